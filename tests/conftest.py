@@ -0,0 +1,38 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xdr_query_api import XDRQueryAPI  # noqa: E402
+from xdr_query_mock_server import MockDataLakeServer  # noqa: E402
+
+
+@pytest.fixture
+def mock_server():
+    with MockDataLakeServer(query_duration=0.0) as server:
+        yield server
+
+
+@pytest.fixture
+def query_api(mock_server):
+    query_api = XDRQueryAPI()
+    query_api.json_config = mock_server.environment_config()
+    yield query_api
+    query_api.close()
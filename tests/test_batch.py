@@ -0,0 +1,69 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from xdr_query_api import ApiError
+from xdr_query_batch import BatchJob, resolve_jobs, run_batch
+
+CREDENTIALS = ('client', 'secret', 'mock')
+TENANT_WHOAMI = {'id': 'tenant-1', 'idType': 'tenant', 'apiHosts': {'dataRegion': 'https://region'}}
+PARTNER_WHOAMI = {'id': 'partner-1', 'idType': 'partner', 'apiHosts': {'global': 'https://global'}}
+
+
+class Resolver:
+
+    def resolve_tenant(self, tenant, authorization, whoami):
+        if tenant == 'unreachable':
+            raise ApiError('Listing tenants failed with error: 500')
+        if tenant == 'unreadable':
+            raise OSError('Permission denied')
+        return tenant + '-id', 'https://' + tenant
+
+
+def test_tenant_mismatch_fails_only_that_job():
+    jobs = [BatchJob('a.sql', 'a.csv', 'other-tenant'), BatchJob('b.sql', 'b.csv')]
+    runnable = resolve_jobs(Resolver(), jobs, 'token', TENANT_WHOAMI)
+    assert runnable == [jobs[1]]
+    assert 'does not match' in jobs[0].error
+    assert jobs[1].tenant_id == 'tenant-1'
+
+
+def test_resolution_failures_are_recorded_per_job():
+    jobs = [BatchJob('a.sql', 'a.csv'), BatchJob('b.sql', 'b.csv', 'unreachable'),
+            BatchJob('c.sql', 'c.csv', 'unreadable'), BatchJob('d.sql', 'd.csv', 'acme')]
+    runnable = resolve_jobs(Resolver(), jobs, 'token', PARTNER_WHOAMI)
+    assert runnable == [jobs[3]]
+    assert [job.error is not None for job in jobs] == [True, True, True, False]
+    assert (jobs[3].tenant_id, jobs[3].url) == ('acme-id', 'https://acme')
+
+
+def test_failing_jobs_do_not_stop_the_batch(mock_server, query_api, tmp_path, monkeypatch):
+    for name, query in (('good', 'SELECT 1'), ('broken', 'SELECT broken')):
+        (tmp_path / (name + '.sql')).write_text(query)
+    stream = query_api.query_results_stream
+
+    def query_results_stream(query, *args, **kwargs):
+        if query == 'SELECT broken':
+            raise KeyError('items')
+        return stream(query, *args, **kwargs)
+
+    monkeypatch.setattr(query_api, 'query_results_stream', query_results_stream)
+    _, whoami = query_api.get_credentials(*CREDENTIALS)
+    jobs = [BatchJob(str(tmp_path / name), str(tmp_path / (name + '.csv')), whoami['id'])
+            for name in ('good.sql', 'broken.sql', 'missing.sql')]
+    run_batch(query_api, jobs, mock_server.base_url, CREDENTIALS, 2, 'csv')
+    assert [job.succeeded for job in jobs] == [True, False, False]
+    assert jobs[0].rows == mock_server.result_rows
+    assert 'items' in jobs[1].error
+    assert jobs[2].error
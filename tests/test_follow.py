@@ -0,0 +1,91 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from datetime import datetime, timezone
+
+from xdr_query_follow import FollowQuery, Watermark
+from xdr_query_results import ResultStream
+
+METADATA = {'columns': [{'name': 'time', 'type': 'varchar'}, {'name': 'value', 'type': 'bigint'}]}
+
+
+class CannedQueryAPI:
+
+    def __init__(self):
+        self.items = []
+        self.queries = []
+
+    def query_results_stream(self, query, tenant_id, url, authorization, use_cache=True):
+        self.queries.append(query)
+        return ResultStream([{'metadata': METADATA, 'items': self.items}])
+
+
+def follow_query(query_api, overlap=0.0):
+    watermark = Watermark(None, datetime(2024, 1, 1, tzinfo=timezone.utc), overlap)
+    return FollowQuery(query_api, 'SELECT time, value FROM events', 'time', watermark)
+
+
+def test_sub_second_rows_are_not_written_twice(capsys):
+    query_api = CannedQueryAPI()
+    follow = follow_query(query_api)
+    query_api.items = [{'time': '2024-01-01T10:00:00.200', 'value': 1},
+                       {'time': '2024-01-01T10:00:00.700', 'value': 2}]
+    assert follow.run_cycle('tenant', 'url', 'token', None, 'ndjson') == 2
+    # The next window starts at the whole second, so both rows come back with a new one
+    query_api.items = query_api.items + [{'time': '2024-01-01T10:00:01.100', 'value': 3}]
+    assert follow.run_cycle('tenant', 'url', 'token', None, 'ndjson') == 1
+    assert query_api.queries[1].endswith("time >= '2024-01-01 10:00:00'")
+    assert capsys.readouterr().out.count('"value": 3') == 1
+
+
+def test_overlap_keeps_rows_it_can_return_again():
+    query_api = CannedQueryAPI()
+    follow = follow_query(query_api, overlap=60)
+    query_api.items = [{'time': '2024-01-01T10:00:30', 'value': 1}, {'time': '2024-01-01T10:01:00.500', 'value': 2}]
+    follow.run_cycle('tenant', 'url', 'token', None, 'ndjson')
+    assert follow.run_cycle('tenant', 'url', 'token', None, 'ndjson') == 0
+
+
+def test_csv_header_is_written_once_to_stdout(capsys):
+    query_api = CannedQueryAPI()
+    follow = follow_query(query_api)
+    query_api.items = [{'time': '2024-01-01T10:00:00', 'value': 1}]
+    follow.run_cycle('tenant', 'url', 'token', None, 'csv')
+    query_api.items = [{'time': '2024-01-01T10:00:05', 'value': 2}]
+    follow.run_cycle('tenant', 'url', 'token', None, 'csv')
+    assert capsys.readouterr().out.splitlines() == ['time,value', '2024-01-01T10:00:00,1', '2024-01-01T10:00:05,2']
+
+
+def test_csv_header_is_not_repeated_in_an_existing_file(tmp_path):
+    output_file = str(tmp_path / 'events.csv')
+    query_api = CannedQueryAPI()
+    follow = follow_query(query_api)
+    query_api.items = [{'time': '2024-01-01T10:00:00', 'value': 1}]
+    follow.run_cycle('tenant', 'url', 'token', output_file, 'csv')
+    follow = follow_query(query_api)
+    query_api.items = [{'time': '2024-01-01T10:00:05', 'value': 2}]
+    follow.run_cycle('tenant', 'url', 'token', output_file, 'csv')
+    with open(output_file) as f:
+        assert f.read().splitlines() == ['time,value', '2024-01-01T10:00:00,1', '2024-01-01T10:00:05,2']
+
+
+def test_rows_without_a_timestamp_are_counted(caplog):
+    query_api = CannedQueryAPI()
+    follow = follow_query(query_api)
+    query_api.items = [{'time': None, 'value': 1}, {'time': '', 'value': 2},
+                       {'time': '2024-01-01T10:00:00', 'value': 3}]
+    assert follow.run_cycle('tenant', 'url', 'token', None, 'ndjson') == 1
+    assert follow.missing_time == 2
+    assert 'Skipped 2 rows without a time value' in caplog.text
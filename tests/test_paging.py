@@ -0,0 +1,55 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from xdr_query_results import next_page_params
+
+
+def page(rows, **pages):
+    return {'items': [{'n': i} for i in range(rows)], 'pages': pages}
+
+
+def test_next_key_is_followed():
+    assert next_page_params(page(2, nextKey='abc', current=1, total=1), 2) == {'pageFromKey': 'abc'}
+
+
+def test_total_decides_when_present():
+    assert next_page_params(page(2, current=1, total=3), 2) == {'page': 2}
+    assert next_page_params(page(2, current=3, total=3), 2) is None
+
+
+def test_full_page_without_total_fetches_the_next_one():
+    assert next_page_params(page(5, current=1), 5) == {'page': 2}
+
+
+def test_short_page_without_total_is_the_last():
+    assert next_page_params(page(4, current=2), 5) is None
+    assert next_page_params(page(0, current=3), 5) is None
+
+
+def test_without_total_or_page_size_paging_stops():
+    assert next_page_params(page(5, current=1)) is None
+
+
+@pytest.mark.parametrize('page_totals', [True, False])
+@pytest.mark.parametrize('rows', [0, 5, 14, 50])
+def test_every_row_is_fetched(mock_server, query_api, page_totals, rows):
+    mock_server.page_totals = page_totals
+    mock_server.result_rows = rows
+    query_api.results_page_size = 7
+    token, whoami = query_api.get_credentials('client', 'secret', 'mock')
+    results = query_api.execute_query('SELECT %d' % rows, whoami['id'], mock_server.base_url, token)
+    assert [item['counter'] for item in results['items']] == list(range(rows))
@@ -0,0 +1,68 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from xdr_query_api import ApiError
+
+CREDENTIALS = ('client', 'secret', 'mock')
+
+
+def revoke(query_api, expires_at=None):
+    # Stands in for a token Central revoked or rotated while it was still cached
+    key = query_api.credential_cache.key(*CREDENTIALS)
+    entry = query_api.credential_cache.entries[key]
+    entry['token'] = 'revoked-token'
+    if expires_at is not None:
+        entry['expires_at'] = expires_at
+    query_api.token_credentials['revoked-token'] = CREDENTIALS
+    return key
+
+
+def test_rejected_token_authenticates_again_once(mock_server, query_api):
+    _, whoami = query_api.get_credentials(*CREDENTIALS)
+    key = revoke(query_api)
+    results = query_api.execute_query('SELECT 1', whoami['id'], mock_server.base_url, 'revoked-token')
+    assert len(results['items']) == mock_server.result_rows
+    assert query_api.credential_cache.entries[key]['token'] != 'revoked-token'
+
+
+def test_expired_token_authenticates_again(mock_server, query_api):
+    _, whoami = query_api.get_credentials(*CREDENTIALS)
+    revoke(query_api, expires_at=0)
+    results = query_api.execute_query('SELECT 1', whoami['id'], mock_server.base_url, 'revoked-token')
+    assert len(results['items']) == mock_server.result_rows
+
+
+def test_refreshed_token_is_reused(mock_server, query_api):
+    token, whoami = query_api.get_credentials(*CREDENTIALS)
+    revoke(query_api)
+    query_api.execute_query('SELECT 1', whoami['id'], mock_server.base_url, 'revoked-token')
+    refreshed = query_api.credential_cache.entries[query_api.credential_cache.key(*CREDENTIALS)]['token']
+    # Another caller still holding the old token joins the new one instead of authenticating again
+    query_api.execute_query('SELECT 2', whoami['id'], mock_server.base_url, 'revoked-token')
+    assert query_api.credential_cache.entries[query_api.credential_cache.key(*CREDENTIALS)]['token'] == refreshed
+
+
+def test_unknown_token_is_not_retried(mock_server, query_api):
+    with pytest.raises(ApiError):
+        query_api.execute_query('SELECT 1', 'tenant', mock_server.base_url, 'unknown-token')
+
+
+def test_whoami_rejection_does_not_authenticate_again(query_api):
+    query_api.get_credentials(*CREDENTIALS)
+    revoke(query_api)
+    with pytest.raises(ApiError):
+        query_api.get_whoami('revoked-token', 'mock')
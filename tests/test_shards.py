@@ -0,0 +1,78 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from xdr_query_shards import ShardError, ShardMerger
+
+GROUPED_QUERY = ('SELECT host, count(*) AS n, sum(bytes) AS total, min(seen) AS first, max(seen) AS last FROM x '
+                 'GROUP BY host ORDER BY n DESC, host')
+COLUMNS = [{'name': 'host', 'type': 'varchar'}, {'name': 'n', 'type': 'bigint'}, {'name': 'total', 'type': 'double'},
+           {'name': 'first', 'type': 'varchar'}, {'name': 'last', 'type': 'varchar'}]
+
+
+def shard(items, columns=COLUMNS):
+    return {'metadata': {'columns': columns}, 'items': items}
+
+
+def test_aggregates_merge_per_group():
+    merged = ShardMerger(GROUPED_QUERY).merge([
+        shard([{'host': 'a', 'n': 2, 'total': 1.5, 'first': '2024-01-02', 'last': '2024-01-03'},
+               {'host': 'b', 'n': 1, 'total': 2, 'first': '2024-01-01', 'last': '2024-01-01'}]),
+        shard([{'host': 'b', 'n': '3', 'total': '0.5', 'first': '2023-12-31', 'last': '2024-01-05'}]),
+    ])
+    groups = {item['host']: item for item in merged['items']}
+    assert groups['a'] == {'host': 'a', 'n': 2, 'total': 1.5, 'first': '2024-01-02', 'last': '2024-01-03'}
+    assert groups['b'] == {'host': 'b', 'n': 4, 'total': 2.5, 'first': '2023-12-31', 'last': '2024-01-05'}
+
+
+def test_merged_groups_are_sorted_again():
+    merged = ShardMerger(GROUPED_QUERY).merge([
+        shard([{'host': 'a', 'n': 2, 'total': 1, 'first': None, 'last': None},
+               {'host': 'c', 'n': 4, 'total': 1, 'first': None, 'last': None}]),
+        shard([{'host': 'b', 'n': 3, 'total': 1, 'first': None, 'last': None},
+               {'host': 'a', 'n': 3, 'total': 1, 'first': None, 'last': None}]),
+    ])
+    assert [(item['host'], item['n']) for item in merged['items']] == [('a', 5), ('c', 4), ('b', 3)]
+
+
+def test_numeric_min_compares_numbers_not_text():
+    columns = [{'name': 'host', 'type': 'varchar'}, {'name': 'n', 'type': 'bigint'}]
+    merged = ShardMerger('SELECT host, min(n) AS n FROM x GROUP BY host ORDER BY n').merge([
+        shard([{'host': 'a', 'n': '10'}, {'host': 'b', 'n': '9'}], columns),
+        shard([{'host': 'a', 'n': '2'}], columns),
+    ])
+    assert merged['items'] == [{'host': 'a', 'n': 2}, {'host': 'b', 'n': 9}]
+
+
+def test_nulls_sort_last():
+    columns = [{'name': 'host', 'type': 'varchar'}, {'name': 'n', 'type': 'bigint'}]
+    merged = ShardMerger('SELECT host, max(n) AS n FROM x GROUP BY host ORDER BY n').merge([
+        shard([{'host': 'a', 'n': None}, {'host': 'b', 'n': 2}], columns),
+        shard([{'host': 'c', 'n': 1}], columns),
+    ])
+    assert [item['host'] for item in merged['items']] == ['c', 'b', 'a']
+
+
+def test_limit_is_rejected_for_grouped_queries():
+    with pytest.raises(ShardError):
+        ShardMerger('SELECT host, count(*) FROM x GROUP BY host ORDER BY 2 DESC LIMIT 10')
+
+
+def test_plain_queries_are_concatenated():
+    columns = [{'name': 'host', 'type': 'varchar'}]
+    merged = ShardMerger('SELECT host FROM x').merge([shard([{'host': 'a'}], columns),
+                                                      shard([{'host': 'b'}], columns)])
+    assert merged['items'] == [{'host': 'a'}, {'host': 'b'}]
@@ -0,0 +1,61 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import importlib
+import random
+
+import pytest
+from tabulate import tabulate
+
+import xdr_query_writers
+from xdr_query_bench import PARITY_HEADERS, PARITY_VALUES
+from xdr_query_writers import table_lines
+
+tabulate_module = importlib.import_module('tabulate')
+
+TABLES = [
+    (['a'], []),
+    (['name', 'count'], [['host', 1], ['other', 22]]),
+    (['n'], [[1], [2.5], ['3']]),
+    (['n', 'text'], [['1,000', 'x'], ['25', 'yy']]),
+    (['mixed'], [[1], ['a'], [None]]),
+    (['flag'], [[True], [False], [None]]),
+    (['multi\nline'], [['one\ntwo\nthree'], ['four']]),
+    (['a', 'b'], [['x\r\ny', 'z'], ['', 'w\nv']]),
+    (['名前', 'v'], [['多字节', 1], ['中\n文字', 22]]),
+    (['emoji'], [['💥'], ['ab']]),
+]
+
+
+@pytest.fixture(params=[True, False], ids=['wcwidth', 'no-wcwidth'])
+def widechars(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(xdr_query_writers, 'wcwidth', None)
+        monkeypatch.setattr(tabulate_module, 'wcwidth', None)
+    elif xdr_query_writers.wcwidth is None:
+        pytest.skip('wcwidth is not installed')
+
+
+@pytest.mark.parametrize('columns, rows', TABLES)
+def test_table_lines_matches_tabulate(widechars, columns, rows):
+    assert '\n'.join(table_lines(columns, rows)) == tabulate(rows, columns, tablefmt='psql')
+
+
+def test_table_lines_matches_tabulate_on_random_tables(widechars):
+    generator = random.Random(0)
+    for _ in range(500):
+        columns = [generator.choice(PARITY_HEADERS) for _ in range(generator.randint(1, 4))]
+        rows = [[generator.choice(PARITY_VALUES) for _ in columns] for _ in range(generator.randint(0, 5))]
+        assert '\n'.join(table_lines(columns, rows)) == tabulate(rows, columns, tablefmt='psql'), (columns, rows)
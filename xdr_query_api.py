@@ -18,18 +18,164 @@ import json
 import logging
 
 import random
-import requests
-from retry import retry
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 from tabulate import tabulate
 
+from xdr_query_cache import CredentialCache, ResultCache, query_key
+from xdr_query_journal import DEFAULT_JOURNAL, ExecutionJournal
+from xdr_query_local import DEFAULT_TABLE, EXECUTIONS, LocalQueryError, LocalResultStore
+from xdr_query_metrics import MetricsRecorder, payload_size, phase, record_bytes
+from xdr_query_scheduler import RequestScheduler, endpoint_key
+from xdr_query_results import CompactResults, ResultStream, build_table, loads, next_page_params
+from xdr_query_shards import TIME_FORMATS, ShardError, ShardMerger, ShardPlan, has_clause
+from xdr_query_spill import SpillBuffer
+from xdr_query_tenants import DEFAULT_TENANT_CACHE, TenantDirectory, TenantError, owner_key, tenant_label
+from xdr_query_transport import HTTPTransport, TransportError, wire_bytes
+from xdr_query_writers import (COMPRESSIONS, OUTPUT_FORMATS, STREAMING_FORMATS, WriterError, compression_for_file,
+                               format_for_file, json_chunks, open_output, table_lines, write_result_rows)
+
 
 class ApiError(Exception):
     pass
 
 
-class XDRQueryAPI:
+class QueryCancelled(ApiError):
+    pass
+
+
+class QueryControl:
+
+    def __init__(self, on_stage=None):
+        self.cancel_event = threading.Event()
+        self.on_stage = on_stage
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise QueryCancelled('Query cancelled')
+
+    def stage(self, name):
+        self.check()
+        if self.on_stage is not None:
+            self.on_stage(name)
+
+    def sleep(self, seconds):
+        if self.cancel_event.wait(seconds):
+            raise QueryCancelled('Query cancelled')
+
+
+class PollPolicy:
+
+    def __init__(self, deadline=300.0, first_delay=0.25, max_delay=10.0, multiplier=1.5, jitter=0.2):
+        self.deadline = deadline
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def next_delay(self, delay):
+        return min(delay * self.multiplier, self.max_delay)
+
+    def jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1)
+
+
+def retry_after_seconds(headers):
+    for name, value in headers.items():
+        if name.lower() == 'retry-after':
+            try:
+                return max(float(value), 0.0)
+            except ValueError:
+                return None
+    return None
+
+
+class TenantQueryResult:
+
+    def __init__(self, tenant_id):
+        self.tenant_id = tenant_id
+        self.succeeded = False
+        self.error = None
+        self.rows = 0
+        self.elapsed = 0.0
+        self.results = None
+
+
+class InFlightQuery:
 
     def __init__(self):
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+        self.followers = 0
+
+
+class QueryCoalescer:
+
+    def __init__(self, wait_interval=0.1):
+        self.wait_interval = wait_interval
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    def key(self, tenant_id, query_text, url, authorization, kind='results'):
+        # Callers sharing whole results and callers sharing an execution to stream must not join each other
+        return query_key(tenant_id, query_text, url, authorization, kind)
+
+    def run(self, key, execute, control=None):
+        while True:
+            with self.lock:
+                query = self.in_flight.get(key)
+                if query is None:
+                    query = InFlightQuery()
+                    self.in_flight[key] = query
+                    self.executions += 1
+                    leader = True
+                else:
+                    query.followers += 1
+                    self.coalesced += 1
+                    leader = False
+
+            if leader:
+                try:
+                    query.results = execute()
+                except BaseException as e:
+                    query.error = e
+                    raise
+                finally:
+                    with self.lock:
+                        del self.in_flight[key]
+                    query.done.set()
+                return query.results
+
+            logging.info('Joining an identical query already in flight')
+            while not query.done.wait(self.wait_interval):
+                if control is not None:
+                    control.check()
+            if query.error is None:
+                return query.results
+            if not isinstance(query.error, QueryCancelled):
+                raise query.error
+            logging.info('Shared query was cancelled, running it again')
+
+
+class XDRQueryBase:
+
+    def __init__(self, credential_cache=None, result_cache=None, tenant_directory=None):
+        self.credential_cache = credential_cache if credential_cache is not None else CredentialCache()
+        self.result_cache = result_cache
+        self.tenant_directory = tenant_directory if tenant_directory is not None else TenantDirectory()
+        self.metrics = None
+        self.coalescer = QueryCoalescer()
+        self.scheduler = RequestScheduler()
+        self.journal = None
+        self.token_credentials = {}
         self.query_success = 201
         self.executions_route = 'xdr-query/v1/queries/runs'
         self.content_type = 'application/json'
@@ -48,6 +194,11 @@ class XDRQueryAPI:
         self.environment_urls = {'whoamiURL': 'https://api.central.sophos.com/whoami/v1',
                                  'tokenURL': 'https://id.sophos.com/api/v2/oauth2/token'}
         self.json_config = ''
+        self.poll_policy = PollPolicy()
+        self.results_page_size = 1000
+        self.tenants_page_size = 100
+        self.spill_rows = 100000
+        self.spill_dir = None
 
     def string_to_urls(self, env: str):
         if env == '':
@@ -57,25 +208,39 @@ class XDRQueryAPI:
 
         return self.json_config[env]
 
-    def service_request_no_client_certs(self, method, url, payload, timeout, headers):
-        try:
-            with requests.Session() as session:
-                data = payload if payload is not None else None
-                req = requests.Request(method, url, data=data, headers=headers)
-                prepped = session.prepare_request(req)
-                resp = session.send(prepped, timeout=timeout, verify=True)
-        except requests.RequestException as e:
-            raise ApiError(e.strerror)
-        data = resp.content
-        status = resp.status_code
-        return data, status, dict(resp.headers)
-
-    def start_query(self, query, url, headers):
-        logging.debug('Running query: ' + query)
-        headers['Content-Type'] = self.content_type
-        executions_url = url + '/' + self.executions_route
-        logging.info('Querying reporting api using ' + executions_url)
-        data, status, _ = self.service_request_no_client_certs('POST', executions_url, query, 10, headers)
+    def throttled_retry(self, key, status, response_headers, retries):
+        if not self.scheduler.is_throttled(status):
+            self.scheduler.completed(key)
+            return False
+        if retries >= self.scheduler.max_retries:
+            return False
+        pause = self.scheduler.throttled(key, retry_after_seconds(response_headers))
+        logging.warning('%s returned %d, backing off %.2fs', key[0], status, pause)
+        return True
+
+    def rejected_credentials(self, status, headers):
+        # Tokens can be revoked or rotated before the cached expiry, a 401 for a token we issued means the
+        # credentials should authenticate again
+        if status != 401:
+            return None
+        token = headers.get('Authorization', '')[len('Bearer '):]
+        credentials = self.token_credentials.get(token)
+        if credentials is None:
+            return None
+        key = self.credential_cache.key(*credentials)
+        entry = self.credential_cache.get(key)
+        # A different token means another request already authenticated again
+        if entry is None or entry['token'] == token:
+            self.credential_cache.invalidate(key)
+        logging.warning('Token was rejected, authenticating again')
+        return credentials
+
+    def start_metrics(self, name):
+        if self.metrics is None:
+            return None
+        return self.metrics.start_execution(name)
+
+    def parse_start_response(self, data, status):
         if status != self.query_success:
             logging.error('Query report status was %d data: %s', status, data)
             raise ApiError('Failed to run query')
@@ -83,23 +248,45 @@ class XDRQueryAPI:
         logging.info('Query report response: ' + str(response_json))
         return response_json['id']
 
-    @retry(tries=60, delay=1, logger=None)
-    def wait_complete_reporting_status(self, execution_id, url, headers):
-        status_url = url + '/' + self.executions_route + '/' + execution_id
-        logging.debug('Checking query status using ' + status_url)
-        data, _, _ = self.service_request_no_client_certs('GET', status_url, None, 10, headers)
-        response_json = json.loads(data)
-        logging.debug('Response json: ' + str(response_json))
-        if response_json['status'].lower() != 'finished':
-            raise ApiError(response_json['status'] + ' is not finished')
+    def hinted_delay(self, response_json, elapsed, delay):
+        progress = response_json.get('progress')
+        if isinstance(progress, (int, float)) and 0 < progress < 1 and elapsed > 0:
+            remaining = elapsed * (1 - progress) / progress
+            return min(max(remaining, self.poll_policy.first_delay), self.poll_policy.max_delay)
+        return self.poll_policy.jittered(delay)
+
+    def check_status_response(self, data, status, response_headers, elapsed, delay):
+        wait = retry_after_seconds(response_headers)
+        if status == 200:
+            response_json = json.loads(data)
+            logging.debug('Response json: ' + str(response_json))
+            if response_json['status'].lower() == 'finished':
+                return response_json, 0
+            if wait is None:
+                wait = self.hinted_delay(response_json, elapsed, delay)
+        elif status == 429 or status >= 500:
+            logging.warning('Query status returned %d, retrying', status)
+            if wait is None:
+                wait = self.poll_policy.jittered(delay)
+        else:
+            logging.error('Query status failed: %d data: %s', status, data)
+            raise ApiError('Query status failed error code: ' + str(status))
+
+        remaining = self.poll_policy.deadline - elapsed
+        if remaining <= 0:
+            raise ApiError('Query did not finish within ' + str(self.poll_policy.deadline) + ' seconds')
+        return None, min(wait, remaining)
+
+    def finish_status(self, status_url, response_json, elapsed, polls, stats):
+        if stats is not None:
+            stats['polls'] = polls
+            stats['time_to_detect'] = elapsed
         logging.info('Query status at ' + status_url + ' complete')
         logging.info('Query status response: ' + str(response_json))
+        logging.info('Completion detected after %.2fs and %d polls', elapsed, polls)
         return response_json['result'].lower() == 'succeeded'
 
-    def get_results(self, execution_id, url, headers):
-        result_url = url + '/' + self.executions_route + '/' + execution_id + '/results'
-        logging.info('Checking query results using ' + result_url)
-        data, status, _ = self.service_request_no_client_certs('GET', result_url, None, 10, headers)
+    def parse_results_response(self, data, status):
         logging.debug('Reporting results: ' + str(status))
         if not status == 200:
             logging.error('Reporting results failed: ' + str(status))
@@ -112,7 +299,14 @@ class XDRQueryAPI:
             except json.JSONDecodeError:
                 pass
             raise ApiError(error)
-        return json.loads(data)
+        return loads(data)
+
+    def results_page_url(self, execution_id, url, params=None):
+        result_url = url + '/' + self.executions_route + '/' + execution_id + '/results'
+        query = {'pageSize': self.results_page_size, 'pageTotal': 'true'}
+        if params:
+            query.update(params)
+        return result_url + '?' + urlencode(query)
 
     def read_query_file(self, file):
         with open(file, 'r') as f:
@@ -120,53 +314,92 @@ class XDRQueryAPI:
         return query
 
     def tabulate_results(self, results):
-        headers = [column['name'] for column in results['metadata']['columns']]
-
-        used_headers = []
-        for item in results['items']:
-            for header in headers:
-                if header in item and header not in used_headers:
-                    used_headers.append(header)
-
-        data = []
-        for item in results['items']:
-            row = []
-            for header in used_headers:
-                if header in item:
-                    row.append(item[header])
-                else:
-                    row.append(None)
-            data.append(row)
-
+        if isinstance(results, CompactResults) and results.spilled:
+            return ''.join(self.format_chunks(results))
+        if isinstance(results, CompactResults):
+            used_headers, data = results.table()
+        else:
+            headers = [column['name'] for column in results['metadata']['columns']]
+            used_headers, data = build_table(headers, results['items'])
         return tabulate(data, used_headers, tablefmt="psql")
 
-    def run_query(self, query_text, tenant_id, url: str, authorization: str, tabulate_result=True):
-
+    def query_request(self, query_text, tenant_id, authorization):
         headers = {
             'Authorization': 'Bearer ' + authorization,
             'X-Tenant-Id': tenant_id
         }
         query_name = random.getrandbits(128)
         templated_query = self.query_template % (tenant_id, query_name, json.dumps(query_text))
+        return templated_query, headers
 
-        execution_id = self.start_query(templated_query, url, headers)
-
-        status = self.wait_complete_reporting_status(execution_id, url, headers)
-
+    def log_query_status(self, status):
         if not status:
             logging.error('Query failed')
         else:
             logging.info('Query run successfully')
 
-        results = self.get_results(execution_id, url, headers)
-        formatted_results = json.dumps(results, indent=4)
+    def cached_results(self, query_text, tenant_id, url, use_cache, refresh_cache, authorization=''):
+        if self.result_cache is None or not use_cache:
+            return None, None
+        # The environment whose credentials issued the token, the url already names the data region
+        environment = self.token_credentials.get(authorization, ('', '', ''))[2]
+        key = self.result_cache.key(tenant_id, query_text, url, environment)
+        if refresh_cache:
+            return key, None
+        results = self.result_cache.get(key)
+        if results is not None:
+            logging.info('Using cached results for tenant ' + tenant_id)
+        return key, results
+
+    def format_results(self, results, tabulate_result=True):
         if tabulate_result:
             logging.debug('Raw Results:' + str(results))
-            formatted_results = self.tabulate_results(results)
-
-        return formatted_results
-
-    def generate_token(self, client_id, client_secret, env=''):
+            return self.tabulate_results(results)
+        if isinstance(results, CompactResults):
+            results = results.to_results()
+        return json.dumps(results, indent=4)
+
+    def buffer_results(self, stream, compact=True):
+        if compact:
+            return CompactResults.from_stream(stream, spill_rows=self.spill_rows, spill_dir=self.spill_dir)
+        if not self.spill_rows:
+            return stream.to_results()
+        items = SpillBuffer(self.spill_rows, self.spill_dir)
+        for page in stream.iter_pages():
+            items.extend(page)
+        return {'metadata': stream.metadata, 'items': items if items.spilled else items.rows}
+
+    def format_chunks(self, results, tabulate_result=True):
+        if tabulate_result:
+            used_headers, data = results.table()
+            lines = table_lines(used_headers, data)
+            line = next(lines, None)
+            for next_line in lines:
+                yield line + '\n'
+                line = next_line
+            if line is not None:
+                yield line
+        else:
+            yield from json_chunks(results['metadata'], results['items'])
+
+    def merge_tenant_results(self, outcomes):
+        columns = [{'name': 'tenant_id', 'type': 'varchar'}]
+        seen = {'tenant_id'}
+        items = []
+        for outcome in outcomes:
+            if not outcome.succeeded:
+                continue
+            for column in outcome.results['metadata']['columns']:
+                if column['name'] not in seen:
+                    seen.add(column['name'])
+                    columns.append(column)
+            for item in outcome.results['items']:
+                row = {'tenant_id': outcome.tenant_id}
+                row.update(item)
+                items.append(row)
+        return {'metadata': {'columns': columns}, 'items': items}
+
+    def token_request(self, client_id, client_secret, env=''):
         url = self.string_to_urls(env)['tokenURL']
 
         if not url:
@@ -176,9 +409,9 @@ class XDRQueryAPI:
             'Content-Type': 'application/x-www-form-urlencoded'
         }
         body = f'grant_type=client_credentials&client_id={client_id}&client_secret={client_secret}&scope=token'
+        return url, body, headers
 
-        data, status, _ = self.service_request_no_client_certs('POST', url, body, 10, headers)
-
+    def parse_token_response(self, data, status):
         if not status == 200:
             raise ApiError('Get Token failed with error: ' + str(status))
 
@@ -186,9 +419,9 @@ class XDRQueryAPI:
         if 'access_token' not in data:
             raise ApiError('Response does not contain access token')
 
-        return data['access_token']
+        return data
 
-    def get_whoami(self, authorization: str, env=''):
+    def whoami_request(self, authorization: str, env=''):
         url = self.string_to_urls(env)['whoamiURL']
 
         if not url:
@@ -197,23 +430,68 @@ class XDRQueryAPI:
         headers = {
             'Authorization': 'Bearer ' + authorization,
         }
+        return url, headers
 
-        data, status, _ = self.service_request_no_client_certs('GET', url, None, 10, headers)
-
+    def parse_whoami_response(self, data, status):
         if not status == 200:
             raise ApiError('Who ami failed with error: ' + str(status))
 
         data = json.loads(data)
         if 'apiHosts' not in data:
             raise ApiError('Could not get api hosts')
-        if 'dataRegion' not in data['apiHosts']:
-            raise ApiError('Could not get data regions')
         if 'id' not in data:
             raise ApiError('Could not get id')
         if 'idType' not in data:
             raise ApiError('Could not get id type')
+        # Partners and organizations have no data region of their own, each tenant has one
+        if data['idType'] == 'tenant' and 'dataRegion' not in data['apiHosts']:
+            raise ApiError('Could not get data regions')
+        if data['idType'] != 'tenant' and 'global' not in data['apiHosts']:
+            raise ApiError('Could not get global api host')
         return data
 
+    def tenants_request(self, authorization: str, whoami, page=1):
+        id_type = whoami['idType']
+        if id_type not in ('partner', 'organization'):
+            raise ApiError('Tenants can only be listed for partner or organization credentials')
+        url = whoami['apiHosts']['global'] + '/' + id_type + '/v1/tenants?' + urlencode(
+            {'page': page, 'pageSize': self.tenants_page_size, 'pageTotal': 'true'})
+        headers = {
+            'Authorization': 'Bearer ' + authorization,
+            'X-' + id_type.capitalize() + '-ID': whoami['id']
+        }
+        return url, headers
+
+    def parse_tenants_response(self, data, status):
+        if status != 200:
+            raise ApiError('Listing tenants failed with error: ' + str(status))
+        response_json = loads(data)
+        if 'items' not in response_json:
+            raise ApiError('Could not get tenants')
+        return response_json
+
+    def tenants_page(self, response_json, page):
+        tenants = []
+        for item in response_json['items']:
+            if 'id' not in item or 'apiHost' not in item:
+                logging.warning('Skipping tenant without an api host: ' + str(item.get('id')))
+                continue
+            tenants.append({'id': item['id'], 'name': item.get('name', ''), 'apiHost': item['apiHost'],
+                            'dataRegion': item.get('dataRegion', '')})
+        pages = response_json.get('pages') or {}
+        if not isinstance(pages.get('total'), int) or page >= pages['total']:
+            return tenants, None
+        return tenants, page + 1
+
+    def own_tenant(self, tenant, whoami):
+        if whoami['idType'] == 'tenant':
+            if tenant and tenant != whoami['id']:
+                raise ApiError('Provided tenant ID does not match whoami response')
+            return whoami['id'], whoami['apiHosts']['dataRegion']
+        if not tenant:
+            raise ApiError('A tenant ID or name is required for ' + whoami['idType'] + ' credentials')
+        return None
+
     def validate_config(self, config):
         if config == '':
             raise ApiError('Config loaded is empty')
@@ -233,6 +511,486 @@ class XDRQueryAPI:
         self.json_config = loaded_config
 
 
+class XDRQueryAPI(XDRQueryBase):
+
+    def __init__(self, transport=None, credential_cache=None, result_cache=None, tenant_directory=None):
+        super().__init__(credential_cache, result_cache, tenant_directory)
+        self.transport = transport if transport is not None else HTTPTransport()
+        self.credential_lock = threading.Lock()
+
+    def service_request_no_client_certs(self, method, url, payload, timeout, headers, reauthenticate=True):
+        key = endpoint_key(method, url, headers.get('X-Tenant-Id'))
+        retries = 0
+        reauthenticated = not reauthenticate
+        while True:
+            wait = self.scheduler.acquire(key)
+            if wait > 0:
+                logging.debug('Rate limit, waiting %.2fs before %s', wait, key[0])
+                time.sleep(wait)
+            try:
+                data, status, response_headers = self.transport.request(method, url, payload, timeout, headers)
+            except TransportError as e:
+                raise ApiError(str(e))
+            record_bytes(payload_size(payload), wire_bytes(response_headers, data))
+            if self.throttled_retry(key, status, response_headers, retries):
+                retries += 1
+                continue
+            credentials = None if reauthenticated else self.rejected_credentials(status, headers)
+            if credentials is not None:
+                # The headers are shared by the rest of the execution, later requests use the new token too
+                headers['Authorization'] = 'Bearer ' + self.get_credentials(*credentials)[0]
+                reauthenticated = True
+                continue
+            return data, status, response_headers
+
+    def close(self):
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start_query(self, query, url, headers, execution=None):
+        logging.debug('Running query: ' + query)
+        headers['Content-Type'] = self.content_type
+        executions_url = url + '/' + self.executions_route
+        logging.info('Querying reporting api using ' + executions_url)
+        with phase(execution, 'start_query'):
+            data, status, _ = self.service_request_no_client_certs('POST', executions_url, query, 10, headers)
+            return self.parse_start_response(data, status)
+
+    def wait_complete_reporting_status(self, execution_id, url, headers, stats=None, control=None, execution=None):
+        status_url = url + '/' + self.executions_route + '/' + execution_id
+        logging.debug('Checking query status using ' + status_url)
+        start = time.monotonic()
+        delay = self.poll_policy.first_delay
+        polls = 0
+        with phase(execution, 'status'):
+            while True:
+                polls += 1
+                if execution is not None:
+                    execution.polls = polls
+                data, status, response_headers = self.service_request_no_client_certs('GET', status_url, None, 10,
+                                                                                      headers)
+                elapsed = time.monotonic() - start
+                response_json, wait = self.check_status_response(data, status, response_headers, elapsed, delay)
+                if response_json is not None:
+                    return self.finish_status(status_url, response_json, elapsed, polls, stats)
+                if control is not None:
+                    control.sleep(wait)
+                else:
+                    time.sleep(wait)
+                delay = self.poll_policy.next_delay(delay)
+
+    def iter_result_pages(self, execution_id, url, headers, control=None, execution=None):
+        params = None
+        while True:
+            if control is not None:
+                control.check()
+            result_url = self.results_page_url(execution_id, url, params)
+            logging.info('Checking query results using ' + result_url)
+            with phase(execution, 'download'):
+                data, status, _ = self.service_request_no_client_certs('GET', result_url, None, 10, headers)
+            with phase(execution, 'decode'):
+                page = self.parse_results_response(data, status)
+            if execution is not None:
+                execution.pages += 1
+                execution.rows += len(page.get('items', []))
+            yield page
+            params = next_page_params(page, self.results_page_size)
+            if params is None:
+                if self.journal is not None:
+                    self.journal.fetched(execution_id)
+                return
+
+    def stream_results(self, execution_id, url, headers, control=None, execution=None):
+        stream = ResultStream(self.iter_result_pages(execution_id, url, headers, control, execution))
+        stream.metrics = execution
+        return stream
+
+    def get_results(self, execution_id, url, headers):
+        return self.stream_results(execution_id, url, headers).to_results()
+
+    def execute_query_stream(self, query_text, tenant_id, url: str, authorization: str, control=None, resume=False):
+        status, stream, _ = self.run_execution(query_text, tenant_id, url, authorization, control, resume)
+        return status, stream
+
+    def run_execution(self, query_text, tenant_id, url: str, authorization: str, control=None, resume=False):
+        execution = self.start_metrics(tenant_id)
+        templated_query, headers = self.query_request(query_text, tenant_id, authorization)
+
+        if resume and self.journal is not None:
+            entry = self.journal.find(tenant_id, query_text, url)
+            if entry is not None:
+                try:
+                    status, stream = self.resume_execution(entry, url, headers, control, execution)
+                    return status, stream, (entry['execution_id'], headers)
+                except QueryCancelled:
+                    raise
+                except ApiError as e:
+                    logging.warning('Could not resume execution %s, running the query again: %s',
+                                    entry['execution_id'], e)
+                    self.journal.remove(entry['execution_id'])
+
+        execution_id = self.start_query(templated_query, url, headers, execution)
+        if self.journal is not None:
+            self.journal.submitted(execution_id, tenant_id, query_text, url)
+        status, stream = self.complete_execution(execution_id, url, headers, control, execution)
+        return status, stream, (execution_id, headers)
+
+    def resume_execution(self, entry, url, headers, control=None, execution=None):
+        logging.info('Resuming execution %s submitted at %s', entry['execution_id'],
+                     time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['submitted_at'])))
+        status = entry['succeeded'] if entry['state'] == 'finished' else None
+        return self.complete_execution(entry['execution_id'], url, headers, control, execution, status)
+
+    def complete_execution(self, execution_id, url, headers, control=None, execution=None, status=None):
+        if execution is not None:
+            execution.execution_id = execution_id
+        if status is None:
+            if control is not None:
+                control.stage('running')
+            status = self.wait_complete_reporting_status(execution_id, url, headers, control=control,
+                                                         execution=execution)
+            self.log_query_status(status)
+            if self.journal is not None:
+                self.journal.finished(execution_id, status)
+        if execution is not None:
+            execution.succeeded = status
+        if control is not None:
+            control.stage('fetching')
+
+        return status, self.stream_results(execution_id, url, headers, control, execution)
+
+    def execute_query(self, query_text, tenant_id, url: str, authorization: str, use_cache=True,
+                      refresh_cache=False, control=None, resume=False):
+        cache_key, results = self.cached_results(query_text, tenant_id, url, use_cache, refresh_cache, authorization)
+        if results is not None:
+            return results
+
+        def execute():
+            status, stream = self.execute_query_stream(query_text, tenant_id, url, authorization, control, resume)
+            results = stream.to_results()
+            if status and cache_key is not None:
+                self.result_cache.put(cache_key, results)
+            return results
+
+        if self.coalescer is None:
+            return execute()
+        return self.coalescer.run(self.coalescer.key(tenant_id, query_text, url, authorization), execute, control)
+
+    def query_results_stream(self, query_text, tenant_id, url: str, authorization: str, use_cache=True,
+                             refresh_cache=False, control=None, resume=False):
+        if self.result_cache is not None and use_cache:
+            return ResultStream([self.execute_query(query_text, tenant_id, url, authorization, use_cache,
+                                                    refresh_cache, control, resume)])
+        if self.coalescer is None:
+            _, stream = self.execute_query_stream(query_text, tenant_id, url, authorization, control, resume)
+            return stream
+        leader = []
+
+        def execute():
+            _, stream, handle = self.run_execution(query_text, tenant_id, url, authorization, control, resume)
+            leader.append(stream)
+            return handle
+
+        # Identical queries in flight share one execution, every caller then reads the result pages itself
+        key = self.coalescer.key(tenant_id, query_text, url, authorization, 'stream')
+        execution_id, headers = self.coalescer.run(key, execute, control)
+        if leader:
+            return leader[0]
+        if control is not None:
+            control.stage('fetching')
+        return self.stream_results(execution_id, url, headers, control)
+
+    def execute_query_compact(self, query_text, tenant_id, url: str, authorization: str, use_cache=True,
+                              refresh_cache=False, control=None):
+        stream = self.query_results_stream(query_text, tenant_id, url, authorization, use_cache, refresh_cache,
+                                           control)
+        return CompactResults.from_stream(stream)
+
+    def execute_query_sharded(self, query_text, tenant_id, url: str, authorization: str, shard_plan, max_workers=8):
+        try:
+            merger = ShardMerger(query_text)
+            queries = shard_plan.shard_queries(query_text)
+        except ShardError as e:
+            raise ApiError(str(e))
+        if not merger.grouped and (has_clause(query_text, 'order by') or has_clause(query_text, 'limit')):
+            logging.warning('ORDER BY and LIMIT apply to each shard, results are concatenated in time window order')
+        logging.info('Running query as %d time window shards', len(queries))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.run_tenant_query, shard_query, tenant_id, url, authorization)
+                       for shard_query in queries]
+            outcomes = [future.result() for future in futures]
+        failed = [outcome for outcome in outcomes if not outcome.succeeded]
+        if failed:
+            raise ApiError('%d of %d shards failed: %s' % (len(failed), len(outcomes), failed[0].error))
+        logging.info('Shards finished in %.2fs at most', max(outcome.elapsed for outcome in outcomes))
+
+        try:
+            return merger.merge([outcome.results for outcome in outcomes])
+        except ShardError as e:
+            raise ApiError(str(e))
+
+    def run_query(self, query_text, tenant_id, url: str, authorization: str, tabulate_result=True, use_cache=True,
+                  refresh_cache=False, shard_plan=None, compact=False):
+        if shard_plan is not None:
+            results = self.execute_query_sharded(query_text, tenant_id, url, authorization, shard_plan)
+        elif compact:
+            results = self.execute_query_compact(query_text, tenant_id, url, authorization, use_cache, refresh_cache)
+        else:
+            results = self.execute_query(query_text, tenant_id, url, authorization, use_cache, refresh_cache)
+        return self.format_results(results, tabulate_result)
+
+    def run_tenant_query(self, query_text, tenant_id, url, authorization):
+        outcome = TenantQueryResult(tenant_id)
+        start = time.monotonic()
+        try:
+            outcome.results = self.execute_query(query_text, tenant_id, url, authorization)
+            outcome.rows = len(outcome.results['items'])
+            outcome.succeeded = True
+        except Exception as e:
+            logging.error('Query for tenant %s failed: %s', tenant_id, e)
+            outcome.error = str(e)
+        outcome.elapsed = time.monotonic() - start
+        return outcome
+
+    def run_query_fan_out(self, query_text, tenant_ids, url: str, authorization: str, max_workers=8,
+                          tenant_urls=None):
+        tenant_urls = tenant_urls or {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.run_tenant_query, query_text, tenant_id, tenant_urls.get(tenant_id, url),
+                                       authorization)
+                       for tenant_id in tenant_ids]
+            outcomes = [future.result() for future in futures]
+        return self.merge_tenant_results(outcomes), outcomes
+
+    def request_token(self, client_id, client_secret, env=''):
+        url, body, headers = self.token_request(client_id, client_secret, env)
+        data, status, _ = self.service_request_no_client_certs('POST', url, body, 10, headers)
+        return self.parse_token_response(data, status)
+
+    def generate_token(self, client_id, client_secret, env=''):
+        return self.request_token(client_id, client_secret, env)['access_token']
+
+    def get_whoami(self, authorization: str, env=''):
+        url, headers = self.whoami_request(authorization, env)
+        # whoami is part of authenticating, a rejected token here must not authenticate again
+        data, status, _ = self.service_request_no_client_certs('GET', url, None, 10, headers, False)
+        return self.parse_whoami_response(data, status)
+
+    def list_tenants(self, authorization: str, whoami):
+        tenants = []
+        page = 1
+        while page is not None:
+            url, headers = self.tenants_request(authorization, whoami, page)
+            data, status, _ = self.service_request_no_client_certs('GET', url, None, 30, headers)
+            page_tenants, page = self.tenants_page(self.parse_tenants_response(data, status), page)
+            tenants.extend(page_tenants)
+        logging.info('Found %d tenants for %s %s', len(tenants), whoami['idType'], whoami['id'])
+        return tenants
+
+    def tenant_index(self, authorization: str, whoami, refresh=False):
+        owner = owner_key(whoami)
+        index = None if refresh else self.tenant_directory.index(owner)
+        if index is None:
+            index = self.tenant_directory.put(owner, self.list_tenants(authorization, whoami))
+        return index
+
+    def resolve_tenant(self, tenant, authorization: str, whoami, refresh=False):
+        own = self.own_tenant(tenant, whoami)
+        if own is not None:
+            return own
+        cached = None if refresh else self.tenant_directory.index(owner_key(whoami))
+        index = cached or self.tenant_index(authorization, whoami, True)
+        try:
+            match = index.resolve(tenant)
+        except TenantError:
+            if cached is None:
+                raise
+            # The cached listing may predate the tenant, check once against Central
+            logging.info('%s not in the cached tenant directory, refreshing it', tenant)
+            match = self.tenant_index(authorization, whoami, True).resolve(tenant)
+        logging.debug('Tenant %s routed to %s', tenant_label(match), match['apiHost'])
+        return match['id'], match['apiHost']
+
+    def resolve_tenants(self, tenants, authorization: str, whoami):
+        # Each tenant is resolved on its own, one unknown name must not stop the others from running
+        tenant_urls = {}
+        failed = []
+        for tenant in tenants:
+            try:
+                tenant_id, url = self.resolve_tenant(tenant, authorization, whoami)
+            except (ApiError, TenantError) as e:
+                logging.error('Cannot resolve tenant %s: %s', tenant, e)
+                outcome = TenantQueryResult(tenant)
+                outcome.error = str(e)
+                failed.append(outcome)
+            else:
+                tenant_urls[tenant_id] = url
+        return tenant_urls, failed
+
+    def get_credentials(self, client_id, client_secret, env=''):
+        key = self.credential_cache.key(client_id, client_secret, env)
+        with self.credential_lock:
+            entry = self.credential_cache.get(key)
+            if entry is None:
+                execution = self.start_metrics('credentials')
+                logging.info('Getting authorization token...')
+                with phase(execution, 'token'):
+                    token_data = self.request_token(client_id, client_secret, env)
+                logging.info('Getting whoami...')
+                with phase(execution, 'whoami'):
+                    whoami = self.get_whoami(token_data['access_token'], env)
+                if execution is not None:
+                    execution.succeeded = True
+                entry = self.credential_cache.put(key, token_data['access_token'], token_data.get('expires_in', 3600),
+                                                  whoami)
+            else:
+                logging.debug('Using cached token and whoami')
+            self.token_credentials[entry['token']] = (client_id, client_secret, env)
+            return entry['token'], entry['whoami']
+
+
+def read_tenant_ids(tenant_ids, tenant_file):
+    ids = []
+    if tenant_ids:
+        ids.extend(tenant_ids.split(','))
+    if tenant_file:
+        with open(tenant_file, 'r') as f:
+            ids.extend(f.read().splitlines())
+    unique = []
+    for tenant_id in ids:
+        tenant_id = tenant_id.strip().lower()
+        if tenant_id and not tenant_id.startswith('#') and tenant_id not in unique:
+            unique.append(tenant_id)
+    return unique
+
+
+def log_tenants(tenants):
+    rows = [[tenant['name'], tenant['id'], tenant['dataRegion'], tenant['apiHost']] for tenant in tenants]
+    table = tabulate(rows, ['name', 'id', 'data_region', 'api_host'], tablefmt='psql')
+    logging.info('%d tenants:\n%s', len(rows), table)
+
+
+def log_resumable(entries):
+    rows = [[entry['execution_id'], entry['tenant_id'], entry['state'],
+             time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['submitted_at']))] for entry in entries]
+    table = tabulate(rows, ['execution_id', 'tenant_id', 'state', 'submitted_at'], tablefmt='psql')
+    logging.info('%d resumable executions:\n%s', len(rows), table)
+
+
+def log_fan_out_report(outcomes):
+    failed = [outcome for outcome in outcomes if not outcome.succeeded]
+    logging.info('Tenant report: %d succeeded, %d failed', len(outcomes) - len(failed), len(failed))
+    for outcome in outcomes:
+        if outcome.succeeded:
+            logging.info('  %s: succeeded, %d rows in %.2fs', outcome.tenant_id, outcome.rows, outcome.elapsed)
+        else:
+            logging.info('  %s: failed in %.2fs: %s', outcome.tenant_id, outcome.elapsed, outcome.error)
+
+
+def write_output(query_api, stream, output_file, output_format, log_results=True, compression=None, f=None):
+    if output_format in STREAMING_FORMATS:
+        with phase(stream.metrics, 'write'):
+            rows = write_result_rows(output_format, output_file, stream.metadata, stream, compression=compression,
+                                     f=f)
+        logging.info('Wrote %d rows as %s', rows, output_format)
+        return
+
+    # Tables only need the row values, so skip building a dict per row
+    results = query_api.buffer_results(stream, output_format == 'table')
+    if is_spilled(results):
+        try:
+            with phase(stream.metrics, 'write'):
+                write_chunks(query_api.format_chunks(results, output_format == 'table'), output_file, log_results,
+                             compression, f)
+        finally:
+            close_results(results)
+        return
+
+    with phase(stream.metrics, 'format'):
+        results = query_api.format_results(results, output_format == 'table')
+    if log_results:
+        logging.info('Results:\n' + str(results))
+
+    if f is not None:
+        with phase(stream.metrics, 'write'):
+            f.write(results + '\n')
+    elif output_file:
+        with phase(stream.metrics, 'write'):
+            with open_output(output_file, compression or compression_for_file(output_file)) as f:
+                f.write(results)
+
+
+def run_local_query(query_api, query, local_db, output_file, output_format, log_results=True, compression=None):
+    with LocalResultStore(local_db) as store:
+        execution = query_api.start_metrics('local')
+        with phase(execution, 'local_query'):
+            stream = store.query(query)
+        stream.metrics = execution
+        write_output(query_api, stream, output_file, output_format, log_results, compression)
+        if execution is not None:
+            execution.rows = stream.rows
+            execution.succeeded = True
+
+
+def is_spilled(results):
+    if isinstance(results, CompactResults):
+        return results.spilled
+    return isinstance(results['items'], SpillBuffer)
+
+
+def close_results(results):
+    if isinstance(results, CompactResults):
+        results.close()
+    else:
+        results['items'].close()
+
+
+def write_chunks(chunks, output_file, log_results=True, compression=None, f=None, log_size=1024 * 1024):
+    out = None
+    if f is None and output_file:
+        out = open_output(output_file, compression or compression_for_file(output_file))
+    try:
+        logged = []
+        logged_size = 0
+        for chunk in chunks:
+            if f is not None:
+                f.write(chunk)
+            elif out is not None:
+                out.write(chunk)
+            if log_results:
+                logged.append(chunk)
+                logged_size += len(chunk)
+                if logged_size >= log_size:
+                    logging.info('Results:\n' + ''.join(logged).rstrip('\n'))
+                    logged = []
+                    logged_size = 0
+        if log_results and logged:
+            logging.info('Results:\n' + ''.join(logged).rstrip('\n'))
+        if f is not None:
+            f.write('\n')
+    finally:
+        if out is not None:
+            out.close()
+
+
+def write_metrics(metrics, metrics_file, prometheus_file):
+    if metrics is None:
+        return
+    try:
+        if metrics_file:
+            metrics.write_json(metrics_file)
+        if prometheus_file:
+            metrics.write_prometheus(prometheus_file)
+    except OSError as e:
+        logging.error('Could not write metrics: ' + str(e))
+
+
 def create_logger(level):
     numeric_level = logging.INFO
     if level:
@@ -246,69 +1004,197 @@ def create_logger(level):
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Argument Parser for sending queries to the reporting api')
-    parser.add_argument('-f', '--query_file', type=str.lower, help='The file containing the query json', required=True)
-    parser.add_argument('-t', '--tenant_id', type=str.lower, help='The tenant id', required=False)
+    parser.add_argument('-f', '--query_file', type=str.lower, help='The file containing the query json')
+    parser.add_argument('-t', '--tenant_id', type=str.lower,
+                        help='The tenant id, or for partner and organization credentials a tenant name', required=False)
     parser.add_argument('-l', '--log_level', type=str.lower, help='Log level: debug ,info, warning, error',
                         required=False, default='info')
     parser.add_argument('-o', '--output_file', type=str.lower, help='The output file to write the result to',
                         required=False)
+    parser.add_argument('-F', '--format', type=str.lower, choices=OUTPUT_FORMATS,
+                        help='Output format, defaults to the output file extension or table')
+    parser.add_argument('--compress', type=str.lower, choices=COMPRESSIONS,
+                        help='Compress the output file, defaults to its .gz or .zst extension')
+    parser.add_argument('--no_log_results', action='store_true', help='Do not echo the results to the log')
     parser.add_argument('-c', '--config', type=str.lower, help='The config file')
     parser.add_argument('-e', '--environment', type=str.lower, help='The environment', default='')
-    parser.add_argument('-id', '--client_id', type=str.lower, help='The client id', required=True)
-    parser.add_argument('-s', '--client_secret', type=str.lower, help='The client secret', required=True)
-
-    return parser.parse_args()
+    parser.add_argument('-id', '--client_id', type=str.lower, help='The client id, required for remote execution')
+    parser.add_argument('-s', '--client_secret', type=str.lower,
+                        help='The client secret, required for remote execution')
+    parser.add_argument('-T', '--tenant_ids', type=str.lower, help='Comma separated tenant ids or names to query')
+    parser.add_argument('--tenant_file', type=str, help='A file with one tenant id per line to query')
+    parser.add_argument('-w', '--workers', type=int, help='Maximum tenants queried at once', default=8)
+    parser.add_argument('--poll_deadline', type=float, help='Seconds to wait for a query to finish', default=300)
+    parser.add_argument('--credential_cache', type=str, help='A file to cache the token and whoami response in')
+    parser.add_argument('--result_cache_ttl', type=float,
+                        help='Reuse results of an identical query run within this many seconds')
+    parser.add_argument('--result_cache_dir', type=str, help='A directory to persist cached results in')
+    parser.add_argument('--refresh_cache', action='store_true', help='Run the query and replace any cached result')
+    parser.add_argument('--no_cache', action='store_true', help='Neither read nor write the result cache')
+    parser.add_argument('--spill_rows', type=int, default=100000,
+                        help='Buffer table and json results on disk past this many rows, 0 to keep them in memory')
+    parser.add_argument('--spill_dir', type=str, help='Directory for spilled results, defaults to the system temp dir')
+    parser.add_argument('--pool_size', type=int, help='Maximum pooled connections per api host', default=10)
+    parser.add_argument('--rate_limit', type=float, default=10,
+                        help='Requests per second per endpoint and tenant to start from, 0 to only react to 429s')
+    parser.add_argument('--shards', type=int,
+                        help='Split the query into this many time windows run concurrently and merge the results')
+    parser.add_argument('--shard_start', type=str, help='Start of the sharded time range, ISO 8601')
+    parser.add_argument('--shard_end', type=str, help='End of the sharded time range, ISO 8601, defaults to now')
+    parser.add_argument('--shard_column', type=str,
+                        help='Timestamp column to filter each shard on, unless the query uses {{start}} and {{end}}')
+    parser.add_argument('--shard_time_format', type=str.lower, choices=TIME_FORMATS, default='timestamp',
+                        help='How shard bounds are written into the query')
+    parser.add_argument('--journal', type=str, nargs='?', const=DEFAULT_JOURNAL,
+                        help='Record submitted executions so they can be resumed, in this file or ' + DEFAULT_JOURNAL)
+    parser.add_argument('--resume', action='store_true',
+                        help='Reattach to an unfetched execution of the same query instead of running it again, '
+                             'implies --journal')
+    parser.add_argument('--list_resumable', action='store_true',
+                        help='List the journaled executions that can still be resumed')
+    parser.add_argument('--metrics', type=str, nargs='?', const='-',
+                        help='Write per phase timings and counts as json to this file, or stdout if no file is given')
+    parser.add_argument('--prometheus_file', type=str, help='Write the metrics in the Prometheus textfile format')
+    parser.add_argument('--execution', type=str.lower, choices=EXECUTIONS, default='remote',
+                        help='Run the query on the Data Lake, or against results saved in --local_db')
+    parser.add_argument('--local_db', type=str,
+                        help='A sqlite file that remote results are saved to and local queries run against')
+    parser.add_argument('--local_table', type=str, default=DEFAULT_TABLE,
+                        help='The local table remote results are saved as, default ' + DEFAULT_TABLE)
+
+    parser.add_argument('--tenant_cache', type=str, default=DEFAULT_TENANT_CACHE,
+                        help='File caching the tenants partner and organization credentials can reach, default ' +
+                             DEFAULT_TENANT_CACHE)
+    parser.add_argument('--tenant_cache_ttl', type=float, default=24 * 3600,
+                        help='Seconds before the cached tenant list is fetched again')
+    parser.add_argument('--refresh_tenants', action='store_true', help='Fetch the tenant list even if it is cached')
+    parser.add_argument('--list_tenants', type=str, nargs='?', const='',
+                        help='List the tenants these credentials can reach, optionally only names with this prefix')
+
+    args = parser.parse_args()
+    if not args.query_file and args.list_tenants is None and not args.list_resumable:
+        parser.error('the following arguments are required: -f/--query_file')
+    if args.execution == 'local' and args.list_tenants is not None:
+        parser.error('--list_tenants requires remote execution')
+    if args.execution == 'local' and not args.local_db:
+        parser.error('local execution requires --local_db')
+    if args.execution == 'remote' and not args.list_resumable and not (args.client_id and args.client_secret):
+        parser.error('remote execution requires --client_id and --client_secret')
+    return args
 
 
 def main():
     args = parse_args()
 
-    query_api = XDRQueryAPI()
+    query_api = XDRQueryAPI(HTTPTransport(pool_size=args.pool_size), CredentialCache(args.credential_cache),
+                            tenant_directory=TenantDirectory(args.tenant_cache, args.tenant_cache_ttl))
+
+    query_api.poll_policy.deadline = args.poll_deadline
+    query_api.scheduler = RequestScheduler(args.rate_limit)
+    query_api.spill_rows = args.spill_rows or None
+    query_api.spill_dir = args.spill_dir
+    if args.result_cache_ttl or args.result_cache_dir:
+        query_api.result_cache = ResultCache(ttl=args.result_cache_ttl or 300, directory=args.result_cache_dir)
+    use_cache = not args.no_cache
+    if args.metrics or args.prometheus_file:
+        query_api.metrics = MetricsRecorder()
 
     create_logger(args.log_level)
+    if args.journal or args.resume or args.list_resumable:
+        query_api.journal = ExecutionJournal(args.journal or DEFAULT_JOURNAL)
+    if args.list_resumable:
+        log_resumable(query_api.journal.unfinished())
+        return
 
     tenant_id = args.tenant_id
 
-    query = query_api.read_query_file(args.query_file)
+    query = query_api.read_query_file(args.query_file) if args.query_file else None
 
     output_file = args.output_file
+    output_format = args.format or format_for_file(output_file)
+
+    local_store = None
+    if args.execution == 'local':
+        try:
+            run_local_query(query_api, query, args.local_db, output_file, output_format, not args.no_log_results,
+                            args.compress)
+        except (LocalQueryError, WriterError) as e:
+            logging.error(str(e))
+        finally:
+            query_api.close()
+            write_metrics(query_api.metrics, args.metrics, args.prometheus_file)
+        return
 
     try:
         if args.config:
             logging.info('Loading config file...')
             query_api.load_config(args.config)
 
-        env = args.environment
-        logging.info('Getting authorization token...')
-        token = query_api.generate_token(args.client_id, args.client_secret, env)
+        token, whoami = query_api.get_credentials(args.client_id, args.client_secret, args.environment)
         logging.debug('Token: %s', token)
 
-        logging.info('Getting whoami...')
-        whoami = query_api.get_whoami(token, env)
+        if args.list_tenants is not None:
+            log_tenants(query_api.tenant_index(token, whoami, args.refresh_tenants).search(args.list_tenants))
+            return
 
-        url = whoami['apiHosts']['dataRegion']
-        logging.debug('Url: %s', url)
+        url = whoami['apiHosts'].get('dataRegion')
+        tenant_urls = {}
+        unresolved = []
 
+        fan_out_ids = read_tenant_ids(args.tenant_ids, args.tenant_file)
         if whoami['idType'] == 'tenant':
+            if fan_out_ids:
+                logging.error('Tenant credentials cannot query other tenants')
+                return
             if tenant_id and tenant_id != whoami['id']:
                 logging.error('Provided tenant ID does not match whoami response')
                 return
             tenant_id = whoami['id']
-        elif not tenant_id:
-            logging.error('Provided tenant ID does not match whoami response')
+        elif not tenant_id and not fan_out_ids:
+            logging.error('A tenant ID or name is required for %s credentials', whoami['idType'])
             return
-        logging.debug('Tenant ID: %s', tenant_id)
-
-        results = query_api.run_query(query, tenant_id, url, token)
+        else:
+            if args.refresh_tenants:
+                query_api.tenant_index(token, whoami, True)
+            if fan_out_ids:
+                tenant_urls, unresolved = query_api.resolve_tenants(fan_out_ids, token, whoami)
+            else:
+                tenant_id, url = query_api.resolve_tenant(tenant_id, token, whoami)
+        logging.debug('Url: %s', url)
 
-        logging.info('Results:\n' + str(results))
+        if fan_out_ids and args.shards:
+            logging.error('Sharding cannot be combined with multiple tenants')
+            return
+        if fan_out_ids:
+            results, outcomes = query_api.run_query_fan_out(query, list(tenant_urls), url, token, args.workers,
+                                                            tenant_urls)
+            log_fan_out_report(unresolved + outcomes)
+            stream = ResultStream([results])
+        elif args.shards:
+            if not args.shard_start:
+                logging.error('Sharding requires --shard_start')
+                return
+            shard_plan = ShardPlan(args.shard_start, args.shard_end, args.shards, args.shard_column,
+                                   args.shard_time_format)
+            stream = ResultStream([query_api.execute_query_sharded(query, tenant_id, url, token, shard_plan,
+                                                                   args.workers)])
+        else:
+            logging.debug('Tenant ID: %s', tenant_id)
+            stream = query_api.query_results_stream(query, tenant_id, url, token, use_cache=use_cache,
+                                                    refresh_cache=args.refresh_cache, resume=args.resume)
 
-        if output_file:
-            with open(output_file, 'wb') as f:
-                f.write(results.encode("utf-8"))
+        if args.local_db:
+            local_store = LocalResultStore(args.local_db)
+            stream = local_store.capture(args.local_table, stream)
+        write_output(query_api, stream, output_file, output_format, not args.no_log_results, args.compress)
 
-    except (ApiError, FileNotFoundError) as e:
+    except (ApiError, ShardError, TenantError, WriterError, LocalQueryError, FileNotFoundError) as e:
         logging.error(str(e))
+    finally:
+        query_api.close()
+        if local_store is not None:
+            local_store.close()
+        write_metrics(query_api.metrics, args.metrics, args.prometheus_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,305 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import logging
+import ssl
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from xdr_query_api import ApiError, TenantQueryResult, XDRQueryBase
+from xdr_query_metrics import payload_size, phase, record_bytes
+from xdr_query_scheduler import endpoint_key
+from xdr_query_results import next_page_params
+from xdr_query_tenants import TenantError, owner_key
+from xdr_query_transport import TransportError, wire_bytes
+
+
+class AsyncHTTPTransport:
+
+    def __init__(self, pool_size=100, verify=True):
+        if aiohttp is None:
+            raise TransportError('The async client requires aiohttp to be installed')
+        self.pool_size = pool_size
+        self.verify = verify
+        self.session = None
+
+    def ssl_context(self):
+        if self.verify is False:
+            return False
+        if isinstance(self.verify, str):
+            return ssl.create_default_context(cafile=self.verify)
+        return None
+
+    def get_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ssl=self.ssl_context())
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def request(self, method, url, payload, timeout, headers):
+        session = self.get_session()
+        try:
+            async with session.request(method, url, data=payload, headers=headers,
+                                       timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                data = await resp.read()
+                return data, resp.status, dict(resp.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransportError(str(e) or type(e).__name__)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncXDRQueryAPI(XDRQueryBase):
+
+    def __init__(self, transport=None, credential_cache=None, tenant_directory=None, result_cache=None):
+        super().__init__(credential_cache, result_cache, tenant_directory)
+        self.transport = transport if transport is not None else AsyncHTTPTransport()
+        self.credential_lock = asyncio.Lock()
+        self.in_flight = {}
+
+    async def service_request_no_client_certs(self, method, url, payload, timeout, headers, reauthenticate=True):
+        key = endpoint_key(method, url, headers.get('X-Tenant-Id'))
+        retries = 0
+        reauthenticated = not reauthenticate
+        while True:
+            wait = self.scheduler.acquire(key)
+            if wait > 0:
+                logging.debug('Rate limit, waiting %.2fs before %s', wait, key[0])
+                await asyncio.sleep(wait)
+            try:
+                data, status, response_headers = await self.transport.request(method, url, payload, timeout,
+                                                                              headers)
+            except TransportError as e:
+                raise ApiError(str(e))
+            record_bytes(payload_size(payload), wire_bytes(response_headers, data))
+            if self.throttled_retry(key, status, response_headers, retries):
+                retries += 1
+                continue
+            credentials = None if reauthenticated else self.rejected_credentials(status, headers)
+            if credentials is not None:
+                headers['Authorization'] = 'Bearer ' + (await self.get_credentials(*credentials))[0]
+                reauthenticated = True
+                continue
+            return data, status, response_headers
+
+    async def close(self):
+        await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def start_query(self, query, url, headers, execution=None):
+        logging.debug('Running query: ' + query)
+        headers['Content-Type'] = self.content_type
+        executions_url = url + '/' + self.executions_route
+        logging.info('Querying reporting api using ' + executions_url)
+        with phase(execution, 'start_query'):
+            data, status, _ = await self.service_request_no_client_certs('POST', executions_url, query, 10, headers)
+            return self.parse_start_response(data, status)
+
+    async def wait_complete_reporting_status(self, execution_id, url, headers, stats=None, control=None,
+                                             execution=None):
+        status_url = url + '/' + self.executions_route + '/' + execution_id
+        logging.debug('Checking query status using ' + status_url)
+        start = time.monotonic()
+        delay = self.poll_policy.first_delay
+        polls = 0
+        with phase(execution, 'status'):
+            while True:
+                polls += 1
+                if execution is not None:
+                    execution.polls = polls
+                data, status, response_headers = await self.service_request_no_client_certs('GET', status_url, None,
+                                                                                            10, headers)
+                elapsed = time.monotonic() - start
+                response_json, wait = self.check_status_response(data, status, response_headers, elapsed, delay)
+                if response_json is not None:
+                    return self.finish_status(status_url, response_json, elapsed, polls, stats)
+                if control is not None:
+                    control.check()
+                await asyncio.sleep(wait)
+                delay = self.poll_policy.next_delay(delay)
+
+    async def iter_result_pages(self, execution_id, url, headers, execution=None):
+        params = None
+        while True:
+            result_url = self.results_page_url(execution_id, url, params)
+            logging.info('Checking query results using ' + result_url)
+            with phase(execution, 'download'):
+                data, status, _ = await self.service_request_no_client_certs('GET', result_url, None, 10, headers)
+            with phase(execution, 'decode'):
+                page = self.parse_results_response(data, status)
+            if execution is not None:
+                execution.pages += 1
+                execution.rows += len(page.get('items', []))
+            yield page
+            params = next_page_params(page, self.results_page_size)
+            if params is None:
+                return
+
+    async def iter_results(self, execution_id, url, headers, execution=None):
+        async for page in self.iter_result_pages(execution_id, url, headers, execution):
+            for item in page.get('items', []):
+                yield item
+
+    async def get_results(self, execution_id, url, headers, execution=None):
+        results = None
+        async for page in self.iter_result_pages(execution_id, url, headers, execution):
+            if results is None:
+                results = {'metadata': page.get('metadata', {'columns': []}), 'items': []}
+            results['items'].extend(page.get('items', []))
+        return results
+
+    async def execute_query(self, query_text, tenant_id, url: str, authorization: str, use_cache=True,
+                            refresh_cache=False):
+        cache_key, results = self.cached_results(query_text, tenant_id, url, use_cache, refresh_cache, authorization)
+        if results is not None:
+            return results
+        if self.coalescer is None:
+            return await self.execute_query_uncoalesced(query_text, tenant_id, url, authorization, cache_key)
+
+        key = self.coalescer.key(tenant_id, query_text, url, authorization)
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.execute_query_uncoalesced(query_text, tenant_id, url, authorization,
+                                                                        cache_key))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            logging.info('Joining an identical query already in flight')
+            self.coalescer.coalesced += 1
+        # Shielded so one caller being cancelled does not cancel the execution the others are waiting on
+        return await asyncio.shield(task)
+
+    async def execute_query_uncoalesced(self, query_text, tenant_id, url, authorization, cache_key=None):
+        execution = self.start_metrics(tenant_id)
+        templated_query, headers = self.query_request(query_text, tenant_id, authorization)
+
+        execution_id = await self.start_query(templated_query, url, headers, execution)
+        if execution is not None:
+            execution.execution_id = execution_id
+
+        status = await self.wait_complete_reporting_status(execution_id, url, headers, execution=execution)
+        self.log_query_status(status)
+        if execution is not None:
+            execution.succeeded = status
+
+        results = await self.get_results(execution_id, url, headers, execution)
+        if status and cache_key is not None:
+            self.result_cache.put(cache_key, results)
+        return results
+
+    async def run_query(self, query_text, tenant_id, url: str, authorization: str, tabulate_result=True,
+                        use_cache=True, refresh_cache=False):
+        results = await self.execute_query(query_text, tenant_id, url, authorization, use_cache, refresh_cache)
+        return self.format_results(results, tabulate_result)
+
+    async def run_tenant_query(self, query_text, tenant_id, url, authorization, semaphore=None):
+        outcome = TenantQueryResult(tenant_id)
+        start = time.monotonic()
+        try:
+            if semaphore is None:
+                outcome.results = await self.execute_query(query_text, tenant_id, url, authorization)
+            else:
+                async with semaphore:
+                    outcome.results = await self.execute_query(query_text, tenant_id, url, authorization)
+            outcome.rows = len(outcome.results['items'])
+            outcome.succeeded = True
+        except Exception as e:
+            logging.error('Query for tenant %s failed: %s', tenant_id, e)
+            outcome.error = str(e)
+        outcome.elapsed = time.monotonic() - start
+        return outcome
+
+    async def run_query_fan_out(self, query_text, tenant_ids, url: str, authorization: str, max_workers=100):
+        semaphore = asyncio.Semaphore(max_workers)
+        outcomes = await asyncio.gather(*[self.run_tenant_query(query_text, tenant_id, url, authorization, semaphore)
+                                          for tenant_id in tenant_ids])
+        return self.merge_tenant_results(outcomes), list(outcomes)
+
+    async def request_token(self, client_id, client_secret, env=''):
+        url, body, headers = self.token_request(client_id, client_secret, env)
+        data, status, _ = await self.service_request_no_client_certs('POST', url, body, 10, headers)
+        return self.parse_token_response(data, status)
+
+    async def generate_token(self, client_id, client_secret, env=''):
+        return (await self.request_token(client_id, client_secret, env))['access_token']
+
+    async def get_whoami(self, authorization: str, env=''):
+        url, headers = self.whoami_request(authorization, env)
+        # whoami is part of authenticating, a rejected token here must not authenticate again
+        data, status, _ = await self.service_request_no_client_certs('GET', url, None, 10, headers, False)
+        return self.parse_whoami_response(data, status)
+
+    async def list_tenants(self, authorization: str, whoami):
+        tenants = []
+        page = 1
+        while page is not None:
+            url, headers = self.tenants_request(authorization, whoami, page)
+            data, status, _ = await self.service_request_no_client_certs('GET', url, None, 30, headers)
+            page_tenants, page = self.tenants_page(self.parse_tenants_response(data, status), page)
+            tenants.extend(page_tenants)
+        logging.info('Found %d tenants for %s %s', len(tenants), whoami['idType'], whoami['id'])
+        return tenants
+
+    async def tenant_index(self, authorization: str, whoami, refresh=False):
+        owner = owner_key(whoami)
+        index = None if refresh else self.tenant_directory.index(owner)
+        if index is None:
+            index = self.tenant_directory.put(owner, await self.list_tenants(authorization, whoami))
+        return index
+
+    async def resolve_tenant(self, tenant, authorization: str, whoami, refresh=False):
+        own = self.own_tenant(tenant, whoami)
+        if own is not None:
+            return own
+        cached = None if refresh else self.tenant_directory.index(owner_key(whoami))
+        index = cached or await self.tenant_index(authorization, whoami, True)
+        try:
+            match = index.resolve(tenant)
+        except TenantError:
+            if cached is None:
+                raise
+            logging.info('%s not in the cached tenant directory, refreshing it', tenant)
+            match = (await self.tenant_index(authorization, whoami, True)).resolve(tenant)
+        return match['id'], match['apiHost']
+
+    async def get_credentials(self, client_id, client_secret, env=''):
+        key = self.credential_cache.key(client_id, client_secret, env)
+        async with self.credential_lock:
+            entry = self.credential_cache.get(key)
+            if entry is None:
+                execution = self.start_metrics('credentials')
+                with phase(execution, 'token'):
+                    token_data = await self.request_token(client_id, client_secret, env)
+                with phase(execution, 'whoami'):
+                    whoami = await self.get_whoami(token_data['access_token'], env)
+                if execution is not None:
+                    execution.succeeded = True
+                entry = self.credential_cache.put(key, token_data['access_token'], token_data.get('expires_in', 3600),
+                                                  whoami)
+            self.token_credentials[entry['token']] = (client_id, client_secret, env)
+            return entry['token'], entry['whoami']
@@ -0,0 +1,244 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from xdr_query_api import ApiError, XDRQueryAPI, create_logger, write_metrics, write_output
+from xdr_query_cache import CredentialCache
+from xdr_query_journal import DEFAULT_JOURNAL, ExecutionJournal
+from xdr_query_metrics import MetricsRecorder
+from xdr_query_scheduler import RequestScheduler
+from xdr_query_tenants import DEFAULT_TENANT_CACHE, TenantDirectory, TenantError
+from xdr_query_transport import HTTPTransport
+from xdr_query_writers import COMPRESSION_EXTENSIONS, COMPRESSIONS, FORMAT_EXTENSIONS, OUTPUT_FORMATS, format_for_file
+
+
+class BatchJob:
+
+    def __init__(self, query_file, output_file, tenant_id=None):
+        self.query_file = query_file
+        self.output_file = output_file
+        self.tenant_id = tenant_id
+        self.url = None
+        self.succeeded = False
+        self.error = None
+        self.rows = 0
+        self.elapsed = 0.0
+
+    def summary(self):
+        return {'query_file': self.query_file, 'output_file': self.output_file, 'tenant_id': self.tenant_id,
+                'succeeded': self.succeeded, 'error': self.error, 'rows': self.rows,
+                'elapsed': round(self.elapsed, 3)}
+
+
+def jobs_from_directory(query_dir, output_dir, extension, output_extension):
+    jobs = []
+    for name in sorted(os.listdir(query_dir)):
+        query_file = os.path.join(query_dir, name)
+        if not os.path.isfile(query_file) or (extension and not name.endswith(extension)):
+            continue
+        output_file = os.path.join(output_dir, os.path.splitext(name)[0] + output_extension)
+        jobs.append(BatchJob(query_file, output_file))
+    return jobs
+
+
+def jobs_from_manifest(manifest_file, output_dir, output_extension):
+    with open(manifest_file, 'r') as f:
+        manifest = json.loads(f.read())
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    jobs = []
+    for entry in manifest:
+        if 'query_file' not in entry:
+            raise ApiError('query_file not found in manifest entry')
+        query_file = os.path.join(base_dir, entry['query_file'])
+        output_file = entry.get('output_file')
+        if output_file is None:
+            output_file = os.path.splitext(os.path.basename(query_file))[0] + output_extension
+        output_file = os.path.join(output_dir or base_dir, output_file)
+        jobs.append(BatchJob(query_file, output_file, entry.get('tenant_id')))
+    return jobs
+
+
+def resolve_job_tenant(query_api, job, token, whoami):
+    if whoami['idType'] == 'tenant':
+        if job.tenant_id and job.tenant_id != whoami['id']:
+            raise ApiError('Tenant ID ' + job.tenant_id + ' does not match whoami response')
+        job.tenant_id = whoami['id']
+    elif not job.tenant_id:
+        raise ApiError('No tenant ID for ' + whoami['idType'] + ' credentials')
+    else:
+        job.tenant_id, job.url = query_api.resolve_tenant(job.tenant_id, token, whoami)
+
+
+def resolve_jobs(query_api, jobs, token, whoami):
+    for job in jobs:
+        try:
+            resolve_job_tenant(query_api, job, token, whoami)
+        except Exception as e:
+            # Reported as a failed job, the rest of the batch still runs
+            logging.error('%s failed: %s', job.query_file, e)
+            job.error = str(e)
+    return [job for job in jobs if job.error is None]
+
+
+def run_job(query_api, job, url, credentials, output_format, resume=False, compression=None):
+    start = time.monotonic()
+    try:
+        query = query_api.read_query_file(job.query_file)
+        token, _ = query_api.get_credentials(*credentials)
+        stream = query_api.query_results_stream(query, job.tenant_id, job.url or url, token, resume=resume)
+        write_output(query_api, stream, job.output_file, output_format or format_for_file(job.output_file), False,
+                     compression)
+        job.rows = stream.rows
+        job.succeeded = True
+    except Exception as e:
+        logging.error('%s failed: %s', job.query_file, e)
+        job.error = str(e)
+    job.elapsed = time.monotonic() - start
+    logging.info('%s finished in %.2fs', job.query_file, job.elapsed)
+    return job
+
+
+def run_batch(query_api, jobs, url, credentials, workers, output_format=None, resume=False, compression=None):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda job: run_job(query_api, job, url, credentials, output_format, resume,
+                                                     compression), jobs))
+
+
+def log_summary(jobs, elapsed):
+    failed = [job for job in jobs if not job.succeeded]
+    logging.info('Batch finished in %.2fs: %d succeeded, %d failed', elapsed, len(jobs) - len(failed), len(failed))
+    for job in jobs:
+        if job.succeeded:
+            logging.info('  %s: %d rows in %.2fs -> %s', job.query_file, job.rows, job.elapsed, job.output_file)
+        else:
+            logging.info('  %s: failed in %.2fs: %s', job.query_file, job.elapsed, job.error)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run a directory or manifest of queries against the reporting api')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-d', '--query_dir', type=str, help='A directory of query files')
+    source.add_argument('-m', '--manifest', type=str,
+                        help='A json list of {"query_file", "output_file", "tenant_id"} entries')
+    parser.add_argument('-o', '--output_dir', type=str, help='The directory to write results to')
+    parser.add_argument('-x', '--extension', type=str, help='Only run files in query_dir with this extension',
+                        default='.sql')
+    parser.add_argument('-F', '--format', type=str.lower, choices=OUTPUT_FORMATS,
+                        help='Output format, defaults to each output file extension or table')
+    parser.add_argument('--compress', type=str.lower, choices=COMPRESSIONS,
+                        help='Compress each output file, defaults to its .gz or .zst extension')
+    parser.add_argument('-t', '--tenant_id', type=str.lower, help='The tenant id for jobs that do not set one')
+    parser.add_argument('-l', '--log_level', type=str.lower, help='Log level: debug ,info, warning, error',
+                        required=False, default='info')
+    parser.add_argument('-c', '--config', type=str, help='The config file')
+    parser.add_argument('-e', '--environment', type=str.lower, help='The environment', default='')
+    parser.add_argument('-id', '--client_id', type=str.lower, help='The client id', required=True)
+    parser.add_argument('-s', '--client_secret', type=str.lower, help='The client secret', required=True)
+    parser.add_argument('-w', '--workers', type=int, help='Maximum queries run at once', default=4)
+    parser.add_argument('--credential_cache', type=str, help='A file to cache the token and whoami response in')
+    parser.add_argument('--spill_rows', type=int, default=100000,
+                        help='Buffer table and json results on disk past this many rows, 0 to keep them in memory')
+    parser.add_argument('--spill_dir', type=str, help='Directory for spilled results, defaults to the system temp dir')
+    parser.add_argument('--tenant_cache', type=str, default=DEFAULT_TENANT_CACHE,
+                        help='File caching the tenants partner and organization credentials can reach, default ' +
+                             DEFAULT_TENANT_CACHE)
+    parser.add_argument('--tenant_cache_ttl', type=float, default=24 * 3600,
+                        help='Seconds before the cached tenant list is fetched again')
+    parser.add_argument('--refresh_tenants', action='store_true', help='Fetch the tenant list even if it is cached')
+    parser.add_argument('--summary_file', type=str, help='Write a json summary of the batch to this file')
+    parser.add_argument('--poll_deadline', type=float, help='Seconds to wait for a query to finish', default=300)
+    parser.add_argument('--rate_limit', type=float, default=10,
+                        help='Requests per second per endpoint and tenant to start from, 0 to only react to 429s')
+    parser.add_argument('--journal', type=str, nargs='?', const=DEFAULT_JOURNAL,
+                        help='Record submitted executions so they can be resumed, in this file or ' + DEFAULT_JOURNAL)
+    parser.add_argument('--resume', action='store_true',
+                        help='Reattach to unfetched executions of the same queries instead of running them again, '
+                             'implies --journal')
+    parser.add_argument('--metrics', type=str, nargs='?', const='-',
+                        help='Write per phase timings and counts as json to this file, or stdout if no file is given')
+    parser.add_argument('--prometheus_file', type=str, help='Write the metrics in the Prometheus textfile format')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    create_logger(args.log_level)
+
+    query_api = XDRQueryAPI(HTTPTransport(pool_size=args.workers * 2), CredentialCache(args.credential_cache),
+                            tenant_directory=TenantDirectory(args.tenant_cache, args.tenant_cache_ttl))
+    query_api.poll_policy.deadline = args.poll_deadline
+    query_api.scheduler = RequestScheduler(args.rate_limit)
+    query_api.spill_rows = args.spill_rows or None
+    query_api.spill_dir = args.spill_dir
+    if args.journal or args.resume:
+        query_api.journal = ExecutionJournal(args.journal or DEFAULT_JOURNAL)
+    if args.metrics or args.prometheus_file:
+        query_api.metrics = MetricsRecorder()
+
+    try:
+        output_extension = FORMAT_EXTENSIONS[args.format or 'table']
+        if args.compress and args.format != 'parquet':
+            output_extension += COMPRESSION_EXTENSIONS[args.compress]
+        if args.query_dir:
+            jobs = jobs_from_directory(args.query_dir, args.output_dir or args.query_dir, args.extension,
+                                       output_extension)
+        else:
+            jobs = jobs_from_manifest(args.manifest, args.output_dir, output_extension)
+        if not jobs:
+            logging.error('No queries found')
+            return
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+
+        if args.config:
+            logging.info('Loading config file...')
+            query_api.load_config(args.config)
+
+        credentials = (args.client_id, args.client_secret, args.environment)
+        token, whoami = query_api.get_credentials(*credentials)
+        url = whoami['apiHosts'].get('dataRegion')
+        if args.refresh_tenants and whoami['idType'] != 'tenant':
+            query_api.tenant_index(token, whoami, True)
+
+        for job in jobs:
+            if job.tenant_id is None:
+                job.tenant_id = args.tenant_id
+        runnable = resolve_jobs(query_api, jobs, token, whoami)
+        logging.info('Running %d queries with %d workers...', len(runnable), args.workers)
+        start = time.monotonic()
+        run_batch(query_api, runnable, url, credentials, args.workers, args.format, args.resume, args.compress)
+        log_summary(jobs, time.monotonic() - start)
+
+        if args.summary_file:
+            with open(args.summary_file, 'w') as f:
+                f.write(json.dumps([job.summary() for job in jobs], indent=4))
+
+    except (ApiError, TenantError, OSError, json.JSONDecodeError) as e:
+        logging.error(str(e))
+    finally:
+        query_api.close()
+        write_metrics(query_api.metrics, args.metrics, args.prometheus_file)
+
+
+if __name__ == '__main__':
+    main()
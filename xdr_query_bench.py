@@ -0,0 +1,383 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from tabulate import tabulate
+
+import xdr_query_api
+from xdr_query_api import XDRQueryAPI
+from xdr_query_async import AsyncXDRQueryAPI, aiohttp
+from xdr_query_mock_server import MockDataLakeServer, generate_self_signed_cert
+from xdr_query_results import CompactResults, ResultStream, build_table, orjson
+from xdr_query_transport import HTTPTransport
+from xdr_query_writers import table_lines
+
+
+def run_mock_queries(server, transport, queries):
+    query_api = XDRQueryAPI(transport)
+    query_api.json_config = server.environment_config()
+    try:
+        start = time.perf_counter()
+        for _ in range(queries):
+            token = query_api.generate_token('mock-client', 'mock-secret', 'mock')
+            whoami = query_api.get_whoami(token, 'mock')
+            query_api.run_query('SELECT 1', whoami['id'], whoami['apiHosts']['dataRegion'], token)
+        return time.perf_counter() - start
+    finally:
+        query_api.close()
+
+
+def bench_transport(queries, query_duration):
+    with tempfile.TemporaryDirectory() as cert_dir:
+        cert_file, key_file = generate_self_signed_cert(cert_dir)
+        with MockDataLakeServer(query_duration=query_duration, cert_file=cert_file, key_file=key_file) as server:
+            report = []
+            for name, keep_alive in (('per-request connection', False), ('pooled keep-alive', True)):
+                server.reset_counters()
+                elapsed = run_mock_queries(server, HTTPTransport(keep_alive=keep_alive, verify=cert_file), queries)
+                report.append((name, server.requests, server.connections, elapsed))
+
+    print('%-24s %10s %12s %18s %10s' % ('transport', 'requests', 'handshakes', 'handshakes/query', 'seconds'))
+    for name, requests, connections, elapsed in report:
+        print('%-24s %10d %12d %18.1f %10.2f' % (name, requests, connections, connections / queries, elapsed))
+    saved = (report[0][2] - report[1][2]) / queries
+    print('Handshakes saved per query: %.1f' % saved)
+
+
+def legacy_build_table(headers, items):
+    used_headers = []
+    for item in items:
+        for header in headers:
+            if header in item and header not in used_headers:
+                used_headers.append(header)
+
+    data = []
+    for item in items:
+        row = []
+        for header in used_headers:
+            if header in item:
+                row.append(item[header])
+            else:
+                row.append(None)
+        data.append(row)
+    return used_headers, data
+
+
+def synthetic_results(rows, columns, sparsity):
+    names = ['column_' + str(i) for i in range(columns)]
+    items = []
+    for i in range(rows):
+        items.append({name: i * columns + j for j, name in enumerate(names) if (i + j) % sparsity})
+    return names, items
+
+
+def best_of(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+PARITY_VALUES = [None, '', True, 'True', 3, -0.001, 4.25, 1e-7, 12345678901234567890, '1', '2.5', '-3e5', ' 12 ',
+                 '1,000', '+1,000.50', '1,0000', 'nan', 'inf', '0x10', '１２', 'a', ' c ', 'x\ny', 'a\r\nb', '7\n',
+                 'x\x0by', '多字节', '中\n文字', 'ｗ\r\nide', 'é', '💥', [1, 2], {'a': 'b\nc'}]
+PARITY_HEADERS = ['h', 'head', '名前', 'mul\nti', 'n\r\nx']
+
+
+def check_table_parity(cases=2000, seed=0):
+    # Spilled tables are laid out by table_lines, they must match what tabulate prints for in-memory ones
+    generator = random.Random(seed)
+    for _ in range(cases):
+        columns = [generator.choice(PARITY_HEADERS) for _ in range(generator.randint(1, 4))]
+        rows = [[generator.choice(PARITY_VALUES) for _ in columns] for _ in range(generator.randint(0, 5))]
+        expected = tabulate(rows, columns, tablefmt='psql')
+        if '\n'.join(table_lines(columns, rows)) != expected:
+            raise RuntimeError('table_lines and tabulate disagree for ' + repr((columns, rows)))
+    print('table_lines matches tabulate on %d random tables' % cases)
+
+
+def bench_tabulate(repeat, include_render):
+    check_table_parity()
+    shapes = (('tall', 100000, 10), ('wide', 20000, 80), ('tall+wide', 100000, 80))
+    print('%-10s %8s %8s %12s %12s %8s' % ('shape', 'rows', 'columns', 'legacy s', 'columnar s', 'speedup'))
+    for name, rows, columns in shapes:
+        headers, items = synthetic_results(rows, columns, 7)
+        if legacy_build_table(headers, items[:1000]) != build_table(headers, items[:1000]):
+            raise RuntimeError('Table builders disagree')
+        legacy = best_of(repeat, legacy_build_table, headers, items)
+        columnar = best_of(repeat, build_table, headers, items)
+        print('%-10s %8d %8d %12.3f %12.3f %7.1fx' % (name, rows, columns, legacy, columnar, legacy / columnar))
+        if include_render:
+            results = {'metadata': {'columns': [{'name': header} for header in headers]}, 'items': items}
+            render = best_of(1, XDRQueryAPI().tabulate_results, results)
+            print('%-10s tabulate_results including psql rendering: %.3fs' % ('', render))
+
+
+def synthetic_pages(rows, columns, page_size=1000):
+    metadata = {'columns': [{'name': 'column_' + str(i), 'type': 'bigint' if i % 3 == 0 else 'varchar'}
+                            for i in range(columns)]}
+    pages = []
+    for start in range(0, rows, page_size):
+        items = []
+        for i in range(start, min(start + page_size, rows)):
+            items.append({column['name']: i * columns + j if j % 3 == 0 else 'value-' + str((i + j) % 1013)
+                          for j, column in enumerate(metadata['columns'])})
+        pages.append(json.dumps({'metadata': metadata, 'items': items}).encode('utf-8'))
+    return pages
+
+
+def decode_dict_rows(pages, loads):
+    return ResultStream(loads(page) for page in pages).to_results()
+
+
+def decode_compact_rows(pages, loads):
+    return CompactResults.from_stream(ResultStream(loads(page) for page in pages), intern=False)
+
+
+def decode_interned_rows(pages, loads):
+    return CompactResults.from_stream(ResultStream(loads(page) for page in pages))
+
+
+def measure_memory(function, *args):
+    tracemalloc.start()
+    result = function(*args)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained / (1024 * 1024), peak / (1024 * 1024)
+
+
+def bench_results(rows, columns, repeat):
+    pages = synthetic_pages(rows, columns)
+    megabytes = sum(map(len, pages)) / (1024 * 1024)
+    print('%d rows x %d columns in %d pages, %.1f MB of json' % (rows, columns, len(pages), megabytes))
+    decoders = [('json', json.loads)]
+    if orjson is not None:
+        decoders.append(('orjson', orjson.loads))
+    else:
+        print('orjson is not installed, only the json decoder is measured')
+
+    print('%-24s %10s %12s %10s' % ('model', 'decode s', 'retained MB', 'peak MB'))
+    baseline = None
+    for decoder, loads in decoders:
+        for model, function in (('dict rows', decode_dict_rows), ('compact rows', decode_compact_rows),
+                                ('interned rows', decode_interned_rows)):
+            elapsed = best_of(repeat, function, pages, loads)
+            retained, peak = measure_memory(function, pages, loads)
+            baseline = baseline or (elapsed, retained)
+            print('%-24s %10.3f %12.1f %10.1f   %.1fx faster, %.1fx smaller' % (
+                model + ' (' + decoder + ')', elapsed, retained, peak, baseline[0] / elapsed, baseline[1] / retained))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+class Workload:
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.failures = 0
+        self.elapsed = 0.0
+        self.peak_memory = None
+
+    def timed(self, function, *args):
+        start = time.perf_counter()
+        try:
+            function(*args)
+        except Exception as e:
+            logging.warning('%s query failed: %s', self.name, e)
+            self.failures += 1
+        self.latencies.append(time.perf_counter() - start)
+
+    def summary(self):
+        return {'workload': self.name, 'queries': len(self.latencies), 'failures': self.failures,
+                'p50': percentile(self.latencies, 0.5), 'p90': percentile(self.latencies, 0.9),
+                'p99': percentile(self.latencies, 0.99), 'max': max(self.latencies, default=0.0),
+                'throughput': len(self.latencies) / self.elapsed if self.elapsed else 0.0,
+                'peak_memory_mb': self.peak_memory}
+
+
+def mock_query_api(server):
+    query_api = XDRQueryAPI()
+    query_api.json_config = server.environment_config()
+    token, whoami = query_api.get_credentials('mock-client', 'mock-secret', 'mock')
+    return query_api, token, whoami['id'], whoami['apiHosts']['dataRegion']
+
+
+def workload_run_query(server, queries, workers, work_dir):
+    workload = Workload('run_query')
+    query_api, token, tenant_id, url = mock_query_api(server)
+    with query_api:
+        for _ in range(queries):
+            workload.timed(query_api.run_query, 'SELECT 1', tenant_id, url, token)
+    return workload
+
+
+def workload_concurrent(server, queries, workers, work_dir):
+    workload = Workload('concurrent x' + str(workers))
+    query_api, token, tenant_id, url = mock_query_api(server)
+    with query_api, ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(queries):
+            executor.submit(workload.timed, query_api.execute_query, 'SELECT ' + str(i), tenant_id, url, token)
+    return workload
+
+
+def workload_async(server, queries, workers, work_dir):
+    workload = Workload('async x' + str(workers))
+
+    async def timed(query_api, semaphore, query, tenant_id, url, token):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await query_api.execute_query(query, tenant_id, url, token)
+            except Exception as e:
+                logging.warning('async query failed: %s', e)
+                workload.failures += 1
+            workload.latencies.append(time.perf_counter() - start)
+
+    async def run():
+        async with AsyncXDRQueryAPI() as query_api:
+            query_api.json_config = server.environment_config()
+            token, whoami = await query_api.get_credentials('mock-client', 'mock-secret', 'mock')
+            semaphore = asyncio.Semaphore(workers)
+            await asyncio.gather(*[timed(query_api, semaphore, 'SELECT ' + str(i), whoami['id'],
+                                         whoami['apiHosts']['dataRegion'], token) for i in range(queries)])
+
+    asyncio.run(run())
+    return workload
+
+
+def workload_cli(server, queries, workers, work_dir):
+    workload = Workload('cli main()')
+    config_file = os.path.join(work_dir, 'config.json')
+    query_file = os.path.join(work_dir, 'query.sql')
+    output_file = os.path.join(work_dir, 'output.txt')
+    with open(config_file, 'w') as f:
+        f.write(json.dumps(server.environment_config()))
+    with open(query_file, 'w') as f:
+        f.write('SELECT 1')
+
+    argv = sys.argv
+    sys.argv = ['xdr_query_api.py', '-f', query_file, '-id', 'mock-client', '-s', 'mock-secret', '-c', config_file,
+                '-e', 'mock', '-o', output_file, '-l', logging.getLevelName(logging.getLogger().level).lower(),
+                '--no_log_results', '--no_journal']
+    try:
+        for _ in range(queries):
+            workload.timed(xdr_query_api.main)
+    finally:
+        sys.argv = argv
+    return workload
+
+
+E2E_WORKLOADS = {'run_query': workload_run_query, 'concurrent': workload_concurrent, 'async': workload_async,
+                 'cli': workload_cli}
+
+
+def bench_e2e(args):
+    server_options = {'query_duration': args.query_duration if args.query_duration is not None else 0.5,
+                      'result_rows': args.result_rows, 'result_columns': args.result_columns,
+                      'latency': args.latency, 'error_rate': args.error_rate, 'throttle_rps': args.throttle_rps}
+    report = []
+    with MockDataLakeServer(**server_options) as server, tempfile.TemporaryDirectory() as work_dir:
+        for name in args.workloads:
+            if name == 'async' and aiohttp is None:
+                print('aiohttp is not installed, the async workload is skipped')
+                continue
+            if args.memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            workload = E2E_WORKLOADS[name](server, args.queries, args.workers, work_dir)
+            workload.elapsed = time.perf_counter() - start
+            if args.memory:
+                workload.peak_memory = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                tracemalloc.stop()
+            report.append(workload.summary())
+
+    print('%-16s %7s %6s %8s %8s %8s %8s %9s %9s' % ('workload', 'queries', 'failed', 'p50 s', 'p90 s', 'p99 s',
+                                                     'max s', 'q/s', 'peak MB'))
+    for row in report:
+        peak = '%9.1f' % row['peak_memory_mb'] if row['peak_memory_mb'] is not None else '%9s' % '-'
+        print('%-16s %7d %6d %8.3f %8.3f %8.3f %8.3f %9.2f %s' % (
+            row['workload'], row['queries'], row['failures'], row['p50'], row['p90'], row['p99'], row['max'],
+            row['throughput'], peak))
+    print('Process max RSS: %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    if args.json_output:
+        with open(args.json_output, 'w') as f:
+            f.write(json.dumps({'server': server_options, 'workloads': report}, indent=4))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks for the query api against a local mock server')
+    parser.add_argument('benchmark', choices=['transport', 'tabulate', 'e2e', 'results'], help='The benchmark to run')
+    parser.add_argument('-n', '--queries', type=int, help='Number of queries to run', default=5)
+    parser.add_argument('--query_duration', type=float,
+                        help='Seconds each mock query runs for, 3 for transport and 0.5 for e2e by default')
+    parser.add_argument('--workloads', nargs='+', choices=list(E2E_WORKLOADS), default=list(E2E_WORKLOADS),
+                        help='The e2e workloads to run')
+    parser.add_argument('-w', '--workers', type=int, help='Concurrency for the concurrent workloads', default=8)
+    parser.add_argument('--result_rows', type=int, help='Rows the mock returns per query, or decoded by results',
+                        default=1000)
+    parser.add_argument('--result_columns', type=int, help='Columns the mock returns per row, or decoded by results',
+                        default=10)
+    parser.add_argument('--latency', type=float, help='Seconds the mock adds to every response', default=0.0)
+    parser.add_argument('--error_rate', type=float, help='Fraction of mock requests failing with 500', default=0.0)
+    parser.add_argument('--throttle_rps', type=float, help='Mock requests per second before 429s', default=0.0)
+    parser.add_argument('--memory', action='store_true', help='Trace peak python memory per workload')
+    parser.add_argument('--json_output', type=str, help='Also write the e2e report as json to this file')
+    parser.add_argument('-r', '--repeat', type=int, help='Repetitions per measurement, best is reported', default=3)
+    parser.add_argument('--render', action='store_true', help='Also time the full psql rendering')
+    parser.add_argument('-l', '--log_level', type=str.lower, help='Log level: debug ,info, warning, error',
+                        default='warning')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                        level=getattr(logging, args.log_level.upper(), logging.WARNING))
+
+    if args.benchmark == 'transport':
+        bench_transport(args.queries, args.query_duration if args.query_duration is not None else 3.0)
+    elif args.benchmark == 'tabulate':
+        bench_tabulate(args.repeat, args.render)
+    elif args.benchmark == 'e2e':
+        bench_e2e(args)
+    elif args.benchmark == 'results':
+        bench_results(args.result_rows, args.result_columns, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
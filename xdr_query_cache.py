@@ -0,0 +1,224 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from xdr_query_sql import mask_literals
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def write_private_file(filename, data):
+    # A temporary file per writer, so concurrent processes never replace each other's half written file
+    directory, name = os.path.split(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def file_lock(filename):
+    # Serializes read-modify-write of a file shared between processes, where flock is available
+    if not filename or fcntl is None:
+        yield
+        return
+    fd = os.open(filename + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+class CredentialCache:
+
+    def __init__(self, filename=None, refresh_margin=120):
+        self.filename = filename
+        self.refresh_margin = refresh_margin
+        self.entries = {}
+        self.lock = threading.Lock()
+        if filename:
+            self.load()
+
+    def key(self, client_id, client_secret, env):
+        return hashlib.sha256('\0'.join([client_id, client_secret, env]).encode('utf-8')).hexdigest()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                self.entries = json.loads(f.read())
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable credential cache: ' + str(e))
+            self.entries = {}
+
+    def save(self):
+        if self.filename:
+            try:
+                write_private_file(self.filename, json.dumps(self.entries).encode('utf-8'))
+            except OSError as e:
+                logging.warning('Could not save credential cache: ' + str(e))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires_at'] - self.refresh_margin <= time.time():
+                logging.debug('Cached token is expiring, refreshing')
+                return None
+            return entry
+
+    def put(self, key, token, expires_in, whoami):
+        with self.lock, file_lock(self.filename):
+            # Keep tokens other processes cached since we last read the file
+            if self.filename:
+                self.load()
+            self.entries = {k: v for k, v in self.entries.items() if v['expires_at'] > time.time()}
+            self.entries[key] = {'token': token, 'expires_at': time.time() + expires_in, 'whoami': whoami}
+            self.save()
+            return self.entries[key]
+
+    def invalidate(self, key):
+        with self.lock, file_lock(self.filename):
+            if self.filename:
+                self.load()
+            if self.entries.pop(key, None) is not None:
+                self.save()
+
+
+LITERAL_PATTERN = re.compile(r'\'[^\']*\'?|"[^"]*"?')
+
+
+def normalize_query(query_text):
+    # Whitespace is only collapsed outside quoted literals, 'a  b' and 'a b' are different queries. Comments are
+    # dropped, masking blanks them outside literals.
+    masked = mask_literals(query_text)
+    parts = []
+    position = 0
+    for match in LITERAL_PATTERN.finditer(masked):
+        parts.append(re.sub(r'\s+', ' ', masked[position:match.start()]))
+        parts.append(query_text[match.start():match.end()])
+        position = match.end()
+    parts.append(re.sub(r'\s+', ' ', masked[position:]))
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def query_key(tenant_id, query_text, *parts):
+    text = '\0'.join([tenant_id, normalize_query(query_text)] + list(parts))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, ttl=300, max_entries=64, max_bytes=256 * 1024 * 1024, directory=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, tenant_id, query_text, url, environment=''):
+        return query_key(tenant_id, query_text, environment, url)
+
+    def entry_file(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load_entry(self, key):
+        try:
+            with open(self.entry_file(key), 'rb') as f:
+                data = f.read()
+            entry = json.loads(data)
+            return entry['stored_at'], entry['results'], len(data)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning('Ignoring unreadable cached result: ' + str(e))
+            return None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.directory:
+                entry = self.load_entry(key)
+                if entry is not None:
+                    self.insert(key, entry)
+            if entry is None:
+                return None
+            stored_at, results, _ = entry
+            if time.time() - stored_at > self.ttl:
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return results
+
+    def put(self, key, results):
+        data = json.dumps({'stored_at': time.time(), 'results': results}).encode('utf-8')
+        if len(data) > self.max_bytes:
+            logging.debug('Result too large to cache')
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.insert(key, (time.time(), results, len(data)))
+            if self.directory:
+                write_private_file(self.entry_file(key), data)
+
+    def insert(self, key, entry):
+        self.entries[key] = entry
+        self.total_bytes += entry[2]
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+        if self.directory:
+            try:
+                os.remove(self.entry_file(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self.remove(key)
@@ -0,0 +1,106 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+# Only the standard library is imported here, so submitting a job skips the startup cost the daemon already paid
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET = os.path.join('~', '.xdr_query', 'daemon.sock')
+
+
+class DaemonError(Exception):
+    pass
+
+
+def send_job(socket_path, job):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(os.path.expanduser(socket_path))
+    except OSError as e:
+        client.close()
+        raise DaemonError('Could not connect to the query daemon at ' + socket_path + ': ' + str(e))
+    with client, client.makefile('rb') as replies:
+        client.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        for line in replies:
+            yield json.loads(line)
+
+
+def run_job(socket_path, job, out):
+    for message in send_job(socket_path, job):
+        if 'output' in message:
+            out.write(message['output'])
+        elif 'stage' in message:
+            logging.info('Query %s', message['stage'])
+        elif 'error' in message:
+            raise DaemonError(message['error'])
+        elif 'done' in message:
+            return message
+    raise DaemonError('The query daemon closed the connection before the query finished')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Submit a query to a running xdr_query_daemon')
+    parser.add_argument('-f', '--query_file', type=str, help='The file containing the query')
+    parser.add_argument('-t', '--tenant_id', type=str.lower, help='The tenant id')
+    parser.add_argument('-o', '--output_file', type=str,
+                        help='The daemon writes the results straight to this file instead of sending them back')
+    parser.add_argument('-F', '--format', type=str.lower, choices=['table', 'json', 'csv', 'ndjson', 'parquet'],
+                        help='Output format, defaults to the output file extension or table')
+    parser.add_argument('--compress', type=str.lower, choices=['gzip', 'zstd'], help='Compress the output file')
+    parser.add_argument('--refresh_cache', action='store_true', help='Run the query and replace any cached result')
+    parser.add_argument('--no_cache', action='store_true', help='Neither read nor write the result cache')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                        help='The daemon socket, default ' + DEFAULT_SOCKET)
+    parser.add_argument('--status', action='store_true', help='Show the daemon status instead of running a query')
+    parser.add_argument('-l', '--log_level', type=str.lower, help='Log level: debug ,info, warning, error',
+                        default='warning')
+    args = parser.parse_args()
+    if not args.status and not args.query_file:
+        parser.error('a query file is required unless --status is given')
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                        level=getattr(logging, args.log_level.upper(), logging.WARNING))
+
+    try:
+        if args.status:
+            for message in send_job(args.socket, {'op': 'status'}):
+                print(json.dumps(message, indent=4))
+            return 0
+
+        with open(args.query_file, 'r') as f:
+            query = f.read()
+        job = {'op': 'query', 'query': query, 'tenant_id': args.tenant_id, 'format': args.format,
+               'compress': args.compress, 'refresh_cache': args.refresh_cache, 'no_cache': args.no_cache,
+               # The daemon may run from another directory
+               'output_file': os.path.abspath(args.output_file) if args.output_file else None}
+        done = run_job(args.socket, job, sys.stdout)
+        logging.info('%d rows in %.2fs', done['rows'], done['elapsed'])
+        return 0
+    except (DaemonError, OSError, ValueError) as e:
+        logging.error(str(e))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
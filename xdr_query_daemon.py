@@ -0,0 +1,266 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+from xdr_query_api import ApiError, QueryControl, XDRQueryAPI, create_logger, write_output
+from xdr_query_cache import CredentialCache, ResultCache
+from xdr_query_client import DEFAULT_SOCKET
+from xdr_query_journal import DEFAULT_JOURNAL, ExecutionJournal
+from xdr_query_scheduler import RequestScheduler
+from xdr_query_tenants import DEFAULT_TENANT_CACHE, TenantDirectory, TenantError
+from xdr_query_transport import HTTPTransport
+from xdr_query_writers import WriterError, format_for_file
+
+
+class ClientGone(Exception):
+    pass
+
+
+class FrameWriter:
+
+    def __init__(self, send, chunk_size=64 * 1024):
+        self.send = send
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.size = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.send({'output': ''.join(self.chunks)})
+            self.chunks = []
+            self.size = 0
+
+
+class QueryDaemonHandler(socketserver.StreamRequestHandler):
+
+    def send(self, message):
+        try:
+            self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+        except OSError as e:
+            raise ClientGone(str(e))
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+            if job.get('op', 'query') == 'status':
+                self.send(self.server.status())
+            else:
+                self.server.run_job(job, self.send)
+        except ClientGone:
+            logging.warning('Client disconnected before its query finished')
+        except ValueError as e:
+            try:
+                self.send({'error': 'Invalid job: ' + str(e)})
+            except ClientGone:
+                pass
+
+
+class QueryDaemon(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, query_api, credentials):
+        self.socket_path = os.path.expanduser(socket_path)
+        self.query_api = query_api
+        self.credentials = credentials
+        self.started = time.time()
+        self.jobs = 0
+        self.failed = 0
+        self.running = 0
+        self.lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(self.socket_path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            if self.socket_in_use():
+                raise OSError('A query daemon is already listening on ' + self.socket_path)
+            os.remove(self.socket_path)
+        # Only the owner may connect, anyone who can submit a job uses these credentials
+        umask = os.umask(0o177)
+        try:
+            super().__init__(self.socket_path, QueryDaemonHandler)
+        finally:
+            os.umask(umask)
+
+    def socket_in_use(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def status(self):
+        with self.lock:
+            return {'uptime': round(time.time() - self.started, 3), 'jobs': self.jobs, 'failed': self.failed,
+                    'running': self.running}
+
+    def job_failed(self, send, error):
+        with self.lock:
+            self.failed += 1
+        send({'error': error})
+
+    def run_job(self, job, send):
+        start = time.monotonic()
+
+        def on_stage(name):
+            try:
+                send({'stage': name})
+            except ClientGone:
+                # Cancelling rather than raising lets coalesced followers run the query themselves
+                control.cancel()
+
+        control = QueryControl(on_stage=on_stage)
+        with self.lock:
+            self.jobs += 1
+            self.running += 1
+        try:
+            if not job.get('query'):
+                raise ApiError('Job has no query')
+            output_file = job.get('output_file')
+            output_format = job.get('format') or format_for_file(output_file)
+            if output_format == 'parquet' and not output_file:
+                raise WriterError('Parquet output requires an output file')
+            token, whoami = self.query_api.get_credentials(*self.credentials)
+            tenant_id, url = self.query_api.resolve_tenant(job.get('tenant_id'), token, whoami)
+            stream = self.query_api.query_results_stream(job['query'], tenant_id, url, token,
+                                                         use_cache=not job.get('no_cache'),
+                                                         refresh_cache=job.get('refresh_cache', False),
+                                                         control=control)
+            if output_file:
+                write_output(self.query_api, stream, output_file, output_format, False, job.get('compress'))
+            else:
+                writer = FrameWriter(send)
+                write_output(self.query_api, stream, None, output_format, False, f=writer)
+                writer.flush()
+            elapsed = time.monotonic() - start
+            logging.info('Job finished in %.2fs with %d rows', elapsed, stream.rows)
+            send({'done': True, 'rows': stream.rows, 'elapsed': round(elapsed, 3)})
+        except ClientGone:
+            with self.lock:
+                self.failed += 1
+            raise
+        except (ApiError, TenantError, WriterError, OSError) as e:
+            logging.error('Job failed: ' + str(e))
+            self.job_failed(send, str(e))
+        except Exception as e:
+            # Anything else still has to reach the client, not just close its connection
+            logging.exception('Job failed')
+            self.job_failed(send, type(e).__name__ + ': ' + str(e))
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Keep an authenticated query api warm and run jobs sent by '
+                                                 'xdr_query_client over a Unix socket')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                        help='The socket to listen on, default ' + DEFAULT_SOCKET)
+    parser.add_argument('-l', '--log_level', type=str.lower, help='Log level: debug ,info, warning, error',
+                        required=False, default='info')
+    parser.add_argument('-c', '--config', type=str, help='The config file')
+    parser.add_argument('-e', '--environment', type=str.lower, help='The environment', default='')
+    parser.add_argument('-id', '--client_id', type=str.lower, help='The client id', required=True)
+    parser.add_argument('-s', '--client_secret', type=str.lower, help='The client secret', required=True)
+    parser.add_argument('--credential_cache', type=str, help='A file to cache the token and whoami response in')
+    parser.add_argument('--result_cache_ttl', type=float,
+                        help='Reuse results of an identical query run within this many seconds')
+    parser.add_argument('--result_cache_dir', type=str, help='A directory to persist cached results in')
+    parser.add_argument('--spill_rows', type=int, default=100000,
+                        help='Buffer table and json results on disk past this many rows, 0 to keep them in memory')
+    parser.add_argument('--spill_dir', type=str, help='Directory for spilled results, defaults to the system temp dir')
+    parser.add_argument('--pool_size', type=int, help='Maximum pooled connections per api host', default=10)
+    parser.add_argument('--poll_deadline', type=float, help='Seconds to wait for a query to finish', default=300)
+    parser.add_argument('--rate_limit', type=float, default=10,
+                        help='Requests per second per endpoint and tenant to start from, 0 to only react to 429s')
+    parser.add_argument('--tenant_cache', type=str, default=DEFAULT_TENANT_CACHE,
+                        help='File caching the tenants partner and organization credentials can reach, default ' +
+                             DEFAULT_TENANT_CACHE)
+    parser.add_argument('--tenant_cache_ttl', type=float, default=24 * 3600,
+                        help='Seconds before the cached tenant list is fetched again')
+    parser.add_argument('--refresh_tenants', action='store_true', help='Fetch the tenant list even if it is cached')
+    parser.add_argument('--journal', type=str, nargs='?', const=DEFAULT_JOURNAL,
+                        help='Record submitted executions so they can be resumed, in this file or ' + DEFAULT_JOURNAL)
+    return parser.parse_args()
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def main():
+    args = parse_args()
+
+    create_logger(args.log_level)
+
+    query_api = XDRQueryAPI(HTTPTransport(pool_size=args.pool_size), CredentialCache(args.credential_cache),
+                            tenant_directory=TenantDirectory(args.tenant_cache, args.tenant_cache_ttl))
+    query_api.poll_policy.deadline = args.poll_deadline
+    query_api.scheduler = RequestScheduler(args.rate_limit)
+    query_api.spill_rows = args.spill_rows or None
+    query_api.spill_dir = args.spill_dir
+    if args.result_cache_ttl or args.result_cache_dir:
+        query_api.result_cache = ResultCache(ttl=args.result_cache_ttl or 300, directory=args.result_cache_dir)
+    if args.journal:
+        query_api.journal = ExecutionJournal(args.journal)
+
+    try:
+        if args.config:
+            logging.info('Loading config file...')
+            query_api.load_config(args.config)
+
+        credentials = (args.client_id, args.client_secret, args.environment)
+        # Fail at startup rather than on the first job if the credentials are wrong
+        token, whoami = query_api.get_credentials(*credentials)
+        if whoami['idType'] != 'tenant':
+            query_api.tenant_index(token, whoami, args.refresh_tenants)
+
+        signal.signal(signal.SIGTERM, stop)
+        with QueryDaemon(args.socket, query_api, credentials) as daemon:
+            logging.info('Query daemon listening on ' + daemon.socket_path)
+            try:
+                daemon.serve_forever()
+            except KeyboardInterrupt:
+                logging.info('Query daemon stopping')
+    except (ApiError, TenantError, OSError, json.JSONDecodeError) as e:
+        logging.error(str(e))
+    finally:
+        query_api.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import argparse
+import hashlib
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from xdr_query_api import ApiError, XDRQueryAPI, create_logger, write_metrics
+from xdr_query_cache import CredentialCache, normalize_query, write_private_file
+from xdr_query_metrics import MetricsRecorder
+from xdr_query_scheduler import RequestScheduler
+from xdr_query_shards import (TIME_FORMATS, ShardError, add_predicate, format_time, parse_time, time_literal,
+                              value_time)
+from xdr_query_tenants import DEFAULT_TENANT_CACHE, TenantDirectory, TenantError
+from xdr_query_transport import HTTPTransport
+from xdr_query_writers import (STREAMING_FORMATS, WriterError, compression_for_file, format_for_file, open_output,
+                               write_result_rows)
+
+WATERMARK_PLACEHOLDER = '{{watermark}}'
+
+
+def row_key(item):
+    return hashlib.sha256(json.dumps(item, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Watermark:
+
+    def __init__(self, filename, start, overlap=0.0):
+        self.filename = filename
+        self.value = start
+        self.overlap = overlap
+        self.seen = {}
+        self.query_hash = None
+        if filename:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                state = json.loads(f.read())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            raise ApiError('Unreadable watermark file ' + self.filename + ': ' + str(e))
+        self.value = parse_time(state['watermark'])
+        self.seen = state.get('seen', {})
+        self.query_hash = state.get('query_hash')
+        logging.info('Resuming from watermark ' + state['watermark'])
+
+    def save(self):
+        if self.filename:
+            state = {'watermark': self.value.isoformat(), 'seen': self.seen, 'query_hash': self.query_hash}
+            write_private_file(self.filename, json.dumps(state).encode('utf-8'))
+
+    def query_from(self):
+        # Whole seconds, like the literal the window is queried with, so every row it can return is in seen
+        return (self.value - timedelta(seconds=self.overlap)).replace(microsecond=0)
+
+    def advance(self, new_rows):
+        for key, moment in new_rows:
+            self.seen[key] = moment.timestamp()
+            if moment > self.value:
+                self.value = moment
+        # Only rows that the next window can return again need remembering
+        horizon = self.query_from().timestamp()
+        self.seen = {key: seconds for key, seconds in self.seen.items() if seconds >= horizon}
+
+
+class FollowQuery:
+
+    def __init__(self, query_api, query_text, column, watermark, time_format='timestamp'):
+        self.query_api = query_api
+        self.query_text = query_text
+        self.column = column
+        self.watermark = watermark
+        self.time_format = time_format
+        self.header_written = False
+        self.missing_time = 0
+        query_hash = hashlib.sha256(normalize_query(query_text).encode('utf-8')).hexdigest()
+        if watermark.query_hash is not None and watermark.query_hash != query_hash:
+            logging.warning('Query changed since the watermark was saved, continuing from it anyway')
+        watermark.query_hash = query_hash
+
+    def cycle_query(self):
+        start = self.watermark.query_from()
+        if WATERMARK_PLACEHOLDER in self.query_text:
+            return self.query_text.replace(WATERMARK_PLACEHOLDER, format_time(start, self.time_format))
+        return add_predicate(self.query_text, '%s >= %s' % (self.column, time_literal(start, self.time_format)))
+
+    def new_rows(self, stream, new_rows):
+        if stream.columns and self.column not in stream.columns:
+            raise ApiError('Query results do not include the watermark column ' + self.column)
+        for item in stream:
+            moment = value_time(item.get(self.column), self.time_format)
+            if moment is None:
+                self.missing_time += 1
+                continue
+            key = row_key(item)
+            if key in self.watermark.seen:
+                continue
+            new_rows.append((key, moment))
+            yield item
+
+    def run_cycle(self, tenant_id, url, authorization, output_file, output_format):
+        query = self.cycle_query()
+        stream = self.query_api.query_results_stream(query, tenant_id, url, authorization, use_cache=False)
+        new_rows = []
+        self.missing_time = 0
+        # Rows wait in a temporary file until every page arrived, so a failed cycle appends nothing that the next
+        # cycle would append again
+        with tempfile.TemporaryFile('w+', newline='', encoding='utf-8') as buffer:
+            # The csv header is written once, with stdout there is no file to check for it
+            rows = write_result_rows(output_format, output_file, stream.metadata, self.new_rows(stream, new_rows),
+                                     append=True, f=buffer, header=False if self.header_written else None)
+            buffer.seek(0)
+            if output_file:
+                with open_output(output_file, compression_for_file(output_file), append=True) as f:
+                    shutil.copyfileobj(buffer, f)
+            else:
+                shutil.copyfileobj(buffer, sys.stdout)
+                sys.stdout.flush()
+        self.header_written = True
+        if self.missing_time:
+            logging.warning('Skipped %d rows without a %s value', self.missing_time, self.column)
+        self.watermark.advance(new_rows)
+        self.watermark.save()
+        logging.info('Wrote %d new rows, watermark is now %s', rows,
+                     format_time(self.watermark.value, self.time_format))
+        return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Re-run a query on a schedule and append only the new rows')
+    parser.add_argument('-f', '--query_file', type=str, help='The file containing the query', required=True)
+    parser.add_argument('-k', '--column', type=str, help='The timestamp column to follow', required=True)
+    parser.add_argument('--time_format', type=str.lower, choices=TIME_FORMATS, default='timestamp',
+                        help='How the timestamp column is written in the query')
+    parser.add_argument('--state_file', type=str,
+                        help='Where the watermark is kept between cycles and runs, default <query_file>.watermark')
+    parser.add_argument('--since', type=str, help='Where to start when there is no saved watermark, ISO 8601')
+    parser.add_argument('--lookback', type=float, help='Seconds before now to start without a watermark or --since',
+                        default=3600)
+    parser.add_argument('--overlap', type=float, default=0,
+                        help='Seconds before the watermark to query again for late arriving rows')
+    parser.add_argument('-i', '--interval', type=float, help='Seconds between the start of each cycle', default=300)
+    parser.add_argument('--cycles', type=int, help='Stop after this many cycles, 0 runs until interrupted',
+                        default=0)
+    parser.add_argument('-o', '--output_file', type=str, help='The file to append new rows to, stdout by default')
+    parser.add_argument('-F', '--format', type=str.lower, choices=['csv', 'ndjson'],
+                        help='Output format, defaults to the output file extension or ndjson')
+    parser.add_argument('-t', '--tenant_id', type=str.lower,
+                        help='The tenant id, or for partner and organization credentials a tenant name', required=False)
+    parser.add_argument('-l', '--log_level', type=str.lower, help='Log level: debug ,info, warning, error',
+                        required=False, default='info')
+    parser.add_argument('-c', '--config', type=str, help='The config file')
+    parser.add_argument('-e', '--environment', type=str.lower, help='The environment', default='')
+    parser.add_argument('-id', '--client_id', type=str.lower, help='The client id', required=True)
+    parser.add_argument('-s', '--client_secret', type=str.lower, help='The client secret', required=True)
+    parser.add_argument('--credential_cache', type=str, help='A file to cache the token and whoami response in')
+    parser.add_argument('--tenant_cache', type=str, default=DEFAULT_TENANT_CACHE,
+                        help='File caching the tenants partner and organization credentials can reach, default ' +
+                             DEFAULT_TENANT_CACHE)
+    parser.add_argument('--tenant_cache_ttl', type=float, default=24 * 3600,
+                        help='Seconds before the cached tenant list is fetched again')
+    parser.add_argument('--poll_deadline', type=float, help='Seconds to wait for a query to finish', default=300)
+    parser.add_argument('--rate_limit', type=float, default=10,
+                        help='Requests per second per endpoint and tenant to start from, 0 to only react to 429s')
+    parser.add_argument('--prometheus_file', type=str,
+                        help='Rewrite the metrics in the Prometheus textfile format after every cycle')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    create_logger(args.log_level)
+
+    query_api = XDRQueryAPI(HTTPTransport(), CredentialCache(args.credential_cache),
+                            tenant_directory=TenantDirectory(args.tenant_cache, args.tenant_cache_ttl))
+    query_api.poll_policy.deadline = args.poll_deadline
+    query_api.scheduler = RequestScheduler(args.rate_limit)
+    if args.prometheus_file:
+        query_api.metrics = MetricsRecorder()
+
+    output_format = args.format or format_for_file(args.output_file, 'ndjson')
+    if output_format not in STREAMING_FORMATS or output_format == 'parquet':
+        logging.error('Follow mode appends csv or ndjson output')
+        return
+
+    try:
+        if args.config:
+            logging.info('Loading config file...')
+            query_api.load_config(args.config)
+
+        if args.since:
+            start = parse_time(args.since)
+        else:
+            start = datetime.now(timezone.utc) - timedelta(seconds=args.lookback)
+        watermark = Watermark(args.state_file or args.query_file + '.watermark', start.replace(microsecond=0),
+                              args.overlap)
+        follow = FollowQuery(query_api, query_api.read_query_file(args.query_file), args.column, watermark,
+                             args.time_format)
+
+        cycle = 0
+        while True:
+            cycle += 1
+            started = time.monotonic()
+            try:
+                token, whoami = query_api.get_credentials(args.client_id, args.client_secret, args.environment)
+                tenant_id, url = query_api.resolve_tenant(args.tenant_id, token, whoami)
+                follow.run_cycle(tenant_id, url, token, args.output_file, output_format)
+            except (ApiError, TenantError) as e:
+                logging.error('Cycle %d failed, the watermark was not moved: %s', cycle, e)
+            write_metrics(query_api.metrics, None, args.prometheus_file)
+
+            if args.cycles and cycle >= args.cycles:
+                break
+            time.sleep(max(args.interval - (time.monotonic() - started), 0))
+
+    except KeyboardInterrupt:
+        logging.info('Stopped')
+    except (ApiError, ShardError, TenantError, WriterError, OSError) as e:
+        logging.error(str(e))
+    finally:
+        query_api.close()
+
+
+if __name__ == '__main__':
+    main()
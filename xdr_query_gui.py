@@ -14,6 +14,9 @@
 #
 
 import logging
+import queue
+import threading
+import time
 import tkinter
 from tkinter.filedialog import askopenfilename, asksaveasfilename
 
@@ -23,11 +26,19 @@ from tkinter import ttk
 
 import textwrap
 
-from xdr_query_api import ApiError, XDRQueryAPI
+from xdr_query_api import ApiError, QueryControl, XDRQueryAPI
+from xdr_query_cache import ResultCache
+from xdr_query_local import DEFAULT_TABLE, LocalQueryError, LocalResultStore
+from xdr_query_results import CompactResults, ResultTable
+from xdr_query_tenants import DEFAULT_TENANT_CACHE, TenantDirectory, TenantError, tenant_label
+from xdr_query_writers import STREAMING_FORMATS, WriterError, format_for_file, write_result_rows
 
 TITLE = "XDR Query Interface"
 TEXT_FRAME_WIDTH = 115
 TEXT_FRAME_HEIGHT = 18
+WORK_POLL_MS = 100
+RESULT_GRID_ROWS = 15
+RESULT_COLUMN_WIDTH = 140
 ENCODED_ICON = """R0lGODlhEAAQAPeQAAVguAVguQRiuwRjuwVjuwNmvQRlvARlvQVlvQRmvQRnvghnvQRovwhovRJovBRrvQNrwQRqwANswQNtwwRsw
                   gRuwwNvxANwxQNxxQNxxgJyxwNzxwRwxQV0xwJ2yQN3ygJ4ywN4ywF7zQJ6zAJ6zQF9zwJ8zgJ9zwJ+zw57yBlzwxh2xRh4xhp5xh
                   x5xh54xhx6xxZ9yRh7yBh+yhx+yhx/ygF/0CJzwCR2wA6AzRWBzBaAzBeBzBaBzRyBzByDzRuEzRyEzgGB0QKB0gGD0wKD0wGE1AG
@@ -86,12 +97,110 @@ ENCODED_ICON = """R0lGODlhEAAQAPeQAAVguAVguQRiuwRjuwVjuwNmvQRlvARlvQVlvQRmvQRnvg
 logging.basicConfig(format='%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.DEBUG)
 
 
+class ResultGrid(ttk.Frame):
+
+    def __init__(self, master, visible_rows, **kwargs):
+        super().__init__(master, **kwargs)
+        self.table = None
+        self.offset = 0
+        self.visible_rows = visible_rows
+
+        filter_label = Label(self, text="Filter ")
+        filter_label.grid(column=0, row=0, sticky=tkinter.W)
+        self.filter_text = tkinter.StringVar()
+        self.filter_entry = Entry(self, textvariable=self.filter_text, width=50)
+        self.filter_entry.grid(column=1, row=0, sticky=tkinter.W)
+        self.filter_entry.bind('<Return>', lambda event: self.apply_filter())
+        self.count_text = tkinter.StringVar()
+        count_label = Label(self, textvariable=self.count_text)
+        count_label.grid(column=2, row=0, sticky=tkinter.E)
+
+        self.tree = ttk.Treeview(self, show='headings', height=visible_rows, selectmode='browse')
+        self.tree.grid(column=0, row=1, columnspan=3, sticky=(tkinter.N, tkinter.S, tkinter.E, tkinter.W))
+
+        self.scrollbar_v = tkinter.Scrollbar(self, orient=tkinter.VERTICAL, command=self.yview)
+        self.scrollbar_v.grid(column=3, row=1, sticky=tkinter.N + tkinter.S)
+        self.scrollbar_h = tkinter.Scrollbar(self, orient=tkinter.HORIZONTAL, command=self.tree.xview)
+        self.scrollbar_h.grid(column=0, row=2, columnspan=3, sticky=tkinter.E + tkinter.W)
+        self.tree.configure(xscrollcommand=self.scrollbar_h.set)
+
+        self.columnconfigure(2, weight=1)
+        self.rowconfigure(1, weight=1)
+
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.tree.bind(sequence, self.on_mouse_wheel)
+        self.tree.bind('<Next>', lambda event: self.yview('scroll', 1, 'pages'))
+        self.tree.bind('<Prior>', lambda event: self.yview('scroll', -1, 'pages'))
+
+    def set_table(self, table):
+        self.table = table
+        self.offset = 0
+        self.filter_text.set('')
+        self.tree.configure(columns=table.columns)
+        for column in table.columns:
+            self.tree.heading(column, text=column, command=lambda name=column: self.sort_by(name))
+            self.tree.column(column, width=RESULT_COLUMN_WIDTH, minwidth=40, stretch=False)
+        self.refresh()
+
+    def refresh(self):
+        self.tree.delete(*self.tree.get_children())
+        if self.table is None:
+            return
+        total = len(self.table)
+        self.offset = max(0, min(self.offset, total - self.visible_rows))
+        for row in self.table.window(self.offset, self.visible_rows):
+            self.tree.insert('', tkinter.END, values=['' if value is None else value for value in row])
+        if total:
+            self.scrollbar_v.set(self.offset / total, min(self.offset + self.visible_rows, total) / total)
+        else:
+            self.scrollbar_v.set(0, 1)
+        self.count_text.set(f'{total} of {len(self.table.rows)} rows')
+
+    def yview(self, *args):
+        if self.table is None:
+            return
+        if args[0] == 'moveto':
+            self.offset = int(float(args[1]) * len(self.table))
+        elif args[0] == 'scroll':
+            self.offset += int(args[1]) * (self.visible_rows if args[2] == 'pages' else 1)
+        self.refresh()
+
+    def on_mouse_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.yview('scroll', -3, 'units')
+        else:
+            self.yview('scroll', 3, 'units')
+        return 'break'
+
+    def sort_by(self, column):
+        if self.table is None:
+            return
+        self.table.sort(column)
+        for name in self.table.columns:
+            marker = ''
+            if name == column:
+                marker = ' \u25bc' if self.table.sort_descending else ' \u25b2'
+            self.tree.heading(name, text=name + marker)
+        self.offset = 0
+        self.refresh()
+
+    def apply_filter(self):
+        if self.table is None:
+            return
+        self.table.filter(self.filter_text.get())
+        self.offset = 0
+        self.refresh()
+
+
 class MainWindow(tkinter.Tk):
 
     def __init__(self):
         super().__init__()
 
-        self.query_api = XDRQueryAPI()
+        self.query_api = XDRQueryAPI(tenant_directory=TenantDirectory(DEFAULT_TENANT_CACHE))
+        self.tenant_index = None
+        self.local_store = LocalResultStore()
+        self.unsaved_results = None
 
         self.query_text = ""
         self.title(TITLE)
@@ -129,6 +238,13 @@ class MainWindow(tkinter.Tk):
 
         self.token = None
         self.whoami = None
+        self.credentials = None
+
+        self.work_queue = queue.Queue()
+        self.worker = None
+        self.control = None
+        self.work_started = 0.0
+        self.work_stage = ''
 
     def build_menu(self):
         menubar = tkinter.Menu(self)
@@ -147,11 +263,12 @@ class MainWindow(tkinter.Tk):
 
     def build_tenant_frame(self, frame):
         label_text = tkinter.StringVar()
-        label_text.set("Tenant Id ")
+        label_text.set("Tenant ")
         tenant_label = Label(frame, textvariable=label_text, height=2)
         tenant_label.grid(row=0, column=0)
 
-        self.tenant_entry = Entry(frame, width=50, state='disabled')
+        self.tenant_entry = ttk.Combobox(frame, width=60, state='disabled')
+        self.tenant_entry.bind('<KeyRelease>', self.filter_tenants)
         self.tenant_entry.grid(row=0, column=1)
 
         self.region_label_text = tkinter.StringVar()
@@ -228,11 +345,36 @@ class MainWindow(tkinter.Tk):
         self.output_scrollbar_v.config(command=self.output_text_box.yview)
         self.output_scrollbar_h.config(command=self.output_text_box.xview)
 
+        grid_width = self.output_text_box.winfo_reqwidth() + self.output_scrollbar_v.winfo_reqwidth()
+        grid_height = self.output_text_box.winfo_reqheight() + self.output_scrollbar_h.winfo_reqheight()
+        self.result_grid = ResultGrid(self.output_frame, RESULT_GRID_ROWS, width=grid_width, height=grid_height)
+        self.result_grid.grid_propagate(False)
+        self.result_grid.grid(column=0, row=1, columnspan=2, rowspan=2)
+        self.result_grid.grid_remove()
+        self.result_table = None
+
     def build_button_frame(self, frame):
         self.generate_token_button = tkinter.Button(frame, text="Generate Token", command=self.generate_token)
         self.generate_token_button.grid(column=0, row=1)
         self.query_button = tkinter.Button(frame, text="Run query", command=self.run_query, state='disabled')
         self.query_button.grid(column=1, row=1)
+        self.cache_results = tkinter.BooleanVar(value=False)
+        self.cache_check_button = tkinter.Checkbutton(frame, text="Cache results", variable=self.cache_results,
+                                                      command=self.toggle_result_cache)
+        self.cache_check_button.grid(column=2, row=1)
+        self.execution = tkinter.StringVar(value='remote')
+        self.remote_radio_button = tkinter.Radiobutton(frame, text="Remote", variable=self.execution, value='remote',
+                                                       command=self.update_query_button)
+        self.remote_radio_button.grid(column=3, row=1)
+        self.local_radio_button = tkinter.Radiobutton(frame, text="Local", variable=self.execution, value='local',
+                                                      command=self.update_query_button)
+        self.local_radio_button.grid(column=4, row=1)
+        self.cancel_button = tkinter.Button(frame, text="Cancel", command=self.cancel_work, state='disabled')
+        self.cancel_button.grid(column=5, row=1)
+        self.status_text = tkinter.StringVar()
+        self.status_text.set("Idle")
+        self.status_label = Label(frame, textvariable=self.status_text, width=32, anchor='w')
+        self.status_label.grid(column=6, row=1)
 
     def load_query(self):
         filename = askopenfilename(parent=self)
@@ -250,9 +392,23 @@ class MainWindow(tkinter.Tk):
 
     def save_output(self):
         filename = asksaveasfilename(parent=self)
-        if not filename == '':
+        if filename == '':
+            return
+        if self.result_table is None:
             with open(filename, 'w') as f:
                 f.write(self.output_text_box.get('1.0', tkinter.END))
+            return
+
+        output_format = format_for_file(filename, default='csv')
+        try:
+            if output_format in STREAMING_FORMATS:
+                write_result_rows(output_format, filename, self.result_table.metadata(), self.result_table.items())
+            else:
+                results = self.query_api.format_results(self.result_table.to_results(), output_format == 'table')
+                with open(filename, 'wb') as f:
+                    f.write(results.encode('utf-8'))
+        except (WriterError, OSError) as e:
+            logging.error('Error saving output: ' + str(e))
 
     def load_config(self):
         filename = askopenfilename(parent=self)
@@ -286,29 +442,165 @@ class MainWindow(tkinter.Tk):
         self.tenant_entry.delete(0, tkinter.END)
         self.tenant_entry.configure(state='disabled')
 
+    def toggle_result_cache(self):
+        if self.cache_results.get():
+            self.query_api.result_cache = ResultCache()
+        else:
+            self.query_api.result_cache = None
+
+    def show_result_table(self, table):
+        self.result_table = table
+        self.output_text_box.grid_remove()
+        self.output_scrollbar_v.grid_remove()
+        self.output_scrollbar_h.grid_remove()
+        self.result_grid.grid()
+        self.result_grid.set_table(table)
+
+    def set_output(self, result):
+        self.result_table = None
+        self.result_grid.grid_remove()
+        self.output_text_box.grid()
+        self.output_scrollbar_v.grid()
+        self.output_scrollbar_h.grid()
+        self.output_text_box.configure(state='normal')
+        self.output_text_box.delete(0.0, tkinter.END)
+        self.output_text_box.insert(0.0, result)
+        self.output_text_box.configure(state='disabled')
+
+    def start_work(self, work, on_done, stage, *args):
+        self.control = QueryControl(on_stage=lambda name: self.work_queue.put(('stage', name)))
+        self.work_started = time.monotonic()
+        self.work_stage = stage
+        self.generate_token_button.configure(state='disabled')
+        self.query_button.configure(state='disabled')
+        self.cancel_button.configure(state='normal')
+        self.worker = threading.Thread(target=self.run_work, args=(self.control, work, on_done) + args, daemon=True)
+        self.worker.start()
+        self.after(WORK_POLL_MS, self.poll_work)
+
+    def run_work(self, control, work, on_done, *args):
+        try:
+            self.work_queue.put(('done', on_done, work(control, *args)))
+        except (ApiError, LocalQueryError, TenantError) as e:
+            self.work_queue.put(('error', str(e)))
+        except Exception as e:
+            logging.exception('Background work failed')
+            self.work_queue.put(('error', 'Unexpected error: ' + str(e)))
+
+    def poll_work(self):
+        finished = False
+        while True:
+            try:
+                message = self.work_queue.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'stage':
+                self.work_stage = message[1]
+            elif message[0] == 'done':
+                message[1](message[2])
+                finished = True
+            else:
+                self.set_output(message[1])
+                finished = True
+
+        if finished:
+            self.finish_work()
+        else:
+            self.status_text.set('%s (%.1fs)' % (self.work_stage.capitalize(), time.monotonic() - self.work_started))
+            self.after(WORK_POLL_MS, self.poll_work)
+
+    def finish_work(self):
+        self.status_text.set('%s in %.1fs' % ('Cancelled' if self.control.cancel_event.is_set() else 'Finished',
+                                              time.monotonic() - self.work_started))
+        self.worker = None
+        self.control = None
+        self.generate_token_button.configure(state='normal')
+        self.update_query_button()
+        self.cancel_button.configure(state='disabled')
+
+    def update_query_button(self):
+        if self.worker is None:
+            local = self.execution.get() == 'local'
+            self.query_button.configure(state='normal' if self.token or local else 'disabled')
+
+    def cancel_work(self):
+        if self.control is not None:
+            self.control.cancel()
+            self.work_stage = 'cancelling'
+
+    def query_work(self, control, query, tenant, credentials):
+        token, whoami = self.query_api.get_credentials(*credentials)
+        tenant_id, url = self.query_api.resolve_tenant(tenant, token, whoami)
+        stream = self.query_api.query_results_stream(query, tenant_id, url, token, control=control)
+        results = CompactResults.from_stream(stream)
+        # Copied into sqlite only when a local query first needs it, most results are never queried locally
+        self.unsaved_results = results
+        control.stage('rendering')
+        return token, whoami, ResultTable.from_compact(results)
+
+    def save_locally(self, results):
+        # Best effort, the remote results are shown even when sqlite cannot hold them
+        try:
+            self.local_store.load_compact(DEFAULT_TABLE, results)
+        except LocalQueryError as e:
+            logging.warning('Results not saved for local queries: ' + str(e))
+            # Local queries must not run against the previous results instead
+            try:
+                self.local_store.drop(DEFAULT_TABLE)
+            except LocalQueryError as drop_error:
+                logging.warning(str(drop_error))
+
+    def local_work(self, control, query):
+        if self.unsaved_results is not None:
+            control.stage('saving locally')
+            self.save_locally(self.unsaved_results)
+            self.unsaved_results = None
+        results = CompactResults.from_stream(self.local_store.query(query))
+        control.stage('rendering')
+        return ResultTable.from_compact(results)
+
+    def query_done(self, result):
+        self.token, self.whoami, table = result
+        self.show_result_table(table)
+
     def run_query(self):
         query = self.query_text_box.get('1.0', tkinter.END)
         tenant_id = self.tenant_entry.get()
 
-        failed = False
-        if not self.token or not self.whoami:
-            result = 'Token not set, have you generated a token?'
-            failed = True
-
-        if not failed and not tenant_id:
-            result = 'Tenant ID not set, have you entered a tenant ID?'
-            failed = True
-
-        if not failed:
-            try:
-                result = self.query_api.run_query(query, tenant_id, self.whoami['apiHosts']['dataRegion'], self.token)
-            except ApiError as e:
-                result = str(e)
+        if self.execution.get() == 'local':
+            self.start_work(self.local_work, self.show_result_table, 'querying ' + DEFAULT_TABLE + ' locally', query)
+        elif not self.token or not self.whoami:
+            self.set_output('Token not set, have you generated a token?')
+        elif not tenant_id:
+            self.set_output('Tenant not set, have you entered or picked a tenant?')
+        else:
+            self.start_work(self.query_work, self.query_done, 'submitted', query, tenant_id, self.credentials)
+
+    def token_work(self, control, client_id, client_secret, env):
+        token, whoami = self.query_api.get_credentials(client_id, client_secret, env)
+        tenant_index = None
+        if whoami['idType'] != 'tenant':
+            control.stage('listing tenants')
+            tenant_index = self.query_api.tenant_index(token, whoami)
+        return token, whoami, (client_id, client_secret, env), tenant_index
+
+    def token_done(self, result):
+        self.token, self.whoami, self.credentials, self.tenant_index = result
+        if self.whoami['idType'] == 'tenant':
+            self.tenant_entry.configure(state='normal', values=[])
+            self.tenant_entry.delete(0, tkinter.END)
+            self.tenant_entry.insert(0, self.whoami['id'])
+            self.tenant_entry.configure(state='disabled')
+        else:
+            self.tenant_entry.configure(state='normal')
+            self.filter_tenants()
+        wrapper = textwrap.TextWrapper(width=100)
+        self.set_output(f'Token set to {wrapper.fill(text=self.token)}')
 
-        self.output_text_box.configure(state='normal')
-        self.output_text_box.delete(0.0, tkinter.END)
-        self.output_text_box.insert(0.0, result)
-        self.output_text_box.configure(state='disabled')
+    def filter_tenants(self, event=None):
+        if self.tenant_index is not None:
+            tenants = self.tenant_index.search(self.tenant_entry.get())
+            self.tenant_entry.configure(values=[tenant_label(tenant) for tenant in tenants])
 
     def generate_token(self):
         client_id = self.client_id_entry.get()
@@ -317,31 +609,15 @@ class MainWindow(tkinter.Tk):
             env = self.region_combo_box.get()
         else:
             env = ''
-        try:
-            self.token = self.query_api.generate_token(client_id, client_secret, env)
-            self.whoami = self.query_api.get_whoami(self.token, env)
-            if self.whoami['idType'] == 'tenant':
-                self.tenant_entry.configure(state='normal')
-                self.tenant_entry.delete(0, tkinter.END)
-                self.tenant_entry.insert(0, self.whoami['id'])
-                self.tenant_entry.configure(state='disabled')
-            else:
-                self.tenant_entry.configure(state='normal')
-            self.query_button.configure(state='normal')
-            wrapper = textwrap.TextWrapper(width=100)
-            result = f'Token set to {wrapper.fill(text=self.token)}'
-        except ApiError as e:
-            result = str(e)
-
-        self.output_text_box.configure(state='normal')
-        self.output_text_box.delete(0.0, tkinter.END)
-        self.output_text_box.insert(0.0, result)
-        self.output_text_box.configure(state='disabled')
+        self.start_work(self.token_work, self.token_done, 'authenticating', client_id, client_secret, env)
 
 
 def main():
     window = MainWindow()
-    window.mainloop()
+    try:
+        window.mainloop()
+    finally:
+        window.query_api.close()
 
 
 if __name__ == "__main__":
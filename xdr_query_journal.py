@@ -0,0 +1,104 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import json
+import logging
+import os
+import threading
+import time
+
+from xdr_query_cache import file_lock, query_key, write_private_file
+
+DEFAULT_JOURNAL = os.path.join('~', '.xdr_query', 'journal.json')
+RESUMABLE_STATES = ['submitted', 'finished']
+
+
+class ExecutionJournal:
+
+    def __init__(self, filename=None, max_age=24 * 3600):
+        self.filename = os.path.expanduser(filename) if filename else None
+        self.max_age = max_age
+        self.entries = {}
+        self.lock = threading.Lock()
+        if self.filename:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                entries = json.loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable execution journal: ' + str(e))
+            return {}
+        oldest = time.time() - self.max_age
+        return {execution_id: entry for execution_id, entry in entries.items() if entry['updated_at'] > oldest}
+
+    def change(self, execution_id, entry):
+        with self.lock:
+            try:
+                with file_lock(self.filename):
+                    # Pick up executions other processes recorded since we last read the journal
+                    if self.filename:
+                        self.entries = self.load()
+                    if entry is None:
+                        self.entries.pop(execution_id, None)
+                    else:
+                        self.entries[execution_id] = entry
+                    if self.filename:
+                        write_private_file(self.filename, json.dumps(self.entries, indent=4).encode('utf-8'))
+            except OSError as e:
+                # The journal only helps resuming, it must never fail the query itself
+                logging.warning('Could not update execution journal: ' + str(e))
+
+    def submitted(self, execution_id, tenant_id, query_text, url):
+        now = time.time()
+        self.change(execution_id, {'execution_id': execution_id, 'tenant_id': tenant_id, 'url': url,
+                                   'query_hash': query_key(tenant_id, query_text, url), 'state': 'submitted',
+                                   'succeeded': None, 'submitted_at': now, 'updated_at': now})
+
+    def finished(self, execution_id, succeeded):
+        with self.lock:
+            entry = self.entries.get(execution_id)
+        if entry is not None:
+            entry = dict(entry, state='finished', succeeded=succeeded, updated_at=time.time())
+            self.change(execution_id, entry)
+
+    def remove(self, execution_id):
+        self.change(execution_id, None)
+
+    def fetched(self, execution_id):
+        self.remove(execution_id)
+
+    def find(self, tenant_id, query_text, url):
+        query_hash = query_key(tenant_id, query_text, url)
+        with self.lock:
+            if self.filename:
+                self.entries = self.load()
+            matches = [entry for entry in self.entries.values()
+                       if entry['query_hash'] == query_hash and entry['state'] in RESUMABLE_STATES]
+        if not matches:
+            return None
+        return max(matches, key=lambda entry: entry['submitted_at'])
+
+    def unfinished(self):
+        with self.lock:
+            if self.filename:
+                self.entries = self.load()
+            return sorted((entry for entry in self.entries.values() if entry['state'] in RESUMABLE_STATES),
+                          key=lambda entry: entry['submitted_at'])
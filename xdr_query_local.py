@@ -0,0 +1,256 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from operator import itemgetter
+
+from xdr_query_results import ResultStream
+from xdr_query_shards import column_reference, select_expressions
+
+DEFAULT_TABLE = 'results'
+EXECUTIONS = ['remote', 'local']
+COLUMNS_TABLE = 'xdr_query_columns'
+INTEGER_TYPES = ['bigint', 'integer', 'int', 'smallint', 'tinyint', 'boolean']
+REAL_TYPES = ['double', 'real', 'float', 'decimal']
+
+
+class LocalQueryError(Exception):
+    pass
+
+
+def column_affinity(column_type):
+    base = (column_type or '').lower().split('(')[0].strip()
+    if base in INTEGER_TYPES:
+        return 'INTEGER'
+    if base in REAL_TYPES:
+        return 'REAL'
+    return 'TEXT'
+
+
+def value_type(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'bigint'
+    if isinstance(value, float):
+        return 'double'
+    return 'varchar'
+
+
+def quote_name(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_value(value):
+    # Arrays, maps and rows have no sqlite type, keep them as json text
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+def output_references(query_text, names):
+    # Which stored column each output column reads directly, None where it is computed
+    expressions = select_expressions(query_text)
+    if not expressions:
+        return [None] * len(names)
+    stars = [i for i, expression in enumerate(expressions) if expression.strip().endswith('*')]
+    if len(stars) == len(expressions):
+        return [name.lower() for name in names]
+    if len(stars) > 1 or len(expressions) - len(stars) > len(names):
+        return [None] * len(names)
+    references = []
+    for i, expression in enumerate(expressions):
+        if i in stars:
+            width = len(names) - len(expressions) + 1
+            references.extend(name.lower() for name in names[len(references):len(references) + width])
+        else:
+            reference = column_reference(expression)
+            references.append(reference.lower() if reference is not None else None)
+    if len(references) != len(names):
+        return [None] * len(names)
+    return references
+
+
+class LocalResultStore:
+
+    def __init__(self, filename=None, page_size=10000):
+        self.filename = os.path.expanduser(filename) if filename else ':memory:'
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        try:
+            # The gui loads and queries from its worker thread, the lock keeps that to one at a time
+            self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS ' + COLUMNS_TABLE +
+                                    ' (table_name TEXT, position INTEGER, name TEXT, type TEXT)')
+        except sqlite3.Error as e:
+            raise LocalQueryError('Could not open local database ' + self.filename + ': ' + str(e))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def drop(self, table_name):
+        with self.lock:
+            try:
+                with self.connection:
+                    self.connection.execute('DROP TABLE IF EXISTS ' + quote_name(table_name))
+                    self.connection.execute('DELETE FROM ' + COLUMNS_TABLE + ' WHERE table_name = ?', (table_name,))
+            except sqlite3.Error as e:
+                raise LocalQueryError('Could not drop ' + table_name + ': ' + str(e))
+
+    def tables(self):
+        with self.lock:
+            cursor = self.connection.execute('SELECT DISTINCT table_name FROM ' + COLUMNS_TABLE +
+                                             ' ORDER BY table_name')
+            return [row[0] for row in cursor]
+
+    def create_table(self, table_name, column_metadata):
+        quoted = quote_name(table_name)
+        self.connection.execute('DROP TABLE IF EXISTS ' + quoted)
+        self.connection.execute('DELETE FROM ' + COLUMNS_TABLE + ' WHERE table_name = ?', (table_name,))
+        definitions = [quote_name(column['name']) + ' ' + column_affinity(column.get('type'))
+                       for column in column_metadata]
+        self.connection.execute('CREATE TABLE ' + quoted + ' (' + ', '.join(definitions) + ')')
+        self.connection.executemany('INSERT INTO ' + COLUMNS_TABLE + ' VALUES (?, ?, ?, ?)',
+                                    [(table_name, i, column['name'], column.get('type', 'varchar'))
+                                     for i, column in enumerate(column_metadata)])
+        return ('INSERT INTO ' + quoted + ' VALUES (' + ', '.join('?' * len(column_metadata)) + ')',
+                [i for i, column in enumerate(column_metadata) if column_affinity(column.get('type')) == 'TEXT'])
+
+    def insert_rows(self, insert, text_columns, rows):
+        if text_columns:
+            rows = [tuple(sql_value(value) for value in row) for row in rows]
+        self.connection.executemany(insert, rows)
+
+    def load(self, table_name, column_metadata, rows):
+        if not column_metadata:
+            raise LocalQueryError('Results have no columns to load')
+        with self.lock:
+            try:
+                with self.connection:
+                    insert, text_columns = self.create_table(table_name, column_metadata)
+                    self.insert_rows(insert, text_columns, rows)
+            except sqlite3.Error as e:
+                raise LocalQueryError('Could not load ' + table_name + ': ' + str(e))
+        logging.info('Loaded %d rows into local table %s', len(rows), table_name)
+
+    def load_compact(self, table_name, compact):
+        self.load(table_name, compact.column_metadata, compact.rows)
+
+    def write(self, table_name, action, *args):
+        with self.lock:
+            try:
+                with self.connection:
+                    return action(*args)
+            except sqlite3.Error as e:
+                raise LocalQueryError('Could not load ' + table_name + ': ' + str(e))
+
+    def capture_pages(self, table_name, stream):
+        column_metadata = stream.metadata.get('columns', [])
+        getter = itemgetter(*stream.columns) if len(stream.columns) > 1 else None
+        rows = 0
+        first = True
+        insert, text_columns = self.write(table_name, self.create_table, table_name, column_metadata)
+        # Each page is committed before it is handed on, the lock and transaction are never held across a yield
+        for items in stream.iter_pages():
+            try:
+                values = list(map(getter, items)) if getter else [(item.get(stream.columns[0]),) for item in items]
+            except KeyError:
+                values = [tuple(item.get(column) for column in stream.columns) for item in items]
+            self.write(table_name, self.insert_rows, insert, text_columns, values)
+            rows += len(values)
+            page = {'items': items}
+            if first:
+                page['metadata'] = stream.metadata
+                first = False
+            yield page
+        logging.info('Loaded %d rows into local table %s', rows, table_name)
+
+    def capture(self, table_name, stream):
+        if not stream.columns:
+            return stream
+        captured = ResultStream(self.capture_pages(table_name, stream))
+        captured.metrics = stream.metrics
+        return captured
+
+    def column_types(self):
+        cursor = self.connection.execute('SELECT name, type FROM ' + COLUMNS_TABLE +
+                                         ' ORDER BY table_name, position')
+        types = {}
+        for name, column_type in cursor:
+            # sqlite column names are case insensitive
+            types.setdefault(name.lower(), column_type)
+        return types
+
+    def fetch(self, cursor):
+        with self.lock:
+            try:
+                return cursor.fetchmany(self.page_size)
+            except sqlite3.Error as e:
+                raise LocalQueryError('Local query failed: ' + str(e))
+
+    def query_pages(self, cursor, names, references, types):
+        try:
+            rows = self.fetch(cursor)
+            columns = []
+            for i, name in enumerate(names):
+                # Only a plain column reference keeps the stored type, sum(n) AS isolated is not a boolean
+                if references[i] in types:
+                    columns.append({'name': name, 'type': types[references[i]]})
+                else:
+                    value = next((row[i] for row in rows if row[i] is not None), None)
+                    columns.append({'name': name, 'type': value_type(value)})
+            # sqlite stores booleans as 0 and 1
+            booleans = [i for i, column in enumerate(columns) if column['type'] == 'boolean']
+            page = {'metadata': {'columns': columns}}
+            while True:
+                if booleans:
+                    rows = [tuple(bool(value) if i in booleans and value is not None else value
+                                  for i, value in enumerate(row)) for row in rows]
+                page['items'] = [dict(zip(names, row)) for row in rows]
+                yield page
+                if len(rows) < self.page_size:
+                    return
+                rows = self.fetch(cursor)
+                page = {}
+        finally:
+            cursor.close()
+
+    def query(self, query_text):
+        logging.debug('Running local query: ' + query_text)
+        with self.lock:
+            try:
+                cursor = self.connection.execute(query_text.strip())
+                types = self.column_types()
+            except sqlite3.Error as e:
+                raise LocalQueryError('Local query failed: ' + str(e))
+        if cursor.description is None:
+            # Statements like CREATE VIEW or DELETE return nothing but should persist
+            cursor.close()
+            with self.lock:
+                self.connection.commit()
+            return ResultStream([])
+        names = [column[0] for column in cursor.description]
+        return ResultStream(self.query_pages(cursor, names, output_references(query_text, names), types))
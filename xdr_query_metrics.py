@@ -0,0 +1,202 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+current_phase = contextvars.ContextVar('current_phase', default=None)
+
+PHASE_COUNTERS = [('seconds', 'Seconds spent in each query phase'),
+                  ('calls', 'Times each query phase ran'),
+                  ('bytes_sent', 'Request bytes sent in each query phase'),
+                  ('bytes_received', 'Response bytes received in each query phase')]
+
+
+class PhaseMetrics:
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def add(self, other):
+        self.seconds += other.seconds
+        self.calls += other.calls
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+
+    def to_dict(self):
+        return {'seconds': round(self.seconds, 6), 'calls': self.calls, 'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received}
+
+
+class ExecutionMetrics:
+
+    def __init__(self, name):
+        self.name = name
+        self.execution_id = None
+        self.phases = {}
+        self.polls = 0
+        self.pages = 0
+        self.rows = 0
+        self.succeeded = None
+        self.error = None
+        self.started_at = time.time()
+        self.start = time.monotonic()
+        self.finish = self.start
+        self.lock = threading.Lock()
+
+    def phase_metrics(self, name):
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = PhaseMetrics()
+            return self.phases[name]
+
+    @property
+    def elapsed(self):
+        return self.finish - self.start
+
+    def to_dict(self):
+        return {'name': self.name, 'execution_id': self.execution_id, 'started_at': self.started_at,
+                'elapsed': round(self.elapsed, 6), 'succeeded': self.succeeded, 'error': self.error,
+                'polls': self.polls, 'pages': self.pages, 'rows': self.rows,
+                'phases': {name: phase.to_dict() for name, phase in self.phases.items()}}
+
+
+@contextmanager
+def phase(execution, name):
+    if execution is None:
+        yield None
+        return
+    metrics = execution.phase_metrics(name)
+    parent = current_phase.get()
+    token = current_phase.set(metrics)
+    start = time.monotonic()
+    try:
+        yield metrics
+    except Exception as e:
+        if execution.error is None:
+            execution.error = str(e)
+            execution.succeeded = False
+        raise
+    finally:
+        current_phase.reset(token)
+        seconds = time.monotonic() - start
+        metrics.seconds += seconds
+        metrics.calls += 1
+        # Phases are exclusive, time spent in a nested phase is not also counted in the enclosing one
+        if parent is not None:
+            parent.seconds -= seconds
+        execution.finish = time.monotonic()
+
+
+def record_bytes(sent, received):
+    metrics = current_phase.get()
+    if metrics is not None:
+        metrics.bytes_sent += sent
+        metrics.bytes_received += received
+
+
+def payload_size(payload):
+    if payload is None:
+        return 0
+    if isinstance(payload, str):
+        return len(payload.encode('utf-8'))
+    return len(payload)
+
+
+class MetricsRecorder:
+
+    def __init__(self):
+        self.executions = []
+        self.lock = threading.Lock()
+
+    def start_execution(self, name):
+        execution = ExecutionMetrics(name)
+        with self.lock:
+            self.executions.append(execution)
+        return execution
+
+    def totals(self):
+        phases = {}
+        totals = {'executions': 0, 'succeeded': 0, 'failed': 0, 'polls': 0, 'pages': 0, 'rows': 0}
+        with self.lock:
+            executions = list(self.executions)
+        for execution in executions:
+            totals['executions'] += 1
+            if execution.succeeded is True:
+                totals['succeeded'] += 1
+            elif execution.succeeded is False:
+                totals['failed'] += 1
+            totals['polls'] += execution.polls
+            totals['pages'] += execution.pages
+            totals['rows'] += execution.rows
+            for name, metrics in list(execution.phases.items()):
+                phases.setdefault(name, PhaseMetrics()).add(metrics)
+        totals['phases'] = phases
+        return totals
+
+    def summary(self):
+        totals = self.totals()
+        totals['phases'] = {name: metrics.to_dict() for name, metrics in totals['phases'].items()}
+        with self.lock:
+            executions = [execution.to_dict() for execution in self.executions]
+        return {'totals': totals, 'executions': executions}
+
+    def prometheus_text(self, prefix='xdr_query'):
+        totals = self.totals()
+        lines = []
+        for counter, help_text in PHASE_COUNTERS:
+            name = prefix + '_phase_' + counter + '_total'
+            lines.append('# HELP ' + name + ' ' + help_text)
+            lines.append('# TYPE ' + name + ' counter')
+            for phase_name, metrics in sorted(totals['phases'].items()):
+                lines.append('%s{phase="%s"} %s' % (name, phase_name, repr(getattr(metrics, counter))))
+        name = prefix + '_executions_total'
+        lines.append('# HELP ' + name + ' Query executions by outcome')
+        lines.append('# TYPE ' + name + ' counter')
+        for outcome in ('succeeded', 'failed'):
+            lines.append('%s{result="%s"} %d' % (name, outcome, totals[outcome]))
+        for counter, help_text in (('polls', 'Status polls made'), ('pages', 'Result pages downloaded'),
+                                   ('rows', 'Result rows received')):
+            name = prefix + '_' + counter + '_total'
+            lines.append('# HELP ' + name + ' ' + help_text)
+            lines.append('# TYPE ' + name + ' counter')
+            lines.append('%s %d' % (name, totals[counter]))
+        name = prefix + '_last_run_timestamp_seconds'
+        lines.append('# HELP ' + name + ' When these metrics were written')
+        lines.append('# TYPE ' + name + ' gauge')
+        lines.append('%s %.3f' % (name, time.time()))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, filename):
+        data = json.dumps(self.summary(), indent=4)
+        if filename == '-':
+            print(data)
+        else:
+            with open(filename, 'w') as f:
+                f.write(data)
+
+    def write_prometheus(self, filename):
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_filename, filename)
@@ -0,0 +1,339 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import ssl
+import subprocess
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+TOKEN_ROUTE = '/api/v2/oauth2/token'
+WHOAMI_ROUTE = '/whoami/v1'
+EXECUTIONS_ROUTE = '/xdr-query/v1/queries/runs'
+TENANTS_ROUTES = {'partner': '/partner/v1/tenants', 'organization': '/organization/v1/tenants'}
+MOCK_TENANT_ID = '11111111-2222-3333-4444-555555555555'
+MOCK_TOKEN = 'mock-access-token'
+
+
+def generate_self_signed_cert(directory):
+    cert_file = os.path.join(directory, 'mock_cert.pem')
+    key_file = os.path.join(directory, 'mock_key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+                    '-keyout', key_file, '-out', cert_file],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_file, key_file
+
+
+class MockDataLakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), query_duration=0.0, result_rows=10, cert_file=None,
+                 key_file=None, id_type='tenant', latency=0.0, error_rate=0.0, throttle_rps=0.0, result_columns=3,
+                 compression=True, tenants=3, page_totals=True):
+        super().__init__(address, MockDataLakeHandler)
+        self.id_type = id_type
+        self.query_duration = query_duration
+        self.result_rows = result_rows
+        self.result_columns = result_columns
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rps = throttle_rps
+        self.compression = compression
+        self.tenants = tenants
+        self.page_totals = page_totals
+        self.throttle_tokens = throttle_rps
+        self.throttle_updated = time.monotonic()
+        self.executions = {}
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.tls = cert_file is not None
+        if self.tls:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert_file, key_file)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        scheme = 'https' if self.tls else 'http'
+        host = 'localhost' if self.tls else self.server_address[0]
+        return scheme + '://' + host + ':' + str(self.server_address[1])
+
+    def environment_config(self, name='mock'):
+        return {name: {'whoamiURL': self.base_url + WHOAMI_ROUTE, 'tokenURL': self.base_url + TOKEN_ROUTE}}
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.errors = 0
+            self.throttled = 0
+            self.bytes_sent = 0
+
+    def count_bytes(self, count):
+        with self.lock:
+            self.bytes_sent += count
+
+    def take_throttle_token(self):
+        if not self.throttle_rps:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.throttle_tokens = min(self.throttle_rps,
+                                       self.throttle_tokens + (now - self.throttle_updated) * self.throttle_rps)
+            self.throttle_updated = now
+            if self.throttle_tokens < 1:
+                self.throttled += 1
+                return False
+            self.throttle_tokens -= 1
+            return True
+
+    def inject_error(self):
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            return True
+        return False
+
+    def create_execution(self, body):
+        execution_id = str(uuid.uuid4())
+        with self.lock:
+            self.executions[execution_id] = {'started': time.monotonic(), 'body': body}
+        return execution_id
+
+    def execution_status(self, execution_id):
+        with self.lock:
+            execution = self.executions.get(execution_id)
+        if execution is None:
+            return None
+        if time.monotonic() - execution['started'] < self.query_duration:
+            return {'id': execution_id, 'status': 'running'}
+        return {'id': execution_id, 'status': 'finished', 'result': 'succeeded'}
+
+    def result_row(self, i, extra_columns):
+        row = {'meta_hostname': 'host-' + str(i % 50), 'calendar_time': '2020-01-01 00:00:00', 'counter': i}
+        for column in extra_columns:
+            row[column] = column + '-' + str(i % 97)
+        return row
+
+    def execution_results(self, execution_id, page=1, page_size=None, page_total=False):
+        extra_columns = ['field_' + str(i) for i in range(max(self.result_columns - 3, 0))]
+        columns = [{'name': 'meta_hostname', 'type': 'varchar'},
+                   {'name': 'calendar_time', 'type': 'varchar'},
+                   {'name': 'counter', 'type': 'bigint'}] + [{'name': name, 'type': 'varchar'}
+                                                             for name in extra_columns]
+        page_size = page_size or max(self.result_rows, 1)
+        total = max((self.result_rows + page_size - 1) // page_size, 1)
+        first = (page - 1) * page_size
+        items = [self.result_row(i, extra_columns) for i in range(first, min(first + page_size, self.result_rows))]
+        pages = {'current': page, 'size': page_size}
+        if page_total and self.page_totals:
+            pages.update({'total': total, 'items': self.result_rows})
+        return {'metadata': {'columns': columns}, 'items': items, 'pages': pages}
+
+    def tenant_id(self, i):
+        return '%08d-0000-4000-8000-000000000000' % i
+
+    def tenant_page(self, page=1, page_size=100):
+        tenants = [{'id': self.tenant_id(i), 'name': 'Mock Tenant ' + str(i), 'dataRegion': 'eu01',
+                    'apiHost': self.base_url, 'status': 'active'} for i in range(1, self.tenants + 1)]
+        first = (page - 1) * page_size
+        total = max((len(tenants) + page_size - 1) // page_size, 1)
+        return {'items': tenants[first:first + page_size],
+                'pages': {'current': page, 'size': page_size, 'total': total, 'items': len(tenants)}}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class MockDataLakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug('Mock server: ' + format % args)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        accepted = [encoding.strip() for encoding in self.headers.get('Accept-Encoding', '').split(',')]
+        compress = self.server.compression and 'gzip' in accepted and len(data) >= 1024
+        if compress:
+            data = gzip.compress(data, 6)
+        self.server.count_bytes(len(data))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def injected_failure(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.server.take_throttle_token():
+            self.send_json(429, {'message': 'Too many requests'}, {'Retry-After': '1'})
+            return True
+        if self.server.inject_error():
+            self.send_json(500, {'message': 'Injected error'})
+            return True
+        return False
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def authorized(self):
+        return self.headers.get('Authorization') == 'Bearer ' + MOCK_TOKEN
+
+    def do_POST(self):
+        self.server.count_request()
+        body = self.read_body()
+        path = self.path.split('?')[0]
+        if self.injected_failure():
+            return
+        if path == TOKEN_ROUTE:
+            self.send_json(200, {'access_token': MOCK_TOKEN, 'token_type': 'bearer', 'expires_in': 3600})
+        elif not self.authorized():
+            self.send_json(401, {'message': 'Unauthorized'})
+        elif path == EXECUTIONS_ROUTE:
+            execution_id = self.server.create_execution(body)
+            self.send_json(201, {'id': execution_id, 'status': 'pending'})
+        else:
+            self.send_json(404, {'message': 'Not found'})
+
+    def do_GET(self):
+        self.server.count_request()
+        path = self.path.split('?')[0]
+        if self.injected_failure():
+            return
+        if not self.authorized():
+            self.send_json(401, {'message': 'Unauthorized'})
+        elif path == WHOAMI_ROUTE:
+            api_hosts = {'global': self.server.base_url}
+            if self.server.id_type == 'tenant':
+                api_hosts['dataRegion'] = self.server.base_url
+            self.send_json(200, {'id': MOCK_TENANT_ID, 'idType': self.server.id_type, 'apiHosts': api_hosts})
+        elif path == TENANTS_ROUTES.get(self.server.id_type):
+            query = parse_qs(urlsplit(self.path).query)
+            page = int(query.get('page', ['1'])[0])
+            page_size = int(query.get('pageSize', ['100'])[0])
+            self.send_json(200, self.server.tenant_page(page, page_size))
+        elif path.startswith(EXECUTIONS_ROUTE + '/'):
+            parts = path[len(EXECUTIONS_ROUTE) + 1:].split('/')
+            status = self.server.execution_status(parts[0])
+            if status is None:
+                self.send_json(404, {'message': 'Execution not found'})
+            elif len(parts) == 1:
+                self.send_json(200, status)
+            elif parts[1] == 'results':
+                query = parse_qs(urlsplit(self.path).query)
+                page = int(query.get('page', ['1'])[0])
+                page_size = int(query['pageSize'][0]) if 'pageSize' in query else None
+                page_total = query.get('pageTotal', ['false'])[0] == 'true'
+                self.send_json(200, self.server.execution_results(parts[0], page, page_size, page_total))
+            else:
+                self.send_json(404, {'message': 'Not found'})
+        else:
+            self.send_json(404, {'message': 'Not found'})
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local mock of the Data Lake query api')
+    parser.add_argument('--host', type=str, help='The address to listen on', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, help='The port to listen on', default=8443)
+    parser.add_argument('--query_duration', type=float, help='Seconds before a query reports finished',
+                        default=0.0)
+    parser.add_argument('--result_rows', type=int, help='Rows returned per query', default=10)
+    parser.add_argument('--result_columns', type=int, help='Columns returned per row', default=3)
+    parser.add_argument('--latency', type=float, help='Seconds added to every response', default=0.0)
+    parser.add_argument('--error_rate', type=float, help='Fraction of requests answered with a 500', default=0.0)
+    parser.add_argument('--throttle_rps', type=float, help='Requests per second allowed before answering 429',
+                        default=0.0)
+    parser.add_argument('--no_compression', action='store_true', help='Never gzip responses')
+    parser.add_argument('--id_type', type=str, help='The idType reported by whoami',
+                        choices=['tenant', 'partner', 'organization'], default='tenant')
+    parser.add_argument('--tenants', type=int, help='Tenants listed for partner and organization ids', default=3)
+    parser.add_argument('--no_page_totals', action='store_true',
+                        help='Leave the page total out of results pages even when pageTotal is requested')
+    parser.add_argument('--tls', action='store_true', help='Serve https with a generated self signed certificate')
+    parser.add_argument('--cert_dir', type=str, help='Directory for the generated certificate', default='.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+
+    cert_file = key_file = None
+    if args.tls:
+        cert_file, key_file = generate_self_signed_cert(args.cert_dir)
+        logging.info('Certificate written to ' + cert_file)
+
+    server = MockDataLakeServer((args.host, args.port), query_duration=args.query_duration,
+                                result_rows=args.result_rows, id_type=args.id_type, cert_file=cert_file,
+                                key_file=key_file, latency=args.latency, error_rate=args.error_rate,
+                                throttle_rps=args.throttle_rps, result_columns=args.result_columns,
+                                compression=not args.no_compression, tenants=args.tenants,
+                                page_totals=not args.no_page_totals)
+    logging.info('Mock data lake listening on ' + server.base_url)
+    logging.info('Config: ' + json.dumps(server.environment_config()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
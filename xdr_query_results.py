@@ -0,0 +1,272 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+from operator import itemgetter
+
+from xdr_query_spill import ProjectedRows, SpillBuffer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects integers outside 64 bits that json accepts, let json decide
+            pass
+    return json.loads(data)
+
+
+def next_page_params(page, page_size=None):
+    pages = page.get('pages') or {}
+    if pages.get('nextKey'):
+        return {'pageFromKey': pages['nextKey']}
+    current = pages.get('current')
+    total = pages.get('total')
+    if isinstance(current, int) and isinstance(total, int):
+        return {'page': current + 1} if current < total else None
+    # Without a total only a short page is known to be the last one
+    if isinstance(current, int) and page_size and len(page.get('items', [])) >= page_size:
+        return {'page': current + 1}
+    return None
+
+
+def used_columns(columns, items):
+    position = {column: i for i, column in reversed(list(enumerate(columns)))}
+    remaining = set(columns)
+    used = []
+    for item in items:
+        if not remaining:
+            break
+        found = remaining.intersection(item)
+        if found:
+            remaining -= found
+            used.extend(sorted(found, key=position.__getitem__))
+    return used
+
+
+def build_table(columns, items):
+    used = used_columns(columns, items)
+    return used, [list(map(item.get, used)) for item in items]
+
+
+class ResultStream:
+
+    def __init__(self, pages):
+        self.pages = iter(pages)
+        first_page = next(self.pages, None) or {}
+        self.metadata = first_page.get('metadata', {'columns': []})
+        self.columns = [column['name'] for column in self.metadata.get('columns', [])]
+        self.first_items = first_page.get('items', [])
+        self.rows = 0
+        self.metrics = None
+
+    def iter_pages(self):
+        if self.first_items is None:
+            raise RuntimeError('ResultStream can only be iterated once')
+        items, self.first_items = self.first_items, None
+        while True:
+            self.rows += len(items)
+            yield items
+            page = next(self.pages, None)
+            if page is None:
+                return
+            items = page.get('items', [])
+
+    def __iter__(self):
+        for items in self.iter_pages():
+            yield from items
+
+    def to_results(self):
+        return {'metadata': self.metadata, 'items': list(self)}
+
+
+class CompactResults:
+
+    def __init__(self, column_metadata, rows, present=None):
+        self.column_metadata = column_metadata
+        self.columns = [column['name'] for column in column_metadata]
+        self.rows = rows
+        # Columns in the order they first appear in the items, as build_table shows them
+        self.present = present if present is not None else list(self.columns)
+
+    @classmethod
+    def from_stream(cls, stream, intern=True, spill_rows=None, spill_dir=None):
+        columns = stream.columns
+        getters = [itemgetter(column) for column in columns]
+        # Repeated values in a column share one object, until a column turns out to be mostly unique
+        caches = [{} if intern else None for _ in columns]
+        seen = 0
+        # build_table shows a column when any row has the key, even if every value is null
+        present = []
+        missing = set(columns)
+        rows = SpillBuffer(spill_rows, spill_dir) if spill_rows else []
+        for items in stream.iter_pages():
+            if missing:
+                found = used_columns([column for column in columns if column in missing], items)
+                present.extend(found)
+                missing.difference_update(found)
+            seen += len(items)
+            values = []
+            for i, getter in enumerate(getters):
+                try:
+                    column_values = list(map(getter, items))
+                except KeyError:
+                    column_values = [item.get(columns[i]) for item in items]
+                cache = caches[i]
+                if cache is not None:
+                    try:
+                        # Keyed by type too, as 1, 1.0 and True are equal dict keys
+                        keys = zip(map(type, column_values), column_values)
+                        column_values = list(map(cache.setdefault, keys, column_values))
+                    except TypeError:
+                        caches[i] = None
+                    else:
+                        if len(cache) > 4096 and len(cache) * 2 > seen:
+                            caches[i] = None
+                values.append(column_values)
+            rows.extend(zip(*values))
+            if spill_rows and rows.spilled:
+                # Shared values only save memory while rows stay in it
+                caches = [None] * len(columns)
+        if spill_rows and not rows.spilled:
+            rows = rows.rows
+        return cls(stream.metadata.get('columns', []), rows, present)
+
+    @classmethod
+    def from_results(cls, results):
+        return cls.from_stream(ResultStream([results]))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def spilled(self):
+        return isinstance(self.rows, SpillBuffer)
+
+    def close(self):
+        if self.spilled:
+            self.rows.close()
+
+    def column(self, name):
+        index = self.columns.index(name)
+        return [row[index] for row in self.rows]
+
+    def columnar(self):
+        if not self.rows:
+            return {column: [] for column in self.columns}
+        return {column: list(values) for column, values in zip(self.columns, zip(*self.rows))}
+
+    def used_columns(self):
+        return list(self.present)
+
+    def table(self):
+        used = self.used_columns()
+        if used == self.columns:
+            return used, self.rows
+        indexes = [self.columns.index(column) for column in used]
+        if self.spilled:
+            return used, ProjectedRows(self.rows, indexes)
+        return used, [[row[i] for i in indexes] for row in self.rows]
+
+    def metadata(self):
+        return {'columns': self.column_metadata}
+
+    def items(self):
+        columns = self.columns
+        present = set(self.present)
+        for row in self.rows:
+            yield {column: value for column, value in zip(columns, row) if column in present}
+
+    def to_results(self):
+        return {'metadata': self.metadata(), 'items': list(self.items())}
+
+
+def sort_key(value):
+    if value is None:
+        return 0, 0, ''
+    if isinstance(value, (int, float)):
+        return 1, value, ''
+    return 2, 0, str(value)
+
+
+class ResultTable:
+
+    def __init__(self, column_metadata, columns, rows):
+        metadata_by_name = {column['name']: column for column in column_metadata}
+        self.column_metadata = [metadata_by_name.get(column, {'name': column}) for column in columns]
+        self.columns = columns
+        self.rows = rows
+        self.view = list(range(len(rows)))
+        self.sort_column = None
+        self.sort_descending = False
+        self.filter_text = ''
+
+    @classmethod
+    def from_results(cls, results):
+        column_metadata = results['metadata']['columns']
+        columns, rows = build_table([column['name'] for column in column_metadata], results['items'])
+        return cls(column_metadata, columns, rows)
+
+    @classmethod
+    def from_compact(cls, compact):
+        columns, rows = compact.table()
+        return cls(compact.column_metadata, columns, rows)
+
+    def __len__(self):
+        return len(self.view)
+
+    def window(self, start, count):
+        return [self.rows[i] for i in self.view[start:start + count]]
+
+    def sort(self, column, descending=None):
+        if descending is None:
+            descending = not self.sort_descending if column == self.sort_column else False
+        self.sort_column = column
+        self.sort_descending = descending
+        self.apply_sort()
+
+    def apply_sort(self):
+        if self.sort_column is None:
+            return
+        index = self.columns.index(self.sort_column)
+        rows = self.rows
+        self.view.sort(key=lambda i: sort_key(rows[i][index]), reverse=self.sort_descending)
+
+    def filter(self, text):
+        self.filter_text = text.lower()
+        if not self.filter_text:
+            self.view = list(range(len(self.rows)))
+        else:
+            needle = self.filter_text
+            self.view = [i for i, row in enumerate(self.rows)
+                         if any(value is not None and needle in str(value).lower() for value in row)]
+        self.apply_sort()
+
+    def metadata(self):
+        return {'columns': self.column_metadata}
+
+    def items(self):
+        columns = self.columns
+        for i in self.view:
+            yield dict(zip(columns, self.rows[i]))
+
+    def to_results(self):
+        return {'metadata': self.metadata(), 'items': list(self.items())}
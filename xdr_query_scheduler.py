@@ -0,0 +1,117 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+THROTTLED_STATUSES = (429, 503)
+ID_SEGMENT = re.compile(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{16,}|\d+)$',
+                        re.IGNORECASE)
+
+
+def endpoint_key(method, url, tenant_id=None):
+    parts = urlsplit(url)
+    path = '/'.join('*' if ID_SEGMENT.match(segment) else segment for segment in parts.path.split('/'))
+    return method + ' ' + parts.netloc + path, tenant_id or ''
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst, max_rate):
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.slowed_until = 0.0
+
+    def slow_down(self, now, interval, min_rate):
+        # Throttles that arrive together are one congestion signal, halve the rate once for them
+        if now < self.slowed_until:
+            return
+        self.rate = max(self.rate / 2, min_rate)
+        self.slowed_until = now + interval
+
+    def reserve(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RequestScheduler:
+
+    def __init__(self, rate=10.0, burst=None, max_rate=None, min_rate=0.5, recovery=0.1, max_retries=6,
+                 first_backoff=1.0, max_backoff=60.0):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self.max_rate = max_rate if max_rate is not None else rate * 4
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.max_retries = max_retries
+        self.first_backoff = first_backoff
+        self.max_backoff = max_backoff
+        self.buckets = {}
+        self.paused_until = 0.0
+        self.consecutive_throttles = 0
+        self.requests = 0
+        self.throttled_responses = 0
+        self.lock = threading.Lock()
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, self.max_rate)
+            self.buckets[key] = bucket
+        return bucket
+
+    def acquire(self, key):
+        with self.lock:
+            now = time.monotonic()
+            self.requests += 1
+            wait = max(self.paused_until - now, 0.0)
+            if self.rate:
+                wait = max(wait, self.bucket(key).reserve(now))
+            return wait
+
+    def is_throttled(self, status):
+        return status in THROTTLED_STATUSES
+
+    def throttled(self, key, retry_after=None):
+        with self.lock:
+            self.throttled_responses += 1
+            self.consecutive_throttles += 1
+            if retry_after is None:
+                backoff = min(self.first_backoff * 2 ** (self.consecutive_throttles - 1), self.max_backoff)
+                retry_after = backoff * random.uniform(0.5, 1)
+            now = time.monotonic()
+            # Every in flight request waits out the pause, not just the one that was throttled
+            self.paused_until = max(self.paused_until, now + retry_after)
+            if self.rate:
+                self.bucket(key).slow_down(now, max(retry_after, self.first_backoff), self.min_rate)
+            return retry_after
+
+    def completed(self, key):
+        with self.lock:
+            self.consecutive_throttles = 0
+            if self.rate:
+                bucket = self.bucket(key)
+                bucket.rate = min(bucket.rate + self.recovery, bucket.max_rate)
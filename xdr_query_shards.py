@@ -0,0 +1,399 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import re
+from datetime import datetime, timedelta, timezone
+
+from xdr_query_sql import mask_literals
+
+START_PLACEHOLDER = '{{start}}'
+END_PLACEHOLDER = '{{end}}'
+TIME_FORMATS = ['timestamp', 'epoch']
+MERGEABLE_AGGREGATES = {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'}
+NUMERIC_TYPES = ['bigint', 'integer', 'int', 'smallint', 'tinyint', 'double', 'real', 'float', 'decimal']
+
+CLAUSE_KEYWORDS = ['select', 'from', 'where', 'group by', 'having', 'order by', 'limit', 'union', 'intersect',
+                   'except']
+CLAUSE_PATTERN = re.compile(r'\b(' + '|'.join(keyword.replace(' ', r'\s+') for keyword in CLAUSE_KEYWORDS) + r')\b',
+                            re.IGNORECASE)
+AGGREGATE_PATTERN = re.compile(r'\b(count|sum|min|max|avg|approx_distinct|array_agg|stddev|variance)\s*\(',
+                               re.IGNORECASE)
+ALIAS_PATTERN = re.compile(r'^\s*(as\s+)?("[^"]*"|\w+)\s*$', re.IGNORECASE)
+EXPLICIT_ALIAS_PATTERN = re.compile(r'^(.*\S)\s+as\s+("[^"]*"|\w+)\s*$', re.IGNORECASE | re.DOTALL)
+IMPLICIT_ALIAS_PATTERN = re.compile(r'^(.*[\w)"])\s+("[^"]*"|\w+)\s*$', re.DOTALL)
+IDENTIFIER_PATTERN = re.compile(r'^\s*(?:(?:"[^"]*"|\w+)\s*\.\s*)*("[^"]*"|\w+)\s*$')
+ORDER_PATTERN = re.compile(r'^(.*?)(?:\s+(asc|desc))?(?:\s+nulls\s+(first|last))?\s*$', re.IGNORECASE | re.DOTALL)
+SQL_KEYWORDS = ['and', 'or', 'not', 'is', 'in', 'like', 'between', 'case', 'when', 'then', 'else', 'end', 'null',
+                'true', 'false', 'distinct']
+TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\w+|[^\s\w]")
+
+
+class ShardError(Exception):
+    pass
+
+
+def parse_time(value):
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        try:
+            moment = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        except ValueError:
+            raise ShardError('Invalid shard time: ' + value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+
+def format_time(moment, time_format='timestamp'):
+    if time_format == 'epoch':
+        return str(int(moment.timestamp()))
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def time_literal(moment, time_format='timestamp'):
+    if time_format == 'epoch':
+        return format_time(moment, time_format)
+    return "'" + format_time(moment, time_format) + "'"
+
+
+def value_time(value, time_format='timestamp'):
+    if value is None or value == '':
+        return None
+    if time_format == 'epoch' or isinstance(value, (int, float)):
+        return datetime.fromtimestamp(float(value), timezone.utc)
+    return parse_time(str(value))
+
+
+def top_level_clauses(sql):
+    masked = mask_literals(sql)
+    depth_at = []
+    depth = 0
+    for char in masked:
+        if char == '(':
+            depth += 1
+        depth_at.append(depth)
+        if char == ')':
+            depth -= 1
+    return [(' '.join(match.group(1).lower().split()), match.start(), match.end())
+            for match in CLAUSE_PATTERN.finditer(masked) if depth_at[match.start()] == 0]
+
+
+def split_top_level(text):
+    masked = mask_literals(text)
+    parts = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(masked):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+def strip_query(query_text):
+    return query_text.strip().rstrip(';').rstrip()
+
+
+def add_predicate(query_text, predicate):
+    sql = strip_query(query_text)
+    clauses = top_level_clauses(sql)
+    names = [name for name, _, _ in clauses]
+    if names.count('select') != 1 or any(name in names for name in ('union', 'intersect', 'except')):
+        raise ShardError('Cannot add a time predicate to this query, use ' + START_PLACEHOLDER + ' and ' +
+                         END_PLACEHOLDER + ' placeholders instead')
+    select_index = names.index('select')
+    following = clauses[select_index + 1:]
+    if not following or following[0][0] != 'from':
+        raise ShardError('Cannot add a time predicate to a query without a FROM clause')
+    next_clause = next((clause for clause in following[1:] if clause[0] != 'where'), None)
+    clause_start = next_clause[1] if next_clause is not None else len(sql)
+    where = next((clause for clause in following if clause[0] == 'where'), None)
+    if where is None:
+        return (sql[:clause_start].rstrip() + ' WHERE ' + predicate + ' ' + sql[clause_start:]).rstrip()
+    condition = sql[where[2]:clause_start].strip()
+    return (sql[:where[2]] + ' (' + condition + ') AND ' + predicate + ' ' + sql[clause_start:]).rstrip()
+
+
+def clause_text(sql, clauses, name):
+    names = [clause for clause, _, _ in clauses]
+    if name not in names:
+        return None
+    index = names.index(name)
+    end = clauses[index + 1][1] if index + 1 < len(clauses) else len(sql)
+    return sql[clauses[index][2]:end]
+
+
+def select_expressions(query_text):
+    sql = strip_query(query_text)
+    clauses = top_level_clauses(sql)
+    names = [name for name, _, _ in clauses]
+    if 'select' not in names or 'from' not in names:
+        return None
+    select = clauses[names.index('select')]
+    select_list = sql[select[2]:clauses[names.index('from')][1]]
+    select_list = re.sub(r'^\s*(distinct|all)\b', '', select_list, flags=re.IGNORECASE)
+    return split_top_level(select_list)
+
+
+def select_aggregates(query_text):
+    expressions = select_expressions(query_text)
+    if expressions is None:
+        return None
+    aggregates = [expression_aggregate(expression) for expression in expressions]
+    if any(aggregates) and has_clause(query_text, 'having'):
+        raise ShardError('Queries with HAVING cannot be merged across shards')
+    return aggregates
+
+
+def expression_aggregate(expression):
+    masked = mask_literals(expression)
+    match = AGGREGATE_PATTERN.search(masked)
+    if match is None:
+        return None
+    function = match.group(1).lower()
+    depth = 0
+    close = None
+    for i in range(match.end() - 1, len(masked)):
+        if masked[i] == '(':
+            depth += 1
+        elif masked[i] == ')':
+            depth -= 1
+            if depth == 0:
+                close = i
+                break
+    simple = (match.start() == len(masked) - len(masked.lstrip()) and close is not None and
+              (not masked[close + 1:].strip() or ALIAS_PATTERN.match(masked[close + 1:])))
+    arguments = masked[match.end():close] if close is not None else ''
+    if not simple or function not in MERGEABLE_AGGREGATES or re.match(r'\s*distinct\b', arguments, re.IGNORECASE):
+        raise ShardError('Cannot merge ' + expression.strip() + ' across shards, only COUNT, SUM, MIN and MAX are '
+                         'supported')
+    return MERGEABLE_AGGREGATES[function]
+
+
+def expression_tokens(expression):
+    return [token if token[0] in '\'"' else token.lower() for token in TOKEN_PATTERN.findall(expression)]
+
+
+def unquote(name):
+    if name.startswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name.lower()
+
+
+def split_alias(expression):
+    # Returns the expression without its alias, and the name ORDER BY can refer to it by
+    masked = mask_literals(expression)
+    match = EXPLICIT_ALIAS_PATTERN.match(masked)
+    if match is None:
+        match = IMPLICIT_ALIAS_PATTERN.match(masked)
+        if match is not None and (match.group(2).lower() in SQL_KEYWORDS or
+                                  match.group(1).split()[-1].lower() in SQL_KEYWORDS):
+            match = None
+    if match is not None:
+        return expression[:match.end(1)], unquote(expression[match.start(2):match.end(2)])
+    match = IDENTIFIER_PATTERN.match(masked)
+    if match is not None:
+        return expression, unquote(expression[match.start(1):match.end(1)])
+    return expression, None
+
+
+def column_reference(expression):
+    # The column a select expression refers to when it is a plain, possibly qualified or aliased, column name
+    body, _ = split_alias(expression)
+    match = IDENTIFIER_PATTERN.match(mask_literals(body))
+    if match is None:
+        return None
+    return unquote(body[match.start(1):match.end(1)])
+
+
+def order_columns(query_text):
+    sql = strip_query(query_text)
+    order_by = clause_text(sql, top_level_clauses(sql), 'order by')
+    if order_by is None:
+        return []
+    selected = [split_alias(expression) for expression in select_expressions(query_text) or []]
+    columns = []
+    for term in split_top_level(order_by):
+        match = ORDER_PATTERN.match(mask_literals(term))
+        expression = term[:match.end(1)].strip()
+        columns.append((order_column(expression, selected), (match.group(2) or '').lower() == 'desc',
+                        (match.group(3) or '').lower() == 'first'))
+    return columns
+
+
+def order_column(expression, selected):
+    if expression.isdigit():
+        if 1 <= int(expression) <= len(selected):
+            return int(expression) - 1
+    elif re.match(r'^("[^"]*"|\w+)$', expression):
+        name = unquote(expression)
+        for i, (_, output_name) in enumerate(selected):
+            if output_name == name:
+                return i
+    tokens = expression_tokens(expression)
+    for i, (body, _) in enumerate(selected):
+        if expression_tokens(body) == tokens:
+            return i
+    raise ShardError('Cannot sort merged shards by ' + expression + ', ORDER BY must refer to a selected column')
+
+
+def sort_items(items, columns, order):
+    # One stable sort per term, last term first, nulls sort last unless NULLS FIRST is given
+    for index, descending, nulls_first in reversed(order):
+        column = columns[index]
+        present = [item for item in items if item.get(column) is not None]
+        nulls = [item for item in items if item.get(column) is None]
+        try:
+            present.sort(key=lambda item: item[column], reverse=descending)
+        except TypeError:
+            raise ShardError('Cannot sort merged shards by ' + column + ', its values have mixed types')
+        items = nulls + present if nulls_first else present + nulls
+    return items
+
+
+def number(value):
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    return value
+
+
+def maybe_number(value):
+    try:
+        return number(value)
+    except ValueError:
+        return value
+
+
+def value_converter(function, column_type):
+    # Numbers can arrive as strings, compare them as numbers or max('9', '10') would be '9'
+    column_type = column_type.lower().split('(')[0].strip()
+    if function == 'sum' or column_type in NUMERIC_TYPES:
+        return number
+    if not column_type:
+        return maybe_number
+    return None
+
+
+def merge_value(function, current, value, converter=number):
+    if value is None:
+        return current
+    if converter is not None:
+        value = converter(value)
+    if current is None:
+        return value
+    if function == 'sum':
+        return current + value
+    if function == 'min':
+        return min(current, value)
+    return max(current, value)
+
+
+def has_clause(query_text, name):
+    return any(clause == name for clause, _, _ in top_level_clauses(strip_query(query_text)))
+
+
+class ShardPlan:
+
+    def __init__(self, start, end=None, shards=4, column=None, time_format='timestamp'):
+        self.start = parse_time(start)
+        self.end = parse_time(end) if end is not None else datetime.now(timezone.utc).replace(microsecond=0)
+        self.shards = shards
+        self.column = column
+        self.time_format = time_format
+        if self.end <= self.start:
+            raise ShardError('Shard end must be after shard start')
+        if shards < 1:
+            raise ShardError('At least one shard is required')
+        if time_format not in TIME_FORMATS:
+            raise ShardError('Unknown shard time format: ' + time_format)
+
+    def windows(self):
+        total = (self.end - self.start).total_seconds()
+        bounds = [self.start + timedelta(seconds=int(total * i / self.shards)) for i in range(self.shards)]
+        bounds.append(self.end)
+        return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+    def format_time(self, moment):
+        return format_time(moment, self.time_format)
+
+    def literal(self, moment):
+        return time_literal(moment, self.time_format)
+
+    def shard_query(self, query_text, start, end):
+        if START_PLACEHOLDER in query_text or END_PLACEHOLDER in query_text:
+            query_text = query_text.replace(START_PLACEHOLDER, self.format_time(start))
+            return query_text.replace(END_PLACEHOLDER, self.format_time(end))
+        if not self.column:
+            raise ShardError('Sharding needs a timestamp column or ' + START_PLACEHOLDER + ' and ' +
+                             END_PLACEHOLDER + ' placeholders in the query')
+        predicate = '(%s >= %s AND %s < %s)' % (self.column, self.literal(start), self.column, self.literal(end))
+        return add_predicate(query_text, predicate)
+
+    def shard_queries(self, query_text):
+        return [self.shard_query(query_text, start, end) for start, end in self.windows()]
+
+
+class ShardMerger:
+
+    def __init__(self, query_text):
+        self.aggregates = select_aggregates(query_text)
+        self.grouped = bool(self.aggregates) and any(self.aggregates)
+        self.order = []
+        if self.grouped:
+            if has_clause(query_text, 'limit'):
+                raise ShardError('LIMIT cannot be merged across shards of an aggregate query, each shard would '
+                                 'only return its own top groups')
+            self.order = order_columns(query_text)
+
+    def merge(self, shard_results):
+        metadata = next((results['metadata'] for results in shard_results if results['metadata'].get('columns')),
+                        shard_results[0]['metadata'] if shard_results else {'columns': []})
+        if not self.grouped:
+            items = []
+            for results in shard_results:
+                items.extend(results['items'])
+            return {'metadata': metadata, 'items': items}
+
+        columns = [column['name'] for column in metadata['columns']]
+        if len(columns) != len(self.aggregates):
+            raise ShardError('Result columns do not match the select list, cannot merge aggregates')
+        keys = [column for column, function in zip(columns, self.aggregates) if function is None]
+        aggregated = [(column['name'], function, value_converter(function, column.get('type', '')))
+                      for column, function in zip(metadata['columns'], self.aggregates) if function]
+        groups = {}
+        for results in shard_results:
+            for item in results['items']:
+                group_key = tuple(item.get(column) for column in keys)
+                merged = groups.get(group_key)
+                if merged is None:
+                    merged = {column: None if function else item.get(column)
+                              for column, function in zip(columns, self.aggregates)}
+                    groups[group_key] = merged
+                for column, function, converter in aggregated:
+                    try:
+                        merged[column] = merge_value(function, merged[column], item.get(column), converter)
+                    except (TypeError, ValueError) as e:
+                        raise ShardError('Cannot merge ' + column + ' across shards: ' + str(e))
+        return {'metadata': metadata, 'items': sort_items(list(groups.values()), columns, self.order)}
@@ -0,0 +1,92 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pickle
+import tempfile
+
+
+class SpillBuffer:
+
+    def __init__(self, threshold=100000, directory=None, batch_size=10000):
+        self.threshold = threshold
+        self.directory = directory
+        self.batch_size = batch_size
+        self.rows = []
+        self.file = None
+        self.count = 0
+
+    @property
+    def spilled(self):
+        return self.file is not None
+
+    def extend(self, rows):
+        before = len(self.rows)
+        self.rows.extend(rows)
+        self.count += len(self.rows) - before
+        if self.file is None and len(self.rows) > self.threshold:
+            self.file = tempfile.TemporaryFile(prefix='xdr_query_', suffix='.spill', dir=self.directory)
+        if self.file is not None and len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def append(self, row):
+        self.extend((row,))
+
+    def flush(self):
+        if self.file is not None and self.rows:
+            self.file.seek(0, 2)
+            pickle.dump(self.rows, self.file, pickle.HIGHEST_PROTOCOL)
+            self.rows = []
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if self.file is None:
+            yield from list(self.rows)
+            return
+        self.flush()
+        # Each iterator keeps its own offset so a table can be read in several passes
+        offset = 0
+        while True:
+            self.file.seek(offset)
+            try:
+                batch = pickle.load(self.file)
+            except EOFError:
+                return
+            offset = self.file.tell()
+            yield from batch
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.rows = []
+        self.count = 0
+
+
+class ProjectedRows:
+
+    def __init__(self, rows, indexes):
+        self.rows = rows
+        self.indexes = indexes
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        indexes = self.indexes
+        for row in self.rows:
+            yield [row[i] for i in indexes]
@@ -0,0 +1,47 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+def mask_literals(sql):
+    # Blank out quoted strings and comments so keyword and bracket scanning only sees sql structure
+    masked = []
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if char in '\'"':
+            end = i + 1
+            while end < len(sql):
+                if sql[end] == char:
+                    if end + 1 < len(sql) and sql[end + 1] == char:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            masked.append(char + ' ' * (end - i - 1) + sql[end:end + 1])
+            i = end + 1
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            end = len(sql) if end < 0 else end
+            masked.append(' ' * (end - i))
+            i = end
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            end = len(sql) if end < 0 else end + 2
+            masked.append(' ' * (end - i))
+            i = end
+        else:
+            masked.append(char)
+            i += 1
+    return ''.join(masked)
@@ -0,0 +1,129 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+from xdr_query_cache import file_lock, write_private_file
+
+DEFAULT_TENANT_CACHE = os.path.join('~', '.xdr_query', 'tenants.json')
+
+
+class TenantError(Exception):
+    pass
+
+
+def owner_key(whoami):
+    return whoami['idType'] + ':' + whoami['id']
+
+
+def tenant_label(tenant):
+    return tenant['name'] + ' (' + tenant['id'] + ')'
+
+
+class TenantIndex:
+
+    def __init__(self, tenants):
+        self.by_id = {tenant['id'].lower(): tenant for tenant in tenants}
+        self.names = sorted((tenant['name'].lower(), tenant['id'].lower()) for tenant in tenants)
+
+    def get(self, tenant_id):
+        return self.by_id.get(tenant_id.lower())
+
+    def search(self, prefix):
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.names, (prefix,))
+        matches = []
+        for name, tenant_id in self.names[start:]:
+            if not name.startswith(prefix):
+                break
+            matches.append(self.by_id[tenant_id])
+        return matches
+
+    def resolve(self, text):
+        tenant = self.get(text.strip())
+        if tenant is not None:
+            return tenant
+        # Labels picked from the gui's list end with the id in parentheses
+        if text.strip().endswith(')') and '(' in text:
+            tenant = self.get(text.strip()[text.rindex('(') + 1:-1])
+            if tenant is not None:
+                return tenant
+        matches = self.search(text.strip())
+        exact = [tenant for tenant in matches if tenant['name'].lower() == text.strip().lower()]
+        if len(exact) == 1:
+            return exact[0]
+        if len(matches) == 1:
+            return matches[0]
+        if not matches:
+            raise TenantError('No tenant with id or name ' + text + ' is reachable with these credentials')
+        raise TenantError(text + ' matches %d tenants: %s' % (len(matches), ', '.join(
+            tenant_label(tenant) for tenant in matches[:5]) + (', ...' if len(matches) > 5 else '')))
+
+
+class TenantDirectory:
+
+    def __init__(self, filename=None, ttl=24 * 3600):
+        self.filename = os.path.expanduser(filename) if filename else None
+        self.ttl = ttl
+        self.entries = {}
+        self.indexes = {}
+        self.lock = threading.Lock()
+        if self.filename:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                self.entries = json.loads(f.read())
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable tenant cache: ' + str(e))
+            self.entries = {}
+
+    def save(self):
+        if self.filename:
+            try:
+                write_private_file(self.filename, json.dumps(self.entries).encode('utf-8'))
+            except OSError as e:
+                logging.warning('Could not save tenant cache: ' + str(e))
+
+    def index(self, owner):
+        with self.lock:
+            entry = self.entries.get(owner)
+            if entry is None or entry['fetched_at'] + self.ttl <= time.time():
+                return None
+            if owner not in self.indexes:
+                self.indexes[owner] = TenantIndex(entry['tenants'])
+            return self.indexes[owner]
+
+    def put(self, owner, tenants):
+        with self.lock, file_lock(self.filename):
+            if self.filename:
+                self.load()
+                self.indexes = {}
+            self.entries = {key: entry for key, entry in self.entries.items()
+                            if entry['fetched_at'] + self.ttl > time.time()}
+            self.entries[owner] = {'fetched_at': time.time(), 'tenants': tenants}
+            self.indexes[owner] = TenantIndex(tenants)
+            self.save()
+            return self.indexes[owner]
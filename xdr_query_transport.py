@@ -0,0 +1,103 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+
+
+WIRE_BYTES_HEADER = 'X-Wire-Bytes'
+
+
+def wire_bytes(headers, data):
+    try:
+        return int(headers.get(WIRE_BYTES_HEADER) or headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return len(data)
+
+
+class TransportError(Exception):
+    pass
+
+
+class HTTPTransport:
+
+    def __init__(self, pool_size=10, keep_alive=True, verify=True, compress=True, chunk_size=64 * 1024):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.verify = verify
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def host_key(self, url):
+        parts = urlsplit(url)
+        return parts.scheme + '://' + parts.netloc
+
+    def session_for(self, url):
+        key = self.host_key(url)
+        with self.lock:
+            if self.closed:
+                raise TransportError('Transport is closed')
+            session = self.sessions.get(key)
+            if session is None:
+                logging.debug('Opening connection pool for ' + key)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(key, adapter)
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                # Every encoding urllib3 can decode here, zstd and br included when their modules are installed
+                session.headers['Accept-Encoding'] = ACCEPT_ENCODING if self.compress else 'identity'
+                self.sessions[key] = session
+            return session
+
+    def request(self, method, url, payload, timeout, headers):
+        session = self.session_for(url)
+        try:
+            req = requests.Request(method, url, data=payload, headers=headers)
+            prepped = session.prepare_request(req)
+            resp = session.send(prepped, timeout=timeout, verify=self.verify, stream=True)
+            try:
+                # Decoded chunk by chunk as it arrives rather than after the whole compressed body is read
+                content = b''.join(resp.iter_content(self.chunk_size))
+                wire_bytes = resp.raw.tell()
+            finally:
+                resp.close()
+        except requests.RequestException as e:
+            raise TransportError(str(e))
+        headers = dict(resp.headers)
+        headers[WIRE_BYTES_HEADER] = str(wire_bytes)
+        return content, resp.status_code, headers
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,395 @@
+# Copyright 2020 Sophos Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import csv
+import gzip
+import json
+import math
+import os
+import re
+import sys
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import wcwidth
+except ImportError:
+    wcwidth = None
+
+STREAMING_FORMATS = ['csv', 'ndjson', 'parquet']
+OUTPUT_FORMATS = ['table', 'json'] + STREAMING_FORMATS
+FORMAT_EXTENSIONS = {'table': '.txt', 'json': '.json', 'csv': '.csv', 'ndjson': '.ndjson', 'parquet': '.parquet'}
+COMPRESSIONS = ['gzip', 'zstd']
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+LINE_BREAK = re.compile('[\r\n]')
+THOUSANDS_NUMBER = re.compile(r'^(([+-]?[0-9]{1,3})(?:,([0-9]{3}))*)?(?(1)\.[0-9]*|\.[0-9]+)?$')
+
+
+class WriterError(Exception):
+    pass
+
+
+def scalar(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def to_int(value):
+    return int(value)
+
+
+def to_float(value):
+    return float(value)
+
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value)
+
+
+def to_string(value):
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+class CSVResultWriter:
+
+    def __init__(self, f, columns, header=True):
+        self.columns = columns
+        self.writer = csv.writer(f)
+        if header:
+            self.writer.writerow(columns)
+
+    def write_row(self, item):
+        self.writer.writerow([scalar(item.get(column)) for column in self.columns])
+
+    def close(self):
+        pass
+
+
+class NDJSONResultWriter:
+
+    def __init__(self, f, columns):
+        self.f = f
+        self.encoder = json.JSONEncoder(ensure_ascii=False)
+
+    def write_row(self, item):
+        self.f.write(self.encoder.encode(item))
+        self.f.write('\n')
+
+    def close(self):
+        pass
+
+
+class ParquetResultWriter:
+    arrow_types = {'bigint': 'int64', 'integer': 'int64', 'int': 'int64', 'smallint': 'int64',
+                   'double': 'float64', 'real': 'float64', 'float': 'float64', 'boolean': 'bool'}
+    converters = {'int64': to_int, 'float64': to_float, 'bool': to_bool, 'string': to_string}
+
+    def __init__(self, filename, column_metadata, batch_size=10000, compression=None):
+        if pyarrow is None:
+            raise WriterError('Parquet output requires pyarrow to be installed')
+        self.columns = [column['name'] for column in column_metadata]
+        types = [self.arrow_types.get(column.get('type', '').lower(), 'string') for column in column_metadata]
+        self.schema = pyarrow.schema([(name, getattr(pyarrow, arrow_type)()) for name, arrow_type in
+                                      zip(self.columns, types)])
+        self.column_converters = [(name, self.converters[arrow_type]) for name, arrow_type in zip(self.columns, types)]
+        # Parquet compresses its column chunks itself instead of the whole file being wrapped
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema, compression=compression or 'snappy')
+        self.batch_size = batch_size
+        self.batch = {column: [] for column in self.columns}
+        self.batch_rows = 0
+
+    def write_row(self, item):
+        for column, converter in self.column_converters:
+            value = item.get(column)
+            if value is not None and value != '':
+                try:
+                    value = converter(value)
+                except (TypeError, ValueError):
+                    value = None
+            else:
+                value = None
+            self.batch[column].append(value)
+        self.batch_rows += 1
+        if self.batch_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch_rows:
+            self.writer.write_table(pyarrow.Table.from_pydict(self.batch, schema=self.schema))
+            self.batch = {column: [] for column in self.columns}
+            self.batch_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def cell_rank(value):
+    # Mirrors how tabulate picks a column type: none < bool < int < float < str
+    if value is None or value == '':
+        return 0
+    if type(value) is bool or value in ('True', 'False'):
+        return 1
+    if type(value) is int:
+        return 2
+    if type(value) is float:
+        return 3
+    if isinstance(value, str):
+        try:
+            int(value)
+            return 2
+        except ValueError:
+            pass
+        # Numbers with thousands separators such as 1,000 count as numbers too
+        if THOUSANDS_NUMBER.match(value):
+            return 3 if '.' in value else 2
+        try:
+            number = float(value)
+        except ValueError:
+            return 5
+        if math.isinf(number) or math.isnan(number):
+            return 3 if value.lower() in ('inf', '-inf', 'nan') else 5
+        return 3
+    return 5
+
+
+def format_cell(value, rank):
+    if value is None or value == '':
+        return ''
+    if rank == 2:
+        return format(value, '')
+    if rank == 3:
+        if isinstance(value, str):
+            value = value.replace(',', '')
+        try:
+            return format(float(value), 'g')
+        except (TypeError, ValueError):
+            return str(value)
+    return str(value).strip()
+
+
+def afterpoint(text):
+    if cell_rank(text) != 3:
+        return -1
+    position = text.rfind('.')
+    if position < 0:
+        position = text.lower().rfind('e')
+    return len(text) - position - 1 if position >= 0 else -1
+
+
+def text_width(text):
+    # tabulate measures display width with wcwidth when it is installed, wide characters take two cells
+    if wcwidth is None or (text.isascii() and text.isprintable()):
+        return len(text)
+    return wcwidth.wcswidth(text)
+
+
+def lines_width(text):
+    return max(text_width(line) for line in LINE_BREAK.split(text))
+
+
+def pad_lines(text, width, numeric):
+    pad = str.rjust if numeric else str.ljust
+    if wcwidth is None:
+        return [pad(line, width) for line in text.splitlines()]
+    # tabulate pairs splitlines() lines with the width corrections of a [\r\n] split, keep its pairing
+    corrections = [text_width(line) - len(line) for line in LINE_BREAK.split(text)]
+    return [pad(line, width - correction) for line, correction in zip(text.splitlines(), corrections)]
+
+
+def overflow(text):
+    # How far pad_lines pushes a line past the column width when its correction belongs to another line
+    corrections = [text_width(line) - len(line) for line in LINE_BREAK.split(text)]
+    extra = 0
+    for line, correction in zip(text.splitlines(), corrections):
+        width = text_width(line)
+        if width >= 0:
+            extra = max(extra, width - len(line) - correction)
+    return extra
+
+
+def table_lines(columns, rows):
+    """Lay out rows like tabulate's psql format, reading rows in passes so they can stream from disk."""
+    if not columns:
+        return
+    ranks = [1] * len(columns)
+    multiline = any(LINE_BREAK.search(column) for column in columns)
+    for row in rows:
+        for i, value in enumerate(row):
+            if ranks[i] < 5:
+                rank = cell_rank(value)
+                if rank > ranks[i]:
+                    ranks[i] = rank
+            if not multiline and isinstance(value, str) and ('\n' in value or '\r' in value):
+                multiline = True
+    numeric = [rank in (2, 3) for rank in ranks]
+    width_of = lines_width if multiline else text_width
+
+    widths = [width_of(column) + 2 for column in columns]
+    heads = [-math.inf] * len(columns)
+    afters = [-1] * len(columns)
+    extras = [0] * len(columns)
+    for row in rows:
+        for i, value in enumerate(row):
+            text = format_cell(value, ranks[i])
+            if multiline:
+                line_widths = [text_width(line) for line in LINE_BREAK.split(text)]
+                if wcwidth is not None:
+                    extras[i] = max(extras[i], overflow(text))
+                if numeric[i]:
+                    # The decimal point padding only lengthens the last line
+                    after = afterpoint(text)
+                    afters[i] = max(afters[i], after)
+                    heads[i] = max(heads[i], line_widths.pop() - after)
+                if line_widths:
+                    widths[i] = max(widths[i], max(line_widths))
+            elif numeric[i]:
+                after = afterpoint(text)
+                afters[i] = max(afters[i], after)
+                heads[i] = max(heads[i], text_width(text) - after)
+            else:
+                widths[i] = max(widths[i], text_width(text))
+    for i, is_numeric in enumerate(numeric):
+        if is_numeric:
+            widths[i] = max(widths[i], heads[i] + afters[i])
+    column_widths = [width + extra for width, extra in zip(widths, extras)]
+    pads = [str.rjust if is_numeric else str.ljust for is_numeric in numeric]
+
+    rule = '-+-'.join('-' * width for width in column_widths)
+    yield '+-' + rule + '-+'
+    if multiline:
+        yield from row_lines(['\n'.join(pad(line, width + len(line) - text_width(line))
+                                        for line in LINE_BREAK.split(column)).splitlines()
+                              for column, width, pad in zip(columns, column_widths, pads)], column_widths)
+    else:
+        heads = [pad(column, width + len(column) - text_width(column))
+                 for column, width, pad in zip(columns, column_widths, pads)]
+        yield '| ' + ' | '.join(heads) + ' |'
+    yield '|-' + rule + '-|'
+    for row in rows:
+        cells = []
+        for i, value in enumerate(row):
+            text = format_cell(value, ranks[i])
+            if numeric[i]:
+                text += ' ' * (afters[i] - afterpoint(text))
+            if multiline:
+                cells.append(pad_lines(text, widths[i], numeric[i]))
+            else:
+                cells.append(pads[i](text, widths[i] + len(text) - text_width(text)))
+        if multiline:
+            yield from row_lines(cells, column_widths)
+        else:
+            yield '| ' + ' | '.join(cells) + ' |'
+    yield '+-' + rule + '-+'
+
+
+def row_lines(cells, widths):
+    # Multi-line cells are spread over several table lines, shorter cells are filled with blanks
+    for n in range(max(len(lines) for lines in cells)):
+        parts = [lines[n] if n < len(lines) else ' ' * width for lines, width in zip(cells, widths)]
+        yield '| ' + ' | '.join(parts) + ' |'
+
+
+def json_chunks(metadata, items):
+    """Yield the same text as json.dumps({'metadata': ..., 'items': ...}, indent=4) one item at a time."""
+    yield '{\n    "metadata": ' + json.dumps(metadata, indent=4).replace('\n', '\n    ') + ',\n    "items": ['
+    separator = '\n        '
+    for item in items:
+        yield separator + json.dumps(item, indent=4).replace('\n', '\n        ')
+        separator = ',\n        '
+    yield ('\n    ]' if separator != '\n        ' else ']') + '\n}'
+
+
+def compression_for_file(filename):
+    extension = os.path.splitext(filename or '')[1].lower()
+    for compression, compression_extension in COMPRESSION_EXTENSIONS.items():
+        if extension == compression_extension:
+            return compression
+    return None
+
+
+def open_output(filename, compression=None, append=False):
+    mode = 'a' if append else 'w'
+    if compression == 'gzip':
+        return gzip.open(filename, mode + 't', compresslevel=6, encoding='utf-8', newline='')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise WriterError('zstd compression requires zstandard to be installed')
+        return zstandard.open(filename, mode + 't', encoding='utf-8', newline='')
+    if compression is not None:
+        raise WriterError('Unknown compression: ' + compression)
+    return open(filename, mode, newline='', encoding='utf-8')
+
+
+def format_for_file(filename, default='table'):
+    if compression_for_file(filename):
+        filename = os.path.splitext(filename)[0]
+    extension = os.path.splitext(filename or '')[1].lower()
+    for output_format, format_extension in FORMAT_EXTENSIONS.items():
+        if extension == format_extension:
+            return output_format
+    return default
+
+
+def write_result_rows(output_format, output_file, metadata, rows, append=False, compression=None, f=None,
+                      header=None):
+    if output_format not in STREAMING_FORMATS:
+        raise WriterError('Unknown streaming output format: ' + output_format)
+    column_metadata = metadata.get('columns', [])
+    columns = [column['name'] for column in column_metadata]
+    opened = None
+    compression = compression or compression_for_file(output_file)
+    if compression and not output_file:
+        raise WriterError('Compressed output requires an output file')
+    if output_format == 'parquet':
+        if not output_file:
+            raise WriterError('Parquet output requires an output file')
+        if append:
+            raise WriterError('Parquet output cannot be appended to')
+        writer = ParquetResultWriter(output_file, column_metadata, compression=compression)
+    else:
+        if header is None:
+            header = not (append and output_file and os.path.exists(output_file) and os.path.getsize(output_file))
+        if f is None and output_file:
+            f = opened = open_output(output_file, compression, append)
+        elif f is None:
+            f = sys.stdout
+        if output_format == 'csv':
+            writer = CSVResultWriter(f, columns, header)
+        else:
+            writer = NDJSONResultWriter(f, columns)
+
+    count = 0
+    try:
+        for item in rows:
+            writer.write_row(item)
+            count += 1
+    finally:
+        writer.close()
+        if opened is not None:
+            opened.close()
+    return count